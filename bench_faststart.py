@@ -0,0 +1,122 @@
+"""
+Бенчмарк переноса moov в начало файла: faststart_mp4 (в процессе, буфер
+фиксированного размера) против ffmpeg -c copy -movflags +faststart.
+Если ffmpeg есть, исходники кодируются им же (moov в конце файла),
+иначе собираются синтетические MP4 и меряется только faststart_mp4.
+Запуск: python bench_faststart.py [размеры_в_MB через запятую]
+"""
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+sys.path.insert(0, '.')
+
+from bot import faststart_mp4, probe_mp4
+
+SIZES_MB = [10, 100, 500]
+CHUNK = 1024 * 1024
+
+
+def box(kind: bytes, body: bytes) -> bytes:
+    return struct.pack('>I4s', 8 + len(body), kind) + body
+
+
+def full_box(kind: bytes, body: bytes) -> bytes:
+    return box(kind, b'\0\0\0\0' + body)
+
+
+def make_synthetic(path: str, size_mb: int):
+    """ftyp + mdat из size_mb чанков по 1 MB + moov с stco на каждый чанк."""
+    ftyp = box(b'ftyp', b'isom\0\0\0\0isommp41')
+    mdat_header = struct.pack('>I4s', 8 + size_mb * CHUNK, b'mdat')
+    first = len(ftyp) + len(mdat_header)
+    offsets = [first + i * CHUNK for i in range(size_mb)]
+    stco = full_box(b'stco', struct.pack('>I', len(offsets)) + b''.join(struct.pack('>I', o) for o in offsets))
+    mvhd = full_box(b'mvhd', struct.pack('>IIII', 0, 0, 1000, size_mb * 1000) + b'\0' * 80)
+    tkhd = full_box(b'tkhd', b'\0' * 72 + struct.pack('>II', 1280 << 16, 720 << 16))
+    hdlr = full_box(b'hdlr', b'\0' * 4 + b'vide' + b'\0' * 13)
+    stbl = box(b'stbl', stco)
+    trak = box(b'trak', tkhd + box(b'mdia', hdlr + box(b'minf', stbl)))
+    moov = box(b'moov', mvhd + trak)
+    with open(path, 'wb') as f:
+        f.write(ftyp)
+        f.write(mdat_header)
+        for i in range(size_mb):
+            # Метка чанка в начале, чтобы проверить смещения после переноса
+            f.write(struct.pack('>I', i) + b'\0' * (CHUNK - 4))
+        f.write(moov)
+
+
+def check_synthetic(path: str, size_mb: int) -> bool:
+    info = probe_mp4(path)
+    if not info or not info.faststart:
+        return False
+    with open(path, 'rb') as f:
+        data = f.read(4096)
+        pos = data.index(b'stco') + 8
+        count = struct.unpack_from('>I', data, pos)[0]
+        offsets = struct.unpack_from(f'>{count}I', data, pos + 4)
+        for i in (0, size_mb // 2, size_mb - 1):
+            f.seek(offsets[i])
+            if struct.unpack('>I', f.read(4))[0] != i:
+                return False
+    return True
+
+
+def make_real(ffmpeg: str, path: str, size_mb: int):
+    """Реальное видео размером size_mb без faststart: шум плохо сжимается, -fs обрезает по размеру."""
+    subprocess.run([ffmpeg, '-y', '-loglevel', 'error', '-f', 'lavfi',
+                    '-i', 'testsrc=size=1280x720:rate=30,noise=alls=80:allf=t',
+                    '-t', '3600', '-fs', str(size_mb * CHUNK), '-c:v', 'mpeg4', '-q:v', '2',
+                    '-f', 'mp4', path], check=True)
+
+
+def run_ffmpeg(ffmpeg: str, src: str, dst: str):
+    subprocess.run([ffmpeg, '-y', '-loglevel', 'error', '-i', src, '-c', 'copy',
+                    '-movflags', '+faststart', '-f', 'mp4', dst], check=True)
+
+
+def timed(func, *args) -> float:
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    sizes = [int(x) for x in sys.argv[1].split(',')] if len(sys.argv) > 1 else SIZES_MB
+    ffmpeg = shutil.which('ffmpeg')
+    print("=== Faststart benchmark ===\n")
+    print(f"Исходники: {'ffmpeg testsrc' if ffmpeg else 'синтетические MP4 (ffmpeg не найден)'}\n")
+    print(f"{'size, MB':>9} {'actual, MB':>11} {'native, s':>10} {'ffmpeg, s':>10} {'check':>6}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size_mb in sizes:
+            src = os.path.join(tmp, f'src_{size_mb}.mp4')
+            native_out = os.path.join(tmp, 'native.mp4')
+            ffmpeg_out = os.path.join(tmp, 'ffmpeg.mp4')
+            if ffmpeg:
+                make_real(ffmpeg, src, size_mb)
+            else:
+                make_synthetic(src, size_mb)
+
+            actual_mb = os.path.getsize(src) / CHUNK
+            native_s = timed(faststart_mp4, src, native_out)
+            if ffmpeg:
+                ffmpeg_s = timed(run_ffmpeg, ffmpeg, src, ffmpeg_out)
+                native_info = probe_mp4(native_out)
+                ok = bool(native_info and native_info.faststart)
+                os.remove(ffmpeg_out)
+                ffmpeg_col = f"{ffmpeg_s:>10.2f}"
+            else:
+                ok = check_synthetic(native_out, size_mb)
+                ffmpeg_col = f"{'-':>10}"
+            print(f"{size_mb:>9} {actual_mb:>11.1f} {native_s:>10.2f} {ffmpeg_col} {'ok' if ok else 'FAIL':>6}")
+            os.remove(native_out)
+            os.remove(src)
+    print("\n=== Benchmark Complete ===")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Бенчмарк HTTP пула: новая ClientSession на каждый запрос против общего
+HttpClientManager с keep-alive. По умолчанию поднимает локальный сервер,
+можно передать URL реального CDN, чтобы увидеть экономию TLS рукопожатий.
+Запуск: python bench_http_pool.py [url]
+"""
+import asyncio
+import sys
+import time
+sys.path.insert(0, '.')
+
+import aiohttp
+import aiohttp.web
+
+from bot import HttpClientManager
+
+REQUESTS = 50
+
+
+async def start_local_server():
+    """Локальный сервер, считающий новые TCP соединения."""
+    peers = set()
+
+    async def handle(request):
+        peers.add(request.transport.get_extra_info('peername'))
+        return aiohttp.web.Response(body=b'x' * 1024)
+
+    app = aiohttp.web.Application()
+    app.router.add_get('/', handle)
+    runner = aiohttp.web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = aiohttp.web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/", peers
+
+
+async def bench_fresh_sessions(url: str) -> float:
+    start = time.perf_counter()
+    for _ in range(REQUESTS):
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url) as resp:
+                await resp.read()
+    return (time.perf_counter() - start) * 1000 / REQUESTS
+
+
+async def bench_shared_pool(url: str) -> float:
+    client = HttpClientManager()
+    await client.start()
+    try:
+        start = time.perf_counter()
+        for _ in range(REQUESTS):
+            async with client.session().get(url) as resp:
+                await resp.read()
+        return (time.perf_counter() - start) * 1000 / REQUESTS
+    finally:
+        await client.close()
+
+
+async def main():
+    print("=== HTTP pool benchmark ===\n")
+    runner = None
+    peers = None
+    if len(sys.argv) > 1:
+        url = sys.argv[1]
+    else:
+        runner, url, peers = await start_local_server()
+    print(f"URL: {url}, запросов: {REQUESTS}\n")
+
+    fresh_ms = await bench_fresh_sessions(url)
+    fresh_conns = len(peers) if peers is not None else None
+    if peers is not None:
+        peers.clear()
+    pooled_ms = await bench_shared_pool(url)
+    pooled_conns = len(peers) if peers is not None else None
+
+    print(f"{'mode':>16} {'ms/request':>12} {'connections':>12}")
+    print(f"{'fresh session':>16} {fresh_ms:>12.2f} {str(fresh_conns or '-'):>12}")
+    print(f"{'shared pool':>16} {pooled_ms:>12.2f} {str(pooled_conns or '-'):>12}")
+
+    if runner:
+        await runner.cleanup()
+    print("\n=== Benchmark Complete ===")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
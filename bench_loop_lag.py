@@ -0,0 +1,128 @@
+"""
+Бенчмарк задержки event loop во время большой загрузки: синхронный
+f.write против AsyncFileSink. Оба читают ответ одинаковыми кусками по
+CHUNK и пишут в настоящий файл. Локальный сервер отдаёт файл со скоростью
+сети (по умолчанию 200 MB/s, паузы через asyncio.sleep в его собственном
+loop, 0 - без ограничения), параллельно тикер раз в 10 мс меряет,
+на сколько опаздывает loop клиента.
+Запуск: python bench_loop_lag.py [размер_в_MB] [сеть_MB/s]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+sys.path.insert(0, '.')
+
+import aiohttp
+import aiohttp.web
+
+from bot import AsyncFileSink
+
+TICK = 0.01
+BLOCK = b'\0' * (1024 * 1024)
+CHUNK = 64 * 1024
+NET_MBPS = 200
+
+
+def start_server(size_mb: int):
+    """Сервер в отдельном потоке со своим loop, чтобы не искажать замер."""
+    ready = threading.Event()
+    state = {}
+
+    async def handle(request):
+        resp = aiohttp.web.StreamResponse()
+        resp.content_length = size_mb * len(BLOCK)
+        await resp.prepare(request)
+        for _ in range(size_mb):
+            await resp.write(BLOCK)
+            if NET_MBPS:
+                await asyncio.sleep(1 / NET_MBPS)
+        return resp
+
+    async def serve():
+        app = aiohttp.web.Application()
+        app.router.add_get('/file', handle)
+        runner = aiohttp.web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = aiohttp.web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        state['port'] = site._server.sockets[0].getsockname()[1]
+        state['stop'] = asyncio.Event()
+        ready.set()
+        await state['stop'].wait()
+        await runner.cleanup()
+
+    def run():
+        state['loop'] = asyncio.new_event_loop()
+        state['loop'].run_until_complete(serve())
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    ready.wait()
+
+    def stop():
+        state['loop'].call_soon_threadsafe(state['stop'].set)
+        thread.join()
+
+    return stop, f"http://127.0.0.1:{state['port']}/file"
+
+
+async def ticker(lags: list, stop: asyncio.Event):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - start - TICK)
+
+
+async def sync_writes(resp, path: str):
+    with open(path, 'wb') as f:
+        async for chunk in resp.content.iter_chunked(CHUNK):
+            f.write(chunk)
+
+
+async def sink_writes(resp, path: str):
+    async with AsyncFileSink(path) as sink:
+        async for chunk in resp.content.iter_chunked(CHUNK):
+            await sink.write(chunk)
+
+
+async def measure(url: str, writer, path: str):
+    lags = []
+    stop = asyncio.Event()
+    tick_task = asyncio.create_task(ticker(lags, stop))
+    start = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url) as resp:
+            await writer(resp, path)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await tick_task
+    os.remove(path)
+    lags.sort()
+    p99 = lags[int(len(lags) * 0.99)] if lags else 0.0
+    # Доля времени, на которую тикер опаздывал, - сколько loop был занят не им
+    blocked = sum(lags) / elapsed * 100 if elapsed else 0.0
+    return elapsed, p99 * 1000, (lags[-1] if lags else 0.0) * 1000, blocked
+
+
+async def main():
+    global NET_MBPS
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    if len(sys.argv) > 2:
+        NET_MBPS = float(sys.argv[2])
+    print("=== Event loop lag benchmark ===\n")
+    stop_server, url = start_server(size_mb)
+    print(f"Файл: {size_mb} MB, сеть: {NET_MBPS or 'без ограничения'} MB/s, куски по {CHUNK // 1024} KB\n")
+    print(f"{'mode':>16} {'seconds':>9} {'lag p99, ms':>12} {'lag max, ms':>12} {'blocked, %':>11}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, writer in (("sync f.write", sync_writes), ("AsyncFileSink", sink_writes)):
+            elapsed, p99, worst, blocked = await measure(url, writer, os.path.join(tmp, 'out.bin'))
+            print(f"{name:>16} {elapsed:>9.2f} {p99:>12.2f} {worst:>12.2f} {blocked:>11.1f}")
+    stop_server()
+    print("\n=== Benchmark Complete ===")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
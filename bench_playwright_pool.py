@@ -0,0 +1,144 @@
+"""
+Бенчмарк Playwright: новая страница на каждый запрос с ожиданием networkidle
+против PagePool (прогретые страницы, блокировка картинок, шрифтов, стилей
+и аналитики, ожидание domcontentloaded). Локальный сервер отдаёт страницу
+поста с тяжёлыми ресурсами, каждый ресурс отвечает с задержкой.
+Меряется время запроса и суммарный RSS процессов браузера.
+Бенчмарк ещё ни разу не запускался (Chromium при разработке пула не было):
+выигрыш пула по времени и RSS не подтверждён замерами.
+Запуск: python bench_playwright_pool.py
+"""
+import asyncio
+import os
+import sys
+import time
+sys.path.insert(0, '.')
+
+import aiohttp.web
+from playwright.async_api import async_playwright
+
+from bot import PagePool
+
+REQUESTS = 20
+IMAGES = 30
+FONTS = 4
+RESOURCE_DELAY = 0.05  # секунд на ответ каждого ресурса
+
+
+def page_html() -> str:
+    images = ''.join(f'<img src="/img/{i}.jpg">' for i in range(IMAGES))
+    fonts = ''.join(
+        f'@font-face {{ font-family: f{i}; src: url(/font/{i}.woff2); }} body {{ font-family: f{i}; }}'
+        for i in range(FONTS)
+    )
+    return (
+        '<html><head>'
+        '<meta property="og:video" content="/video.mp4">'
+        '<link rel="stylesheet" href="/style.css">'
+        f'<style>{fonts}</style>'
+        '<script async src="https://www.googletagmanager.com/gtag/js"></script>'
+        '</head><body>'
+        f'<video src="/video.mp4"></video>{images}'
+        '<script>fetch("/api/post")</script>'
+        '</body></html>'
+    )
+
+
+async def start_local_server():
+    html = page_html()
+
+    async def post(request):
+        return aiohttp.web.Response(text=html, content_type='text/html')
+
+    async def resource(request):
+        await asyncio.sleep(RESOURCE_DELAY)
+        return aiohttp.web.Response(body=os.urandom(100 * 1024), content_type='application/octet-stream')
+
+    async def api(request):
+        return aiohttp.web.json_response({'ok': True})
+
+    app = aiohttp.web.Application()
+    app.router.add_get('/p/{id}', post)
+    app.router.add_get('/api/post', api)
+    app.router.add_get('/{tail:.*}', resource)
+    runner = aiohttp.web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = aiohttp.web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def browser_rss_mb() -> float:
+    """RSS всех потомков текущего процесса (драйвер и процессы Chromium)."""
+    parents = {}
+    rss = {}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                fields = dict(line.split(':', 1) for line in f if ':' in line)
+        except OSError:
+            continue
+        parents[int(pid)] = int(fields.get('PPid', '0').strip())
+        rss[int(pid)] = int(fields.get('VmRSS', '0 kB').split()[0])
+    me = os.getpid()
+    total = 0
+    for pid in rss:
+        parent = parents.get(pid)
+        while parent and parent != me:
+            parent = parents.get(parent)
+        if parent == me:
+            total += rss[pid]
+    return total / 1024
+
+
+async def bench_fresh_pages(context, base: str) -> float:
+    start = time.perf_counter()
+    for i in range(REQUESTS):
+        page = await context.new_page()
+        try:
+            await page.goto(f"{base}/p/{i}", wait_until='networkidle')
+            await page.locator('meta[property="og:video"]').first.get_attribute('content')
+        finally:
+            await page.close()
+    return (time.perf_counter() - start) * 1000 / REQUESTS
+
+
+async def bench_page_pool(context, base: str) -> float:
+    pool = PagePool('bench', size=2)
+    await pool.start(context)
+    try:
+        start = time.perf_counter()
+        for i in range(REQUESTS):
+            async with pool.page() as page:
+                await page.goto(f"{base}/p/{i}", wait_until='domcontentloaded')
+                await page.locator('meta[property="og:video"]').first.get_attribute('content')
+        return (time.perf_counter() - start) * 1000 / REQUESTS
+    finally:
+        await pool.close()
+
+
+async def main():
+    print("=== Playwright page pool benchmark ===\n")
+    runner, base = await start_local_server()
+    print(f"Запросов: {REQUESTS}, ресурсов на странице: {IMAGES + FONTS + 1}\n")
+    print(f"{'mode':>16} {'ms/request':>12} {'browser RSS, MB':>16}")
+    async with async_playwright() as pw:
+        for name, bench in (('fresh page', bench_fresh_pages), ('page pool', bench_page_pool)):
+            # Отдельный браузер на режим, чтобы RSS не копился между замерами
+            browser = await pw.chromium.launch(headless=True)
+            context = await browser.new_context()
+            try:
+                ms = await bench(context, base)
+                rss = browser_rss_mb()
+            finally:
+                await browser.close()
+            print(f"{name:>16} {ms:>12.1f} {rss:>16.1f}")
+    await runner.cleanup()
+    print("\n=== Benchmark Complete ===")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,145 @@
+"""
+Проверка загрузчика по диапазонам на локальной заглушке: сервер ограничивает
+скорость одного соединения, поэтому пропускная способность должна расти
+с числом сегментов. Дополнительно проверяются откат на один поток, когда
+диапазоны не поддержаны, и докачка оборванного сегмента.
+Запуск: python bench_ranged_download.py [размер_в_MB]
+"""
+import asyncio
+import hashlib
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+sys.path.insert(0, '.')
+
+import aiohttp
+import aiohttp.web
+
+from bot import download_direct, HttpClientManager
+
+PER_CONNECTION_MBPS = 8
+CHUNK = 64 * 1024
+
+
+def start_stub(payload: bytes):
+    """Заглушка в отдельном потоке: /ranged, /plain (без Range) и /flaky (рвёт первые ответы)."""
+    ready = threading.Event()
+    state = {'flaky_drops': 2}
+
+    async def send(request, start: int, end: int, status: int, drop_after: int = None):
+        resp = aiohttp.web.StreamResponse(status=status)
+        resp.content_length = end - start + 1
+        resp.headers['Accept-Ranges'] = 'bytes'
+        if status == 206:
+            resp.headers['Content-Range'] = f"bytes {start}-{end}/{len(payload)}"
+        await resp.prepare(request)
+        sent = 0
+        for pos in range(start, end + 1, CHUNK):
+            if drop_after is not None and sent >= drop_after:
+                request.transport.close()
+                return resp
+            await resp.write(payload[pos:min(end + 1, pos + CHUNK)])
+            sent += CHUNK
+            await asyncio.sleep(CHUNK / (PER_CONNECTION_MBPS * 1024 * 1024))
+        return resp
+
+    def parse_range(request):
+        match = re.match(r'bytes=(\d+)-(\d*)', request.headers.get('Range', ''))
+        if not match:
+            return None
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else len(payload) - 1
+        return start, min(end, len(payload) - 1)
+
+    async def ranged(request):
+        rng = parse_range(request)
+        if rng is None:
+            return await send(request, 0, len(payload) - 1, 200)
+        return await send(request, rng[0], rng[1], 206)
+
+    async def plain(request):
+        return await send(request, 0, len(payload) - 1, 200)
+
+    async def flaky(request):
+        rng = parse_range(request)
+        if rng is None:
+            return await send(request, 0, len(payload) - 1, 200)
+        drop = None
+        if rng[1] - rng[0] > CHUNK * 4 and state['flaky_drops'] > 0:
+            state['flaky_drops'] -= 1
+            drop = CHUNK * 4
+        return await send(request, rng[0], rng[1], 206, drop_after=drop)
+
+    async def serve():
+        app = aiohttp.web.Application()
+        app.router.add_get('/ranged', ranged)
+        app.router.add_get('/plain', plain)
+        app.router.add_get('/flaky', flaky)
+        runner = aiohttp.web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = aiohttp.web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        state['port'] = site._server.sockets[0].getsockname()[1]
+        state['stop'] = asyncio.Event()
+        ready.set()
+        await state['stop'].wait()
+        await runner.cleanup()
+
+    def run():
+        state['loop'] = asyncio.new_event_loop()
+        state['loop'].run_until_complete(serve())
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    ready.wait()
+
+    def stop():
+        state['loop'].call_soon_threadsafe(state['stop'].set)
+        thread.join()
+
+    return stop, f"http://127.0.0.1:{state['port']}"
+
+
+async def fetch(session, url: str, path: str, segments: int, expected: str):
+    start = time.perf_counter()
+    result = await download_direct(session, url, path, segments=segments)
+    elapsed = time.perf_counter() - start
+    ok = result is not None and result.sha256 == expected
+    os.remove(path)
+    return elapsed, ok
+
+
+async def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    payload = os.urandom(size_mb * 1024 * 1024)
+    expected = hashlib.sha256(payload).hexdigest()
+    stop, base = start_stub(payload)
+
+    client = HttpClientManager(limit_per_host=16)
+    await client.start()
+    session = client.session()
+
+    print("=== Ranged download check ===\n")
+    print(f"Файл: {size_mb} MB, скорость одного соединения: {PER_CONNECTION_MBPS} MB/s\n")
+    print(f"{'segments':>9} {'seconds':>9} {'MB/s':>8} {'sha256':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'out.bin')
+        for segments in (1, 2, 4, 8):
+            elapsed, ok = await fetch(session, f"{base}/ranged", path, segments, expected)
+            print(f"{segments:>9} {elapsed:>9.2f} {size_mb / elapsed:>8.1f} {'ok' if ok else 'FAIL':>8}")
+
+        elapsed, ok = await fetch(session, f"{base}/plain", path, 4, expected)
+        print(f"\nБез Range (откат на один поток): {elapsed:.2f}s, sha256 {'ok' if ok else 'FAIL'}")
+        elapsed, ok = await fetch(session, f"{base}/flaky", path, 4, expected)
+        print(f"Обрывы сегментов (докачка): {elapsed:.2f}s, sha256 {'ok' if ok else 'FAIL'}")
+
+    await client.close()
+    stop()
+    print("\n=== Check Complete ===")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
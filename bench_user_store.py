@@ -0,0 +1,64 @@
+"""
+Бенчмарк хранилища пользователей: стоимость одного обновления счётчика
+в зависимости от количества пользователей (JSON vs SQLite).
+Запуск: python bench_user_store.py
+"""
+import os
+import sys
+import tempfile
+import time
+sys.path.insert(0, '.')
+
+from bot import JsonUserStore, SQLiteUserStore
+
+USER_COUNTS = [1_000, 10_000, 100_000]
+UPDATES = 200
+
+
+def make_users(count: int) -> dict:
+    return {
+        uid: {
+            'premium': False,
+            'premium_until': None,
+            'downloads_today': 0,
+            'last_download_date': '2025-01-01',
+            'referral_code': f"{uid:08x}",
+            'referred_by': None,
+            'referrals_completed': [],
+        }
+        for uid in range(count)
+    }
+
+
+def bench(store, users: dict) -> float:
+    """Возвращает среднее время одного обновления в миллисекундах."""
+    store.save_all(users, {}, {})
+    start = time.perf_counter()
+    for i in range(UPDATES):
+        uid = (i * 7919) % len(users)
+        users[uid]['downloads_today'] += 1
+        store.save_user(uid, users[uid])
+    return (time.perf_counter() - start) * 1000 / UPDATES
+
+
+def main():
+    print("=== User store benchmark ===\n")
+    print(f"{'users':>10} {'json, ms/update':>18} {'sqlite, ms/update':>20}")
+    for count in USER_COUNTS:
+        with tempfile.TemporaryDirectory() as tmp:
+            json_store = JsonUserStore(
+                users_file=os.path.join(tmp, 'users.json'),
+                settings_file=os.path.join(tmp, 'settings.json'),
+                referrals_file=os.path.join(tmp, 'referrals.json'),
+            )
+            json_ms = bench(json_store, make_users(count))
+
+            sqlite_store = SQLiteUserStore(os.path.join(tmp, 'users.db'))
+            sqlite_ms = bench(sqlite_store, make_users(count))
+            sqlite_store.close()
+        print(f"{count:>10} {json_ms:>18.3f} {sqlite_ms:>20.3f}")
+    print("\n=== Benchmark Complete ===")
+
+
+if __name__ == "__main__":
+    main()
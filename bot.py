@@ -1,4 +1,5 @@
 # bot.py - Luno Bot
+import abc
 import asyncio
 import json
 import logging
@@ -8,9 +9,19 @@ import hashlib
 import importlib.util
 import ast
 import time
+import sqlite3
+import threading
+import copy
+import contextvars
+import random
+import contextlib
+import struct
+import math
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Optional, List, Tuple, Dict, Any
+from typing import Optional, List, Tuple, Dict, Any, Callable, Awaitable
+from collections import deque
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
 import aiohttp
 import aiohttp.web
@@ -49,14 +60,6 @@ WEBHOOK_HOST = os.getenv("WEBHOOK_HOST")
 PORT = int(os.getenv("PORT", 8000))
 ADMIN_USERNAME = "@somersbyewich"
 
-YT_BROWSER: Optional[Browser] = None
-YT_CONTEXT: Optional[BrowserContext] = None
-YT_PLAYWRIGHT_READY = False
-
-IG_BROWSER: Optional[Browser] = None
-IG_CONTEXT: Optional[BrowserContext] = None
-IG_PLAYWRIGHT_READY = False
-
 # YouTube Auto-Cookie Refresh
 YOUTUBE_VISITOR_DATA: Optional[str] = None
 YOUTUBE_PO_TOKEN: Optional[str] = None  # Proof of Origin token for bot bypass
@@ -66,6 +69,7 @@ YOUTUBE_REFRESH_INTERVAL = 1800  # 30 минут
 # Shutdown control
 SHUTDOWN_FLAG = False
 YOUTUBE_REFRESH_TASK: Optional[asyncio.Task] = None
+YOUTUBE_POOL_TASK: Optional[asyncio.Task] = None
 INSTAGRAM_REFRESH_TASK: Optional[asyncio.Task] = None
 
 # Instagram Auto-Cookie Refresh
@@ -80,10 +84,63 @@ dp = Dispatcher()
 SETTINGS_FILE = 'user_settings.json'
 USERS_FILE = 'users_data.json'
 REFERRALS_FILE = 'referrals.json'
+FILE_ID_CACHE_FILE = 'file_id_cache.json'
+METHOD_STATS_FILE = 'method_stats.json'
+METHOD_EXPLORATION_RATE = float(os.getenv("METHOD_EXPLORATION_RATE", 0.1))  # доля запросов для исследования
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", 100))  # всего соединений
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", 10))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", 300))  # секунд
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 30.0))  # секунд
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", 64 * 1024))  # байт в буфере потоковой загрузки
+FILE_SINK_MIN_BUFFER = int(os.getenv("FILE_SINK_MIN_BUFFER", 256 * 1024))  # первый сброс на диск
+FILE_SINK_MAX_BUFFER = int(os.getenv("FILE_SINK_MAX_BUFFER", 8 * 1024 * 1024))  # потолок памяти записи на загрузку
+STREAM_MAX_SIZE = int(os.getenv("STREAM_MAX_SIZE", 512 * 1024 * 1024))  # предел размера скачиваемого файла
+PHOTO_FETCH_CONCURRENCY = int(os.getenv("PHOTO_FETCH_CONCURRENCY", 4))  # фото карусели одновременно
+RANGED_SEGMENTS = int(os.getenv("RANGED_SEGMENTS", 4))  # параллельных диапазонов на файл
+RANGED_MIN_SEGMENT_SIZE = int(os.getenv("RANGED_MIN_SEGMENT_SIZE", 2 * 1024 * 1024))  # байт
+RANGED_SEGMENT_RETRIES = int(os.getenv("RANGED_SEGMENT_RETRIES", 3))
+YTDLP_FRAGMENTS_INITIAL = int(os.getenv("YTDLP_FRAGMENTS_INITIAL", 2))  # стартовое число параллельных фрагментов
+YTDLP_FRAGMENTS_MAX = int(os.getenv("YTDLP_FRAGMENTS_MAX", 8))
+YTDLP_CONNECTION_BUDGET = int(os.getenv("YTDLP_CONNECTION_BUDGET", 24))  # фрагментов на все загрузки сразу
+YTDLP_BANDWIDTH_LIMIT = int(os.getenv("YTDLP_BANDWIDTH_LIMIT", 0))  # байт/с на все загрузки, 0 - без лимита
+DOWNLOAD_STATE_FILE = 'download_state.json'
+PARTIALS_DIR = os.getenv("PARTIALS_DIR", "partials")  # недокачанные файлы и .part файлы yt-dlp
+PARTIAL_MAX_AGE = int(os.getenv("PARTIAL_MAX_AGE", 6 * 3600))  # секунд до удаления брошенной докачки
+PARTIAL_JANITOR_INTERVAL = int(os.getenv("PARTIAL_JANITOR_INTERVAL", 1800))  # секунд
+FFMPEG_CONCURRENCY = int(os.getenv("FFMPEG_CONCURRENCY", os.cpu_count() or 2))  # одновременных процессов ffmpeg
+FFMPEG_TIMEOUT = float(os.getenv("FFMPEG_TIMEOUT", 60.0))  # секунд на задачу
+TELEGRAM_FILE_LIMIT = 50 * 1024 * 1024  # больше бот отправить не может
+QUALITY_MAX_HEIGHTS = {'1080p': 1080, '720p': 720, '480p': 480}  # качества, внутри которых подбирается формат под лимит
+FIT_SIZE_MARGIN = 0.95  # запас на оценку размера и контейнер при склейке
+PLAYWRIGHT_PAGE_POOL_SIZE = int(os.getenv("PLAYWRIGHT_PAGE_POOL_SIZE", 2))  # прогретых страниц на контекст
+PLAYWRIGHT_PAGE_HEALTH_TIMEOUT = float(os.getenv("PLAYWRIGHT_PAGE_HEALTH_TIMEOUT", 5.0))  # секунд
+BROWSER_IDLE_TIMEOUT = float(os.getenv("BROWSER_IDLE_TIMEOUT", 600.0))  # секунд простоя до закрытия браузера
+BROWSER_MAX_RSS_MB = float(os.getenv("BROWSER_MAX_RSS_MB", 800.0))  # RSS браузера, после которого он перезапускается
+BROWSER_CHECK_INTERVAL = float(os.getenv("BROWSER_CHECK_INTERVAL", 60.0))  # секунд
+BROWSER_LAUNCH_RETRY = float(os.getenv("BROWSER_LAUNCH_RETRY", 300.0))  # секунд до повтора после неудачного запуска
+PLAYWRIGHT_READY_TIMEOUT = float(os.getenv("PLAYWRIGHT_READY_TIMEOUT", 10.0))  # секунд ожидания нужного ответа страницы
+PLAYWRIGHT_CONSENT_TIMEOUT = float(os.getenv("PLAYWRIGHT_CONSENT_TIMEOUT", 3.0))  # секунд ожидания баннера cookies
+PLAYWRIGHT_CONSENT_BUTTON_TIMEOUT = float(os.getenv("PLAYWRIGHT_CONSENT_BUTTON_TIMEOUT", 1.0))  # секунд до видимой кнопки
+YOUTUBE_TOKEN_REFRESH_AHEAD = float(os.getenv("YOUTUBE_TOKEN_REFRESH_AHEAD", 300.0))  # секунд до истечения токенов
+YOUTUBE_TOKEN_MIN_INTERVAL = float(os.getenv("YOUTUBE_TOKEN_MIN_INTERVAL", 60.0))  # секунд между неудачными обновлениями
+YOUTUBE_TOKEN_POOL_SIZE = int(os.getenv("YOUTUBE_TOKEN_POOL_SIZE", 3))  # дополнительных личностей, 0 - только основная
+YOUTUBE_IDENTITIES_DIR = os.getenv("YOUTUBE_IDENTITIES_DIR", "youtube_identities")  # cookies личностей пула
+YOUTUBE_IDENTITY_ATTEMPTS = int(os.getenv("YOUTUBE_IDENTITY_ATTEMPTS", 2))  # личностей пула на одну загрузку
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 3))  # ошибок подряд до размыкания
+CIRCUIT_BASE_COOLDOWN = float(os.getenv("CIRCUIT_BASE_COOLDOWN", 30.0))  # секунд
+CIRCUIT_MAX_COOLDOWN = float(os.getenv("CIRCUIT_MAX_COOLDOWN", 3600.0))  # секунд
+CIRCUIT_PROBE_INTERVAL = float(os.getenv("CIRCUIT_PROBE_INTERVAL", 20.0))  # секунд
+FILE_ID_CACHE_TTL = int(os.getenv("FILE_ID_CACHE_TTL", 7 * 24 * 3600))  # 7 дней
+FILE_ID_CACHE_MAX_ENTRIES = int(os.getenv("FILE_ID_CACHE_MAX_ENTRIES", 50000))
+USER_DB_FILE = os.getenv("USER_DB_FILE", "users.db")
+USER_STORE_BACKEND = (os.getenv("USER_STORE_BACKEND") or "sqlite").strip().lower()  # sqlite | json
+PERSIST_FLUSH_INTERVAL = int(os.getenv("PERSIST_FLUSH_INTERVAL", 15))  # секунд между сбросами на диск
+PERSIST_FLUSH_MAX_PENDING = int(os.getenv("PERSIST_FLUSH_MAX_PENDING", 200))  # изменений до внеочередного сброса
 
 user_settings = {}
 users_data = {}  # {user_id: {premium: bool, premium_until: timestamp, downloads_today: int, last_download_date: str, referral_code: str, referred_by: user_id}}
 referrals = {}  # {referral_code: user_id}
+user_store: Optional['UserStore'] = None
 
 # Константы
 FREE_DAILY_LIMIT = 1488
@@ -95,68 +152,416 @@ class VideoStates(StatesGroup):
 
 # ==================== РАБОТА С ДАННЫМИ ===================
 
-def load_user_settings():
-    global user_settings
+def _read_json_file(file_path: str) -> Optional[Any]:
     try:
-        with open(SETTINGS_FILE, 'r', encoding='utf-8') as f:
-            user_settings = json.load(f)
-            # Конвертируем ключи обратно в int
-            user_settings = {int(k): v for k, v in user_settings.items()}
-            logger.info(f"Загружено {len(user_settings)} настроек пользователей")
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
     except FileNotFoundError:
-        user_settings = {}
-        save_user_settings()
-    except Exception as e:
-        logger.error(f"Ошибка загрузки настроек: {e}")
-        user_settings = {}
+        return None
 
-def save_user_settings():
+def _atomic_write_json(file_path: str, data: Any):
+    """Пишет JSON во временный файл рядом и атомарно подменяет им исходный."""
+    dir_name = os.path.dirname(os.path.abspath(file_path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp_", suffix=".json", dir=dir_name)
     try:
-        with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(user_settings, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logger.error(f"Ошибка сохранения настроек: {e}")
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
 
-def load_users_data():
-    global users_data
-    try:
-        with open(USERS_FILE, 'r', encoding='utf-8') as f:
-            users_data = json.load(f)
-            users_data = {int(k): v for k, v in users_data.items()}
-            logger.info(f"Загружено {len(users_data)} пользователей")
-    except FileNotFoundError:
-        users_data = {}
-        save_users_data()
-    except Exception as e:
-        logger.error(f"Ошибка загрузки данных пользователей: {e}")
-        users_data = {}
+class UserStore(abc.ABC):
+    """Интерфейс хранилища пользователей, настроек качества и реферальных кодов.
+    Неполная реализация не создаётся: ошибка при конструировании, а не при первом сохранении."""
 
-def save_users_data():
-    try:
-        with open(USERS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(users_data, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logger.error(f"Ошибка сохранения данных пользователей: {e}")
+    name = "base"
+
+    @abc.abstractmethod
+    def load_all(self) -> Tuple[Dict[int, dict], Dict[int, str], Dict[str, int]]:
+        ...
+
+    @abc.abstractmethod
+    def save_user(self, user_id: int, user: dict):
+        ...
+
+    @abc.abstractmethod
+    def save_setting(self, user_id: int, quality: str):
+        ...
+
+    @abc.abstractmethod
+    def save_referral(self, referral_code: str, user_id: int):
+        ...
+
+    @abc.abstractmethod
+    def save_all(self, users: Dict[int, dict], settings: Dict[int, str], refs: Dict[str, int]):
+        ...
+
+    def save_batch(self, users: Dict[int, dict], settings: Dict[int, str], refs: Dict[str, int]):
+        """Сохраняет пачку изменённых записей (вызывается из фонового потока)."""
+        for user_id, user in users.items():
+            self.save_user(user_id, user)
+        for user_id, quality in settings.items():
+            self.save_setting(user_id, quality)
+        for referral_code, user_id in refs.items():
+            self.save_referral(referral_code, user_id)
+
+    def close(self):
+        pass
+
+class JsonUserStore(UserStore):
+    """Старый формат: три JSON-файла, каждое изменение перезаписывает файл целиком."""
+
+    name = "json"
+
+    def __init__(self, users_file: str = USERS_FILE, settings_file: str = SETTINGS_FILE,
+                 referrals_file: str = REFERRALS_FILE):
+        self.users_file = users_file
+        self.settings_file = settings_file
+        self.referrals_file = referrals_file
+        self._users: Dict[int, dict] = {}
+        self._settings: Dict[int, str] = {}
+        self._referrals: Dict[str, int] = {}
+
+    def load_all(self) -> Tuple[Dict[int, dict], Dict[int, str], Dict[str, int]]:
+        users = _read_json_file(self.users_file) or {}
+        settings = _read_json_file(self.settings_file) or {}
+        refs = _read_json_file(self.referrals_file) or {}
+        # Конвертируем ключи обратно в int
+        self._users = {int(k): v for k, v in users.items()}
+        self._settings = {int(k): v for k, v in settings.items()}
+        self._referrals = dict(refs)
+        # Отдаём копии: собственные словари пишутся из фонового потока
+        return copy.deepcopy(self._users), dict(self._settings), dict(self._referrals)
+
+    def _dump(self, file_path: str, data: dict):
+        _atomic_write_json(file_path, data)
+
+    def save_user(self, user_id: int, user: dict):
+        self._users[user_id] = user
+        self._dump(self.users_file, self._users)
+
+    def save_setting(self, user_id: int, quality: str):
+        self._settings[user_id] = quality
+        self._dump(self.settings_file, self._settings)
+
+    def save_referral(self, referral_code: str, user_id: int):
+        self._referrals[referral_code] = user_id
+        self._dump(self.referrals_file, self._referrals)
+
+    def save_all(self, users: Dict[int, dict], settings: Dict[int, str], refs: Dict[str, int]):
+        self._users, self._settings, self._referrals = copy.deepcopy(users), dict(settings), dict(refs)
+        self._dump(self.users_file, self._users)
+        self._dump(self.settings_file, self._settings)
+        self._dump(self.referrals_file, self._referrals)
+
+    def save_batch(self, users: Dict[int, dict], settings: Dict[int, str], refs: Dict[str, int]):
+        # Один файл переписывается не больше одного раза на пачку
+        if users:
+            self._users.update(users)
+            self._dump(self.users_file, self._users)
+        if settings:
+            self._settings.update(settings)
+            self._dump(self.settings_file, self._settings)
+        if refs:
+            self._referrals.update(refs)
+            self._dump(self.referrals_file, self._referrals)
+
+class SQLiteUserStore(UserStore):
+    """SQLite в режиме WAL: каждое изменение обновляет одну строку, а не весь файл."""
+
+    name = "sqlite"
+
+    USER_COLUMNS = ('premium', 'premium_until', 'downloads_today', 'last_download_date',
+                    'referral_code', 'referred_by', 'referrals_completed')
+
+    def __init__(self, db_path: str = USER_DB_FILE):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                premium INTEGER NOT NULL DEFAULT 0,
+                premium_until TEXT,
+                downloads_today INTEGER NOT NULL DEFAULT 0,
+                last_download_date TEXT,
+                referral_code TEXT,
+                referred_by INTEGER,
+                referrals_completed TEXT NOT NULL DEFAULT '[]',
+                extra TEXT NOT NULL DEFAULT '{}'
+            );
+            CREATE TABLE IF NOT EXISTS user_settings (
+                user_id INTEGER PRIMARY KEY,
+                quality TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS referrals (
+                referral_code TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+        # Базы, созданные до появления колонки extra
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(users)")}
+        if 'extra' not in columns:
+            self._conn.execute("ALTER TABLE users ADD COLUMN extra TEXT NOT NULL DEFAULT '{}'")
+
+    def _user_row(self, user_id: int, user: dict) -> tuple:
+        # Ключи вне фиксированных колонок хранятся в extra, чтобы не терять их
+        extra = {k: v for k, v in user.items() if k not in self.USER_COLUMNS}
+        return (
+            user_id,
+            1 if user.get('premium') else 0,
+            user.get('premium_until'),
+            int(user.get('downloads_today') or 0),
+            user.get('last_download_date'),
+            user.get('referral_code'),
+            user.get('referred_by'),
+            json.dumps(user.get('referrals_completed') or []),
+            json.dumps(extra, ensure_ascii=False, default=str),
+        )
 
-def load_referrals():
-    global referrals
+    def _upsert_users(self, rows: List[tuple]):
+        self._conn.executemany(
+            "INSERT INTO users (user_id, premium, premium_until, downloads_today, last_download_date, "
+            "referral_code, referred_by, referrals_completed, extra) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET premium=excluded.premium, premium_until=excluded.premium_until, "
+            "downloads_today=excluded.downloads_today, last_download_date=excluded.last_download_date, "
+            "referral_code=excluded.referral_code, referred_by=excluded.referred_by, "
+            "referrals_completed=excluded.referrals_completed, extra=excluded.extra",
+            rows,
+        )
+
+    def _upsert_settings(self, rows: List[tuple]):
+        self._conn.executemany(
+            "INSERT INTO user_settings (user_id, quality) VALUES (?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET quality=excluded.quality",
+            rows,
+        )
+
+    def _upsert_referrals(self, rows: List[tuple]):
+        self._conn.executemany(
+            "INSERT INTO referrals (referral_code, user_id) VALUES (?, ?) "
+            "ON CONFLICT(referral_code) DO UPDATE SET user_id=excluded.user_id",
+            rows,
+        )
+
+    def load_all(self) -> Tuple[Dict[int, dict], Dict[int, str], Dict[str, int]]:
+        users: Dict[int, dict] = {}
+        with self._lock:
+            for row in self._conn.execute(
+                "SELECT user_id, premium, premium_until, downloads_today, last_download_date, "
+                "referral_code, referred_by, referrals_completed, extra FROM users"
+            ):
+                try:
+                    user = json.loads(row[-1] or '{}')
+                except Exception:
+                    user = {}
+                user.update(zip(self.USER_COLUMNS, row[1:-1]))
+                user['premium'] = bool(user['premium'])
+                try:
+                    user['referrals_completed'] = json.loads(user['referrals_completed'] or '[]')
+                except Exception:
+                    user['referrals_completed'] = []
+                users[row[0]] = user
+            settings = {uid: q for uid, q in self._conn.execute("SELECT user_id, quality FROM user_settings")}
+            refs = {code: uid for code, uid in self._conn.execute("SELECT referral_code, user_id FROM referrals")}
+        return users, settings, refs
+
+    def save_user(self, user_id: int, user: dict):
+        with self._lock:
+            self._upsert_users([self._user_row(user_id, user)])
+
+    def save_setting(self, user_id: int, quality: str):
+        with self._lock:
+            self._upsert_settings([(user_id, quality)])
+
+    def save_referral(self, referral_code: str, user_id: int):
+        with self._lock:
+            self._upsert_referrals([(referral_code, user_id)])
+
+    def save_all(self, users: Dict[int, dict], settings: Dict[int, str], refs: Dict[str, int]):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._upsert_users([self._user_row(uid, u) for uid, u in users.items()])
+                self._upsert_settings(list(settings.items()))
+                self._upsert_referrals(list(refs.items()))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def save_batch(self, users: Dict[int, dict], settings: Dict[int, str], refs: Dict[str, int]):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                if users:
+                    self._upsert_users([self._user_row(uid, u) for uid, u in users.items()])
+                if settings:
+                    self._upsert_settings(list(settings.items()))
+                if refs:
+                    self._upsert_referrals(list(refs.items()))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def get_meta(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+                (key, value),
+            )
+
+    def close(self):
+        with self._lock:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+
+def migrate_json_to_sqlite(store: SQLiteUserStore) -> bool:
+    """Однократно переносит users_data.json / referrals.json / user_settings.json в SQLite."""
+    if store.get_meta('json_migrated_at'):
+        return False
+    legacy = JsonUserStore()
+    users, settings, refs = legacy.load_all()
+    if users or settings or refs:
+        store.save_all(users, settings, refs)
+        logger.info(f"Миграция в SQLite: {len(users)} пользователей, {len(settings)} настроек, {len(refs)} реферальных кодов")
+    store.set_meta('json_migrated_at', datetime.now().isoformat())
+    return bool(users or settings or refs)
+
+def create_user_store(backend: str = USER_STORE_BACKEND) -> UserStore:
+    if backend == "json":
+        return JsonUserStore()
+    store = SQLiteUserStore()
     try:
-        with open(REFERRALS_FILE, 'r', encoding='utf-8') as f:
-            referrals = json.load(f)
-            logger.info(f"Загружено {len(referrals)} реферальных кодов")
-    except FileNotFoundError:
-        referrals = {}
-        save_referrals()
+        migrate_json_to_sqlite(store)
     except Exception as e:
-        logger.error(f"Ошибка загрузки реферальных кодов: {e}")
-        referrals = {}
+        logger.error(f"Ошибка миграции данных в SQLite: {e}")
+    return store
 
-def save_referrals():
+def init_user_store():
+    """Открывает хранилище и загружает данные в память."""
+    global user_store, users_data, user_settings, referrals
     try:
-        with open(REFERRALS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(referrals, f, ensure_ascii=False, indent=2)
+        user_store = create_user_store()
+        users_data, user_settings, referrals = user_store.load_all()
+        logger.info(f"Хранилище {user_store.name}: {len(users_data)} пользователей, "
+                    f"{len(user_settings)} настроек, {len(referrals)} реферальных кодов")
     except Exception as e:
-        logger.error(f"Ошибка сохранения реферальных кодов: {e}")
+        logger.error(f"Ошибка загрузки данных пользователей: {e}")
+        user_store = JsonUserStore()
+        users_data, user_settings, referrals = {}, {}, {}
+
+# ==================== ОТЛОЖЕННАЯ ЗАПИСЬ ====================
+# Изменения помечаются "грязными" и сбрасываются на диск фоновой задачей
+# раз в PERSIST_FLUSH_INTERVAL секунд или после PERSIST_FLUSH_MAX_PENDING изменений.
+
+_dirty_users: set = set()
+_dirty_settings: set = set()
+_dirty_referrals: set = set()
+_pending_mutations = 0
+_flush_event = asyncio.Event()
+_flush_lock = asyncio.Lock()
+PERSIST_FLUSH_TASK: Optional[asyncio.Task] = None
+
+def _note_mutation():
+    global _pending_mutations
+    _pending_mutations += 1
+    if _pending_mutations >= PERSIST_FLUSH_MAX_PENDING:
+        _flush_event.set()
+
+def save_user(user_id: int):
+    """Помечает запись пользователя для сохранения."""
+    if user_id in users_data:
+        _dirty_users.add(user_id)
+        _note_mutation()
+
+def save_user_setting(user_id: int):
+    """Помечает настройку качества пользователя для сохранения."""
+    if user_id in user_settings:
+        _dirty_settings.add(user_id)
+        _note_mutation()
+
+def save_referral(referral_code: str):
+    """Помечает реферальный код для сохранения."""
+    if referral_code in referrals:
+        _dirty_referrals.add(referral_code)
+        _note_mutation()
+
+async def flush_user_data() -> int:
+    """Сбрасывает накопленные изменения в хранилище. Возвращает число записей."""
+    global _pending_mutations
+    if user_store is None:
+        return 0
+    async with _flush_lock:
+        if not (_dirty_users or _dirty_settings or _dirty_referrals):
+            return 0
+        # Снимок делаем в event loop, запись - в отдельном потоке
+        users = {uid: copy.deepcopy(users_data[uid]) for uid in _dirty_users if uid in users_data}
+        settings = {uid: user_settings[uid] for uid in _dirty_settings if uid in user_settings}
+        refs = {code: referrals[code] for code in _dirty_referrals if code in referrals}
+        _dirty_users.clear()
+        _dirty_settings.clear()
+        _dirty_referrals.clear()
+        _pending_mutations = 0
+        # Запись в потоке не отменяется: при отмене ждём её под _flush_lock,
+        # чтобы финальный сброс и close() не разошлись с пишущим потоком
+        job = asyncio.ensure_future(asyncio.to_thread(user_store.save_batch, users, settings, refs))
+        try:
+            await _await_through_cancel(job)
+        except BaseException as e:
+            error = e if job.cancelled() else job.exception()
+            if error is not None:
+                logger.error(f"Ошибка сохранения данных пользователей: {error}")
+                _dirty_users.update(users)
+                _dirty_settings.update(settings)
+                _dirty_referrals.update(refs)
+            if not isinstance(e, Exception):
+                raise
+            return 0
+        total = len(users) + len(settings) + len(refs)
+        logger.debug(f"Данные пользователей сохранены: {total} записей")
+        return total
+
+async def persistence_flush_loop():
+    """Фоновый цикл отложенной записи данных пользователей."""
+    while not SHUTDOWN_FLAG:
+        try:
+            await asyncio.wait_for(_flush_event.wait(), timeout=PERSIST_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            logger.info("Persistence flush loop cancelled")
+            break
+        _flush_event.clear()
+        try:
+            await flush_user_data()
+            await FILE_ID_CACHE.flush()
+            await METHOD_SCOREBOARD.flush()
+            await DOWNLOAD_STATE.flush()
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            logger.error(f"Ошибка в цикле сохранения данных: {e}")
 
 def generate_referral_code(user_id: int) -> str:
     """Генерирует уникальный реферальный код для пользователя"""
@@ -176,8 +581,8 @@ def get_or_create_user(user_id: int) -> dict:
             'referrals_completed': []
         }
         referrals[referral_code] = user_id
-        save_users_data()
-        save_referrals()
+        save_user(user_id)
+        save_referral(referral_code)
     return users_data[user_id]
 
 def is_premium(user_id: int) -> bool:
@@ -188,7 +593,7 @@ def is_premium(user_id: int) -> bool:
             return True
         else:
             user['premium'] = False
-            save_users_data()
+            save_user(user_id)
     return False
 
 def check_daily_limit(user_id: int) -> bool:
@@ -219,18 +624,20 @@ def increment_downloads(user_id: int):
     else:
         user['downloads_today'] += 1
     
-    save_users_data()
+    save_user(user_id)
 
 def activate_premium(user_id: int, days: int = 365):
     """Активирует премиум для пользователя"""
     user = get_or_create_user(user_id)
     user['premium'] = True
     user['premium_until'] = (datetime.now() + timedelta(days=days)).isoformat()
-    save_users_data()
+    save_user(user_id)
 
 def get_quality_setting(user_id: int) -> str:
     """Получает настройку качества пользователя"""
-    return user_settings.get(user_id, "720p")
+    quality = user_settings.get(user_id, "720p")
+    # Бывший режим 'fit': подбор под лимит Telegram теперь идёт внутри любого потолка высоты
+    return "720p" if quality == "fit" else quality
 
 # ==================== COOKIES ====================
 
@@ -353,7 +760,10 @@ def get_ydl_opts(quality: str = "720p", use_youtube_cookies: bool = True) -> Dic
         'retries': 3,
         'fragment_retries': 3,
         'extractor_retries': 3,
-        'concurrent_fragment_downloads': 1,
+        # concurrent_fragment_downloads выставляет run_ydl_download
+        # .part файлы в PARTIALS_DIR: повторная попытка продолжает их
+        'paths': {'temp': PARTIALS_DIR},
+        'continuedl': True,
     }
 
     ytdlp_proxy = (os.getenv("YTDLP_PROXY") or "").strip()
@@ -397,164 +807,677 @@ def get_ydl_opts(quality: str = "720p", use_youtube_cookies: bool = True) -> Dic
     
     return ydl_opts
 
-# ==================== PLAYWRIGHT ====================
+def _estimate_format_size(fmt: Dict[str, Any], duration: Optional[float]) -> Optional[float]:
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if not size and fmt.get('tbr') and duration:
+        size = fmt['tbr'] * 1000 / 8 * duration  # tbr в кбит/с
+    return size
+
+def select_fit_format(info: Dict[str, Any], max_height: Optional[int] = None,
+                      limit: int = TELEGRAM_FILE_LIMIT) -> Optional[Tuple[str, float]]:
+    """Лучший формат (или пара видео+аудио) не выше max_height, который по оценке влезает в limit.
+    Возвращает (строка формата yt-dlp, оценка размера) или None."""
+    duration = info.get('duration')
+    budget = limit * FIT_SIZE_MARGIN
+    candidates = []  # (высота, mp4, битрейт, формат, размер)
+    videos, audios = [], []
+    for fmt in info.get('formats') or []:
+        size = _estimate_format_size(fmt, duration)
+        if not fmt.get('format_id') or not size:
+            continue
+        has_video = fmt.get('vcodec') != 'none'
+        has_audio = fmt.get('acodec') != 'none'
+        if has_video and max_height and (fmt.get('height') or 0) > max_height:
+            continue
+        if has_video and has_audio:
+            candidates.append((fmt.get('height') or 0, fmt.get('ext') == 'mp4', fmt.get('tbr') or 0,
+                               fmt['format_id'], size))
+        elif has_video:
+            videos.append((fmt, size))
+        elif has_audio:
+            audios.append((fmt, size))
+    
+    # Аудио для склейки: предпочитаем m4a (склеивается в mp4 без перекодирования), затем битрейт
+    audios.sort(key=lambda a: (a[0].get('ext') == 'm4a', a[0].get('abr') or 0), reverse=True)
+    for video, video_size in videos:
+        for audio, audio_size in audios[:3]:
+            candidates.append((video.get('height') or 0, video.get('ext') == 'mp4',
+                               (video.get('tbr') or 0) + (audio.get('tbr') or 0),
+                               f"{video['format_id']}+{audio['format_id']}", video_size + audio_size))
+    
+    fitting = [c for c in candidates if c[4] <= budget]
+    if not fitting:
+        return None
+    best = max(fitting, key=lambda c: (c[0], c[1], c[2]))
+    return best[3], best[4]
+
+def fit_format_chooser(quality: str) -> Optional[Callable[[Dict[str, Any]], Optional[str]]]:
+    """Выбор формата под лимит Telegram внутри потолка высоты из настройки качества.
+    Вызывается на уже извлечённых метаданных (см. _ydl_download_path), так что файл не качается
+    целиком только ради ссылки на файлообменник. None - для 'best' и 'audio' подбора нет."""
+    max_height = QUALITY_MAX_HEIGHTS.get(quality.lower())
+    if not max_height:
+        return None
+
+    def choose(info: Dict[str, Any]) -> Optional[str]:
+        choice = select_fit_format(info, max_height)
+        if not choice:
+            logger.info(f"Ни один формат до {max_height}p не влезает в лимит по оценке, качаем обычный")
+            return None
+        format_str, size = choice
+        logger.info(f"Формат под лимит Telegram: {format_str} (~{size / 1024 / 1024:.1f} MB, до {max_height}p)")
+        return format_str
+    return choose
+
+# ==================== ПУЛ СТРАНИЦ PLAYWRIGHT ====================
+# Загрузчики не открывают страницу на каждый запрос, а берут заранее
+# созданную из пула контекста. На страницах пула отключены картинки, шрифты,
+# стили и аналитика: видео, документы и XHR/fetch к API проходят как есть.
+# Перед выдачей страница проверяется, упавшие и закрытые заменяются новыми.
+
+BLOCKED_RESOURCE_TYPES = frozenset({'image', 'font', 'stylesheet'})
+BLOCKED_URL_MARKERS = (
+    'google-analytics.com', 'googletagmanager.com', 'doubleclick.net',
+    'googlesyndication.com', 'googleadservices.com', 'connect.facebook.net',
+    'facebook.com/tr', 'play.google.com/log', 'youtube.com/api/stats',
+    'youtube.com/ptracking', 'youtube.com/pagead', '/youtubei/v1/log_event',
+    'instagram.com/logging', 'instagram.com/ajax/bz',
+)
 
-async def init_instagram_playwright():
-    global IG_BROWSER, IG_CONTEXT, IG_PLAYWRIGHT_READY
-    logger.info("Инициализация Instagram Playwright...")
+async def _block_heavy_resources(route):
+    """Обработчик page.route: отбрасывает тяжёлые ресурсы и трекеры."""
+    request = route.request
     try:
-        pw = await async_playwright().start()
-        IG_BROWSER = await pw.chromium.launch(headless=True)
-        IG_CONTEXT = await IG_BROWSER.new_context(
-            user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        )
+        if request.resource_type in BLOCKED_RESOURCE_TYPES or any(m in request.url for m in BLOCKED_URL_MARKERS):
+            await route.abort()
+        else:
+            await route.continue_()
+    except Exception:
+        # Страница закрылась посреди запроса
+        pass
 
-        cookies_to_load: List[Dict[str, Any]] = []
-        cookies_json = os.getenv("COOKIES_INSTAGRAM") or os.getenv("COOKIES_TXT")
-        if cookies_json:
-            try:
-                cookies_data = json.loads(cookies_json)
-                for cookie in cookies_data:
-                    pw_cookie = {
-                        'name': cookie.get('name', ''),
-                        'value': cookie.get('value', ''),
-                        'domain': cookie.get('domain', ''),
-                        'path': cookie.get('path', '/'),
-                        'expires': int(cookie.get('expires', 0)) if cookie.get('expires') else None,
-                        'secure': bool(cookie.get('secure', False)),
-                        'httpOnly': bool(cookie.get('httpOnly', False)),
-                        'sameSite': 'Lax'
-                    }
-                    pw_cookie = {k: v for k, v in pw_cookie.items() if v is not None}
-                    cookies_to_load.append(pw_cookie)
+class PagePool:
+    """Пул прогретых страниц одного BrowserContext.
+
+    Использование:
+        async with YT_PAGE_POOL.page() as page:
+            await page.goto(url, wait_until='domcontentloaded')
+    """
 
+    def __init__(self, name: str, size: int = PLAYWRIGHT_PAGE_POOL_SIZE, viewport: Optional[Dict[str, int]] = None):
+        self.name = name
+        self.size = max(1, size)
+        self.viewport = viewport
+        self._context: Optional[BrowserContext] = None
+        self._idle: List[Any] = []
+        self._semaphore = asyncio.Semaphore(self.size)
+        self._crashed: set = set()
+        self.in_use = 0
+        self.acquired = 0
+        self.created = 0
+        self.recycled = 0
+        self.wait_seconds = 0.0
+
+    async def start(self, context: BrowserContext):
+        """Привязывает пул к контексту и заранее открывает size страниц."""
+        await self.close()
+        self._context = context
+        for _ in range(self.size):
+            try:
+                self._idle.append(await self._new_page())
             except Exception as e:
-                logger.error(f"Ошибка загрузки Instagram cookies: {e}")
-
-        if not cookies_to_load:
-            for path in [
-                "cookies_instagram_bot1.txt",
-                "cookies_instagram_bot2.txt",
-                "cookies_instagram_bot3.txt",
-                "cookies_instagram.txt",
-                "cookies.txt",
-            ]:
-                if os.path.exists(path) and os.path.getsize(path) > 0:
-                    # Пробуем как Netscape
-                    cookies_to_load = _read_netscape_cookiefile(path)
-                    if not cookies_to_load:
-                        # Пробуем как JSON (если не распарсилось выше, но записалось как текст)
-                        try:
-                            with open(path, 'r', encoding='utf-8') as f:
-                                content = f.read()
-                            try:
-                                c_data = json.loads(content)
-                            except json.JSONDecodeError:
-                                try:
-                                    c_data = ast.literal_eval(content)
-                                except Exception:
-                                    c_data = None
-                            
-                            if isinstance(c_data, list):
-                                for cookie in c_data:
-                                    pw_cookie = {
-                                        'name': cookie.get('name', ''),
-                                        'value': cookie.get('value', ''),
-                                        'domain': cookie.get('domain', ''),
-                                        'path': cookie.get('path', '/'),
-                                        'expires': int(cookie.get('expires', 0)) if cookie.get('expires') else None,
-                                        'secure': bool(cookie.get('secure', False)),
-                                        'httpOnly': bool(cookie.get('httpOnly', False)),
-                                        'sameSite': 'Lax'
-                                    }
-                                    pw_cookie = {k: v for k, v in pw_cookie.items() if v is not None}
-                                    cookies_to_load.append(pw_cookie)
-                        except Exception:
-                            pass
-
-                    if cookies_to_load:
-                        break
+                logger.warning(f"Пул страниц {self.name}: не удалось открыть страницу: {e}")
+                break
+        logger.info(f"Пул страниц {self.name}: прогрето {len(self._idle)} из {self.size}")
+
+    async def _new_page(self):
+        page = await self._context.new_page()
+        page.on('crash', lambda p: self._crashed.add(id(p)))
+        await page.route('**/*', _block_heavy_resources)
+        if self.viewport:
+            await page.set_viewport_size(self.viewport)
+        self.created += 1
+        return page
+
+    async def _healthy(self, page) -> bool:
+        if page.is_closed() or id(page) in self._crashed:
+            return False
+        try:
+            return await asyncio.wait_for(page.evaluate('1'), timeout=PLAYWRIGHT_PAGE_HEALTH_TIMEOUT) == 1
+        except Exception:
+            return False
+
+    async def _discard(self, page):
+        self._crashed.discard(id(page))
+        self.recycled += 1
+        try:
+            await page.close()
+        except Exception:
+            pass
+
+    async def _acquire(self):
+        while self._idle:
+            page = self._idle.pop()
+            if await self._healthy(page):
+                return page
+            logger.info(f"Пул страниц {self.name}: страница неисправна, заменяем")
+            await self._discard(page)
+        return await self._new_page()
+
+    async def _release(self, page):
+        if self._context is None or not await self._healthy(page):
+            await self._discard(page)
+            return
+        try:
+            # Останавливаем скрипты и медиа прошлой страницы, освобождая память
+            await page.goto('about:blank', timeout=PLAYWRIGHT_PAGE_HEALTH_TIMEOUT * 1000)
+        except Exception:
+            await self._discard(page)
+            return
+        self._idle.append(page)
+
+    @contextlib.asynccontextmanager
+    async def page(self):
+        """Выдаёт страницу пула на время блока. Обработчики page.on() снимает вызывающий код."""
+        if self._context is None:
+            raise RuntimeError(f"Пул страниц {self.name} не запущен")
+        started = time.monotonic()
+        async with self._semaphore:
+            self.wait_seconds += time.monotonic() - started
+            page = await self._acquire()
+            self.in_use += 1
+            self.acquired += 1
+            try:
+                yield page
+            finally:
+                self.in_use -= 1
+                await self._release(page)
 
-        if cookies_to_load:
+    async def close(self):
+        self._context = None
+        pages, self._idle = self._idle, []
+        for page in pages:
             try:
-                await IG_CONTEXT.add_cookies(cookies_to_load)
-                logger.info(f"Загружено {len(cookies_to_load)} Instagram cookies")
+                await page.close()
+            except Exception:
+                pass
+        self._crashed.clear()
+
+    def metrics_text(self) -> str:
+        labels = f'{{pool="{self.name}"}}'
+        return (f"playwright_pool_idle{labels} {len(self._idle)}\n"
+                f"playwright_pool_in_use{labels} {self.in_use}\n"
+                f"playwright_pool_acquired_total{labels} {self.acquired}\n"
+                f"playwright_pool_pages_created_total{labels} {self.created}\n"
+                f"playwright_pool_recycled_total{labels} {self.recycled}\n"
+                f"playwright_pool_wait_seconds_total{labels} {self.wait_seconds:.3f}\n")
+
+IG_PAGE_POOL = PagePool('instagram', viewport={'width': 375, 'height': 812})
+YT_PAGE_POOL = PagePool('youtube')
+
+# ==================== PLAYWRIGHT ====================
+# Playwright нужен только как запасной путь, поэтому драйвер и браузеры не
+# стартуют вместе с ботом. BROWSERS поднимает один общий драйвер и браузер
+# профиля при первом обращении, закрывает простаивающие браузеры (и драйвер,
+# когда браузеров не осталось) и перезапускает браузер, чей RSS перерос
+# BROWSER_MAX_RSS_MB. Cookies закрытого браузера переносятся в следующий запуск.
+
+class BrowserUnavailableError(Exception):
+    """Браузер профиля не запускается: недавний запуск завершился ошибкой."""
+
+class BrowserProfile:
+    """Настройки браузера одной платформы и его текущее состояние."""
+
+    def __init__(self, name: str, launch_args: Optional[List[str]] = None,
+                 context_options: Optional[Dict[str, Any]] = None,
+                 setup: Optional[Callable[[BrowserContext], Awaitable[None]]] = None,
+                 page_pool: Optional[PagePool] = None,
+                 initial_cookies: Optional[Callable[[], List[Dict[str, Any]]]] = None):
+        self.name = name
+        self.launch_args = list(launch_args or [])
+        self.context_options = dict(context_options or {})
+        self.setup = setup
+        self.page_pool = page_pool
+        self.initial_cookies = initial_cookies  # cookies из настроек, пока браузер ни разу не запускался
+        self.browser: Optional[Browser] = None
+        self.context: Optional[BrowserContext] = None
+        self.cookies: Optional[List[Dict[str, Any]]] = None  # снимок cookies закрытого браузера
+        self.rss_mb: Optional[float] = None  # последний замер maintain()
+        self.lock = asyncio.Lock()
+        self.active = 0
+        self.last_used = 0.0
+        self.restart_pending = False
+        self.failed_until = 0.0
+        self.launches = 0
+        self.idle_closes = 0
+        self.memory_restarts = 0
+
+    @property
+    def marker(self) -> str:
+        # Chromium игнорирует неизвестные ключи: по этому находим процессы браузера в /proc
+        return f"--bot-browser-profile={self.name}-{os.getpid()}"
+
+class BrowserManager:
+    """Общий драйвер Playwright и лениво запускаемые браузеры по профилям."""
+
+    def __init__(self, idle_timeout: float = BROWSER_IDLE_TIMEOUT, max_rss_mb: float = BROWSER_MAX_RSS_MB):
+        self.idle_timeout = idle_timeout
+        self.max_rss_mb = max_rss_mb
+        self._profiles: Dict[str, BrowserProfile] = {}
+        self._playwright = None
+        self._driver_lock = asyncio.Lock()
+
+    def register(self, profile: BrowserProfile):
+        self._profiles[profile.name] = profile
+
+    def available(self, name: str) -> bool:
+        """False, если профиля нет или его браузер недавно не смог запуститься."""
+        profile = self._profiles.get(name)
+        return profile is not None and time.monotonic() >= profile.failed_until
+
+    def running(self, name: str) -> bool:
+        profile = self._profiles.get(name)
+        return bool(profile and profile.context)
+
+    async def _driver(self):
+        async with self._driver_lock:
+            if self._playwright is None:
+                self._playwright = await async_playwright().start()
+                logger.info("Драйвер Playwright запущен")
+            return self._playwright
+
+    async def _stop_driver_if_unused(self):
+        async with self._driver_lock:
+            if self._playwright is None or any(p.browser for p in self._profiles.values()):
+                return
+            try:
+                await self._playwright.stop()
             except Exception as e:
-                logger.error(f"Ошибка загрузки Instagram cookies: {e}")
+                logger.debug(f"Ошибка остановки драйвера Playwright: {e}")
+            self._playwright = None
+            logger.info("Драйвер Playwright остановлен: браузеров не осталось")
+
+    async def _ensure(self, profile: BrowserProfile) -> BrowserContext:
+        async with profile.lock:
+            if profile.context and profile.browser and profile.browser.is_connected():
+                return profile.context
+            if profile.browser:
+                await self._shutdown(profile, "браузер отключился")
+            if time.monotonic() < profile.failed_until:
+                raise BrowserUnavailableError(f"Браузер {profile.name} недоступен")
+            try:
+                pw = await self._driver()
+                profile.browser = await pw.chromium.launch(
+                    headless=True, args=profile.launch_args + [profile.marker]
+                )
+                profile.context = await profile.browser.new_context(**profile.context_options)
+                if profile.cookies:
+                    await profile.context.add_cookies(profile.cookies)
+                elif profile.setup:
+                    await profile.setup(profile.context)
+                if profile.page_pool:
+                    await profile.page_pool.start(profile.context)
+            except Exception as e:
+                profile.failed_until = time.monotonic() + BROWSER_LAUNCH_RETRY
+                await self._shutdown(profile, "ошибка запуска")
+                await self._stop_driver_if_unused()
+                raise BrowserUnavailableError(f"Не удалось запустить браузер {profile.name}: {e}") from e
+            profile.launches += 1
+            logger.info(f"Браузер {profile.name} запущен")
+            return profile.context
+
+    async def _shutdown(self, profile: BrowserProfile, reason: str):
+        """Закрывает браузер профиля, сохранив cookies. Вызывается под profile.lock."""
+        if profile.page_pool:
+            await profile.page_pool.close()
+        if profile.context:
+            try:
+                profile.cookies = await profile.context.cookies()
+            except Exception:
+                pass
+        if profile.browser:
+            try:
+                await profile.browser.close()
+            except Exception as e:
+                logger.debug(f"Ошибка закрытия браузера {profile.name}: {e}")
+            logger.info(f"Браузер {profile.name} закрыт: {reason}")
+        profile.browser = None
+        profile.context = None
+        profile.rss_mb = None
+        profile.restart_pending = False
+
+    @contextlib.asynccontextmanager
+    async def session(self, name: str):
+        """Контекст профиля на время блока: пока блок активен, браузер не закроется."""
+        profile = self._profiles[name]
+        profile.active += 1
+        try:
+            yield await self._ensure(profile)
+        finally:
+            profile.active -= 1
+            profile.last_used = time.monotonic()
+            if profile.restart_pending and profile.active == 0:
+                async with profile.lock:
+                    if profile.restart_pending and profile.active == 0:
+                        await self._shutdown(profile, "перезапуск по памяти")
+
+    @contextlib.asynccontextmanager
+    async def fresh_context(self, name: str):
+        """Новый пустой контекст в браузере профиля: без общих cookies и с теми же настройками."""
+        async with self.session(name):
+            profile = self._profiles[name]
+            context = await profile.browser.new_context(**profile.context_options)
+            try:
+                yield context
+            finally:
+                try:
+                    await context.close()
+                except Exception:
+                    pass
 
-        IG_PLAYWRIGHT_READY = True
-        logger.info("Instagram Playwright инициализирован")
-    except Exception as e:
-        logger.error(f"Ошибка инициализации Instagram Playwright: {e}")
-        IG_PLAYWRIGHT_READY = False
+    @contextlib.asynccontextmanager
+    async def page(self, name: str):
+        """Страница из пула профиля (браузер запускается при необходимости)."""
+        async with self.session(name):
+            async with self._profiles[name].page_pool.page() as page:
+                yield page
+
+    async def cookies(self, name: str) -> List[Dict[str, Any]]:
+        """Cookies профиля без запуска браузера: из живого контекста, из снимка
+        или, до первого запуска, из настроек профиля."""
+        profile = self._profiles.get(name)
+        if not profile:
+            return []
+        if profile.context:
+            try:
+                return await profile.context.cookies()
+            except Exception:
+                pass
+        if profile.cookies is None and profile.initial_cookies:
+            return await asyncio.to_thread(profile.initial_cookies)
+        return list(profile.cookies or [])
+
+    def rss_mb(self, name: str) -> Optional[float]:
+        """RSS браузера профиля по последнему замеру maintain() (None, если не запущен)."""
+        profile = self._profiles.get(name)
+        return profile.rss_mb if profile and profile.browser else None
+
+    @staticmethod
+    def _scan_rss(marker_text: str) -> Optional[float]:
+        """Суммарный RSS процессов с marker в командной строке и их потомков по /proc.
+        Обходит все процессы, поэтому вызывается в потоке (None вне Linux)."""
+        if not os.path.isdir('/proc'):
+            return None
+        marker = marker_text.encode()
+        parents: Dict[int, int] = {}
+        rss: Dict[int, int] = {}
+        roots = set()
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            pid = int(entry)
+            try:
+                with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                    if marker in f.read():
+                        roots.add(pid)
+                with open(f'/proc/{pid}/status') as f:
+                    for line in f:
+                        if line.startswith('PPid:'):
+                            parents[pid] = int(line.split()[1])
+                        elif line.startswith('VmRSS:'):
+                            rss[pid] = int(line.split()[1])
+            except (OSError, ValueError):
+                continue
+        if not roots:
+            return None
+        total = 0
+        for pid, kb in rss.items():
+            node = pid
+            while node and node not in roots:
+                node = parents.get(node)
+            if node:
+                total += kb
+        return total / 1024
+
+    async def maintain(self):
+        """Закрывает простаивающие браузеры и перезапускает разросшиеся."""
+        now = time.monotonic()
+        for profile in self._profiles.values():
+            if not profile.browser:
+                continue
+            rss = profile.rss_mb = await asyncio.to_thread(self._scan_rss, profile.marker)
+            if rss is not None and rss > self.max_rss_mb and not profile.restart_pending:
+                logger.warning(f"Браузер {profile.name}: RSS {rss:.0f} MB > {self.max_rss_mb:.0f} MB, перезапуск")
+                profile.memory_restarts += 1
+                profile.restart_pending = True
+            idle = profile.active == 0 and now - profile.last_used >= self.idle_timeout
+            if profile.active == 0 and (idle or profile.restart_pending):
+                async with profile.lock:
+                    if profile.active == 0 and profile.browser:
+                        if not profile.restart_pending:
+                            profile.idle_closes += 1
+                        await self._shutdown(profile, "простой" if idle else "перезапуск по памяти")
+        await self._stop_driver_if_unused()
+
+    async def close(self):
+        for profile in self._profiles.values():
+            async with profile.lock:
+                await self._shutdown(profile, "остановка бота")
+        await self._stop_driver_if_unused()
+
+    def metrics_text(self) -> str:
+        lines = []
+        for profile in self._profiles.values():
+            labels = f'{{profile="{profile.name}"}}'
+            rss = self.rss_mb(profile.name)
+            lines.append(f"browser_running{labels} {1 if profile.browser else 0}")
+            lines.append(f"browser_active_sessions{labels} {profile.active}")
+            lines.append(f"browser_rss_mb{labels} {rss or 0:.1f}")
+            lines.append(f"browser_launches_total{labels} {profile.launches}")
+            lines.append(f"browser_idle_closes_total{labels} {profile.idle_closes}")
+            lines.append(f"browser_memory_restarts_total{labels} {profile.memory_restarts}")
+        text = "\n".join(lines) + "\n" if lines else ""
+        for profile in self._profiles.values():
+            if profile.page_pool:
+                text += profile.page_pool.metrics_text()
+        return text
+
+BROWSERS = BrowserManager()
+BROWSER_MAINTENANCE_TASK: Optional[asyncio.Task] = None
+
+async def browser_maintenance_loop():
+    """Периодически закрывает простаивающие и разросшиеся браузеры."""
+    while not SHUTDOWN_FLAG:
+        try:
+            await asyncio.sleep(BROWSER_CHECK_INTERVAL)
+            await BROWSERS.maintain()
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            logger.error(f"Ошибка обслуживания браузеров: {e}")
+
+async def wait_first(*aws: Awaitable, timeout: float = PLAYWRIGHT_READY_TIMEOUT) -> bool:
+    """Ждёт первое успешно выполнившееся условие, но не дольше timeout.
 
-async def init_youtube_playwright():
-    global YT_BROWSER, YT_CONTEXT, YT_PLAYWRIGHT_READY
-    logger.info("Инициализация YouTube Playwright...")
+    Условия, завершившиеся ошибкой (например, таймаут самого Playwright), не
+    считаются. Остальные отменяются. Возвращает True, если условие выполнилось.
+    """
+    pending = {asyncio.ensure_future(aw) for aw in aws}
+    deadline = time.monotonic() + timeout
     try:
-        pw = await async_playwright().start()
-        YT_BROWSER = await pw.chromium.launch(
-            headless=True,
-            args=[
-                '--disable-blink-features=AutomationControlled',
-                '--disable-dev-shm-usage',
-                '--no-sandbox',
-            ]
-        )
-        YT_CONTEXT = await YT_BROWSER.new_context(
-            user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            viewport={'width': 1920, 'height': 1080},
-            locale='en-US',
-            timezone_id='America/New_York',
-            extra_http_headers={
-                'Accept-Language': 'en-US,en;q=0.9',
-            }
-        )
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            if any(not task.cancelled() and task.exception() is None for task in done):
+                return True
+        return False
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
 
-        cookie_file_path = Path("cookies_youtube.txt")
-        if cookie_file_path.exists():
-            logger.info(f"Загружаем YouTube cookies из {cookie_file_path.name}")
-            try:
-                with open(cookie_file_path, 'r', encoding='utf-8') as f:
-                    lines = f.readlines()
-                cookies_to_load = []
-                for line in lines:
-                    if line.startswith('#') or not line.strip():
-                        continue
+def load_instagram_cookies() -> List[Dict[str, Any]]:
+    """Instagram cookies из окружения или файлов в формате Playwright."""
+    cookies_to_load: List[Dict[str, Any]] = []
+    cookies_json = os.getenv("COOKIES_INSTAGRAM") or os.getenv("COOKIES_TXT")
+    if cookies_json:
+        try:
+            cookies_data = json.loads(cookies_json)
+            for cookie in cookies_data:
+                pw_cookie = {
+                    'name': cookie.get('name', ''),
+                    'value': cookie.get('value', ''),
+                    'domain': cookie.get('domain', ''),
+                    'path': cookie.get('path', '/'),
+                    'expires': int(cookie.get('expires', 0)) if cookie.get('expires') else None,
+                    'secure': bool(cookie.get('secure', False)),
+                    'httpOnly': bool(cookie.get('httpOnly', False)),
+                    'sameSite': 'Lax'
+                }
+                pw_cookie = {k: v for k, v in pw_cookie.items() if v is not None}
+                cookies_to_load.append(pw_cookie)
+
+        except Exception as e:
+            logger.error(f"Ошибка загрузки Instagram cookies: {e}")
+
+    if not cookies_to_load:
+        for path in [
+            "cookies_instagram_bot1.txt",
+            "cookies_instagram_bot2.txt",
+            "cookies_instagram_bot3.txt",
+            "cookies_instagram.txt",
+            "cookies.txt",
+        ]:
+            if os.path.exists(path) and os.path.getsize(path) > 0:
+                # Пробуем как Netscape
+                cookies_to_load = _read_netscape_cookiefile(path)
+                if not cookies_to_load:
+                    # Пробуем как JSON (если не распарсилось выше, но записалось как текст)
                     try:
-                        parts = line.strip().split('\t')
-                        if len(parts) >= 7:
-                            domain, flag, path, secure, expiration, name, value = parts[:7]
-                            pw_cookie = {
-                                'name': name,
-                                'value': value,
-                                'domain': domain.lstrip('.'),
-                                'path': path,
-                                'expires': int(expiration) if expiration.isdigit() else None,
-                                'secure': secure.lower() == 'true',
-                                'httpOnly': False,
-                                'sameSite': 'Lax'
-                            }
-                            pw_cookie = {k: v for k, v in pw_cookie.items() if v is not None}
-                            cookies_to_load.append(pw_cookie)
-                    except ValueError:
-                        continue
+                        with open(path, 'r', encoding='utf-8') as f:
+                            content = f.read()
+                        try:
+                            c_data = json.loads(content)
+                        except json.JSONDecodeError:
+                            try:
+                                c_data = ast.literal_eval(content)
+                            except Exception:
+                                c_data = None
+
+                        if isinstance(c_data, list):
+                            for cookie in c_data:
+                                pw_cookie = {
+                                    'name': cookie.get('name', ''),
+                                    'value': cookie.get('value', ''),
+                                    'domain': cookie.get('domain', ''),
+                                    'path': cookie.get('path', '/'),
+                                    'expires': int(cookie.get('expires', 0)) if cookie.get('expires') else None,
+                                    'secure': bool(cookie.get('secure', False)),
+                                    'httpOnly': bool(cookie.get('httpOnly', False)),
+                                    'sameSite': 'Lax'
+                                }
+                                pw_cookie = {k: v for k, v in pw_cookie.items() if v is not None}
+                                cookies_to_load.append(pw_cookie)
+                    except Exception:
+                        pass
 
                 if cookies_to_load:
-                    await YT_CONTEXT.add_cookies(cookies_to_load)
-                    logger.info(f"Загружено {len(cookies_to_load)} YouTube cookies")
-            except Exception as e:
-                logger.error(f"Ошибка загрузки cookies: {e}")
+                    break
+    return cookies_to_load
 
-        YT_PLAYWRIGHT_READY = True
-        logger.info("YouTube Playwright инициализирован")
-    except Exception as e:
-        logger.error(f"Ошибка инициализации YouTube Playwright: {e}")
-        YT_PLAYWRIGHT_READY = False
+async def setup_instagram_context(context: BrowserContext):
+    """Загружает Instagram cookies из окружения или файлов в свежий контекст."""
+    cookies_to_load = await asyncio.to_thread(load_instagram_cookies)
+    if cookies_to_load:
+        try:
+            await context.add_cookies(cookies_to_load)
+            logger.info(f"Загружено {len(cookies_to_load)} Instagram cookies")
+        except Exception as e:
+            logger.error(f"Ошибка загрузки Instagram cookies: {e}")
+
+async def setup_youtube_context(context: BrowserContext):
+    """Загружает YouTube cookies из cookies_youtube.txt в свежий контекст."""
+    cookie_file_path = Path("cookies_youtube.txt")
+    if cookie_file_path.exists():
+        logger.info(f"Загружаем YouTube cookies из {cookie_file_path.name}")
+        try:
+            with open(cookie_file_path, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+            cookies_to_load = []
+            for line in lines:
+                if line.startswith('#') or not line.strip():
+                    continue
+                try:
+                    parts = line.strip().split('\t')
+                    if len(parts) >= 7:
+                        domain, flag, path, secure, expiration, name, value = parts[:7]
+                        pw_cookie = {
+                            'name': name,
+                            'value': value,
+                            'domain': domain.lstrip('.'),
+                            'path': path,
+                            'expires': int(expiration) if expiration.isdigit() else None,
+                            'secure': secure.lower() == 'true',
+                            'httpOnly': False,
+                            'sameSite': 'Lax'
+                        }
+                        pw_cookie = {k: v for k, v in pw_cookie.items() if v is not None}
+                        cookies_to_load.append(pw_cookie)
+                except ValueError:
+                    continue
+
+            if cookies_to_load:
+                await context.add_cookies(cookies_to_load)
+                logger.info(f"Загружено {len(cookies_to_load)} YouTube cookies")
+        except Exception as e:
+            logger.error(f"Ошибка загрузки cookies: {e}")
+
+BROWSERS.register(BrowserProfile(
+    'instagram',
+    context_options={'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'},
+    setup=setup_instagram_context,
+    page_pool=IG_PAGE_POOL,
+    initial_cookies=load_instagram_cookies,
+))
+BROWSERS.register(BrowserProfile(
+    'youtube',
+    launch_args=[
+        '--disable-blink-features=AutomationControlled',
+        '--disable-dev-shm-usage',
+        '--no-sandbox',
+    ],
+    context_options={
+        'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+        'viewport': {'width': 1920, 'height': 1080},
+        'locale': 'en-US',
+        'timezone_id': 'America/New_York',
+        'extra_http_headers': {
+            'Accept-Language': 'en-US,en;q=0.9',
+        },
+    },
+    setup=setup_youtube_context,
+    page_pool=YT_PAGE_POOL,
+))
 
 # ==================== СКАЧИВАНИЕ ====================
 
+# Файлы, которые одновременно отдаются нескольким пользователям: {path: число владельцев}
+_file_refs: Dict[str, int] = {}
+
+def retain_file(file_path: Optional[str], count: int = 1):
+    """Добавляет владельцев файлу: cleanup_file удалит его только после последнего."""
+    if file_path and count > 0:
+        _file_refs[file_path] = _file_refs.get(file_path, 1) + count
+
 def cleanup_file(file_path: str):
+    if file_path in _file_refs:
+        _file_refs[file_path] -= 1
+        if _file_refs[file_path] > 0:
+            logger.debug(f"Файл {Path(file_path).name} ещё нужен ({_file_refs[file_path]} владельцев)")
+            return
+        del _file_refs[file_path]
     try:
         if file_path and os.path.exists(file_path):
             os.remove(file_path)
@@ -631,6 +1554,10 @@ def _ydl_extract_info(url: str, ydl_opts: Dict[str, Any]) -> Dict[str, Any]:
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
         return ydl.extract_info(url, download=True)
 
+def _ydl_probe_info(url: str, ydl_opts: Dict[str, Any]) -> Dict[str, Any]:
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        return ydl.extract_info(url, download=False)
+
 def _ydl_download_info_and_path(url: str, ydl_opts: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[str]]:
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
         info = ydl.extract_info(url, download=True)
@@ -643,27 +1570,1161 @@ def _ydl_download_info_and_path(url: str, ydl_opts: Dict[str, Any]) -> Tuple[Dic
             return info, temp_file
         return info, None
 
-def _ydl_download_path(url: str, ydl_opts: Dict[str, Any]) -> Optional[str]:
+def _ydl_download_path(url: str, ydl_opts: Dict[str, Any],
+                       choose_format: Optional[Callable[[Dict[str, Any]], Optional[str]]] = None) -> Optional[str]:
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=True)
+        if choose_format is None:
+            info = ydl.extract_info(url, download=True)
+        else:
+            # Метаданные извлекаются один раз: по ним выбирается формат, и тот же результат качается
+            info = ydl.extract_info(url, download=False, process=False)
+            format_str = None
+            try:
+                format_str = choose_format(info)
+            except Exception as e:
+                logger.debug(f"Выбор формата под лимит не удался: {e}")
+            if format_str:
+                ydl.format_selector = ydl.build_format_selector(format_str)
+            info = ydl.process_ie_result(info, download=True)
         temp_file = ydl.prepare_filename(info)
         if temp_file and os.path.exists(temp_file):
             return temp_file
     return None
 
+# ==================== ФРАГМЕНТЫ YT-DLP ====================
+# DASH и HLS качаются фрагментами. Число параллельных фрагментов подбирается
+# на каждую платформу: растёт, пока растёт скорость, и вдвое падает на 403/429.
+# Общий бюджет соединений и полосы делится между всеми загрузками сразу.
+
+class FragmentConcurrencyController:
+    """Подбор concurrent_fragment_downloads для одной платформы (рост по скорости, спад вдвое на троттлинге)."""
+
+    def __init__(self, platform: str, initial: int = YTDLP_FRAGMENTS_INITIAL,
+                 maximum: int = YTDLP_FRAGMENTS_MAX, alpha: float = 0.3):
+        self.platform = platform
+        self.maximum = max(1, maximum)
+        self.level = max(1, min(initial, self.maximum))
+        self.alpha = alpha
+        self.throughput: Dict[int, float] = {}  # EWMA байт/с на уровне параллельности
+        self.throttled = 0
+
+    def record(self, level: int, size: int, seconds: float, throttled: bool = False):
+        if throttled:
+            self.throttled += 1
+            new_level = max(1, level // 2)
+            if new_level < self.level:
+                logger.info(f"Фрагменты {self.platform}: троттлинг, {self.level} -> {new_level}")
+            self.level = min(self.level, new_level)
+            return
+        if size <= 0 or seconds <= 0:
+            return
+        rate = size / seconds
+        previous = self.throughput.get(level)
+        self.throughput[level] = rate if previous is None else self.alpha * rate + (1 - self.alpha) * previous
+        if level != self.level:
+            return
+        current = self.throughput[level]
+        lower = self.throughput.get(level - 1)
+        upper = self.throughput.get(level + 1)
+        if lower is not None and current < lower * 0.9:
+            # Больше фрагментов стало медленнее - откатываемся
+            self.level = level - 1
+        elif (level < self.maximum and (lower is None or current > lower * 1.1)
+              and (upper is None or upper > current * 1.1)):
+            self.level = level + 1
+        if self.level != level:
+            logger.debug(f"Фрагменты {self.platform}: {level} -> {self.level} ({rate / 1e6:.1f} MB/s)")
+
+class ConnectionBudget:
+    """Общий на процесс пул фрагментных соединений и полосы для yt-dlp."""
+
+    def __init__(self, connections: int = YTDLP_CONNECTION_BUDGET, bandwidth: int = YTDLP_BANDWIDTH_LIMIT):
+        self.connections = max(1, connections)
+        self.bandwidth = bandwidth
+        self.in_use = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self, want: int) -> int:
+        """Выдаёт от 1 до want соединений, ожидая, если свободных нет."""
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_use < self.connections)
+            granted = max(1, min(want, self.connections - self.in_use))
+            self.in_use += granted
+            return granted
+
+    async def release(self, granted: int):
+        async with self._cond:
+            self.in_use -= granted
+            self._cond.notify_all()
+
+    def ratelimit(self, granted: int) -> Optional['_BandwidthShare']:
+        """Доля полосы пропорционально доле выданных сейчас соединений: сумма по идущим
+        загрузкам не превышает лимит, а одна загрузка получает всю полосу."""
+        if not self.bandwidth:
+            return None
+        return _BandwidthShare(self, granted)
+
+class _BandwidthShare:
+    """Значение params['ratelimit'] для yt-dlp, пересчитываемое при каждом чтении.
+
+    yt-dlp читает ratelimit в slow_down() на каждом блоке, поэтому доля меняется сразу,
+    когда другие загрузки стартуют или завершаются. Фрагментные загрузчики получают копию
+    params, но копия ссылается на тот же объект.
+    """
+
+    def __init__(self, budget: ConnectionBudget, granted: int):
+        self.budget = budget
+        self.granted = granted
+
+    def __float__(self) -> float:
+        in_use = max(self.granted, self.budget.in_use)
+        return float(max(1, self.budget.bandwidth * self.granted // in_use))
+
+    def __int__(self) -> int:
+        return int(float(self))
+
+    def __lt__(self, other) -> bool:
+        return float(self) < other
+
+    def __gt__(self, other) -> bool:
+        return float(self) > other
+
+    def __rtruediv__(self, other) -> float:
+        return other / float(self)
+
+    def __repr__(self) -> str:
+        return f"{int(self)}"
+
+FRAGMENT_CONTROLLERS: Dict[str, FragmentConcurrencyController] = {}
+FRAGMENT_BUDGET = ConnectionBudget()
+
+_THROTTLE_STATUSES = {403, 429}
+
+def _is_throttle_error(error: Exception) -> bool:
+    """403/429 от сервера: статус из исходной HTTP ошибки yt-dlp, иначе по тексту 'HTTP Error 403'."""
+    import re
+    seen = set()
+    pending: List[Optional[BaseException]] = [error]
+    while pending:
+        err = pending.pop()
+        if err is None or id(err) in seen:
+            continue
+        seen.add(id(err))
+        status = getattr(err, 'status', None) or getattr(err, 'code', None)
+        if isinstance(status, int) and status in _THROTTLE_STATUSES:
+            return True
+        exc_info = getattr(err, 'exc_info', None)
+        if isinstance(exc_info, tuple) and len(exc_info) > 1 and isinstance(exc_info[1], BaseException):
+            pending.append(exc_info[1])
+        pending.extend((err.__cause__, err.__context__))
+    return bool(re.search(r'HTTP Error (403|429)\b', str(error)))
+
+class _DownloadMeter:
+    """Progress hook yt-dlp: байты и время только фазы скачивания, без извлечения и склейки."""
+
+    def __init__(self):
+        self.first_started: Optional[float] = None
+        self.last_finished: Optional[float] = None
+        self.size = 0
+
+    def __call__(self, status: Dict[str, Any]):
+        now = time.monotonic()
+        if status.get('status') == 'downloading' and self.first_started is None:
+            self.first_started = now
+        elif status.get('status') == 'finished':
+            self.size += int(status.get('total_bytes') or status.get('downloaded_bytes') or 0)
+            self.last_finished = now
+            if self.first_started is None and status.get('elapsed'):
+                self.first_started = now - float(status['elapsed'])
+
+    @property
+    def seconds(self) -> float:
+        if self.first_started is None or self.last_finished is None:
+            return 0.0
+        return self.last_finished - self.first_started
+
+async def run_ydl_download(platform: str, url: str, ydl_opts: Dict[str, Any],
+                           choose_format: Optional[Callable[[Dict[str, Any]], Optional[str]]] = None) -> Optional[str]:
+    """_ydl_download_path с подобранной параллельностью фрагментов и долей общего бюджета."""
+    controller = FRAGMENT_CONTROLLERS.setdefault(platform, FragmentConcurrencyController(platform))
+    granted = await FRAGMENT_BUDGET.acquire(controller.level)
+    opts = dict(ydl_opts)
+    opts['concurrent_fragment_downloads'] = granted
+    ratelimit = FRAGMENT_BUDGET.ratelimit(granted)
+    if ratelimit:
+        opts['ratelimit'] = ratelimit
+    meter = _DownloadMeter()
+    opts['progress_hooks'] = [*opts.get('progress_hooks', []), meter]
+    
+    job = asyncio.ensure_future(asyncio.to_thread(_ydl_download_path, url, opts, choose_format))
+    try:
+        temp_file = await asyncio.shield(job)
+        # Скорость только фазы скачивания: извлечение и склейка от числа фрагментов не зависят
+        controller.record(granted, meter.size, meter.seconds)
+        return temp_file
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        controller.record(granted, 0, meter.seconds, throttled=_is_throttle_error(e))
+        raise
+    finally:
+        # Поток yt-dlp не отменяется: соединения возвращаются, когда он реально закончит
+        if job.done():
+            await FRAGMENT_BUDGET.release(granted)
+        else:
+            job.add_done_callback(lambda _: asyncio.ensure_future(FRAGMENT_BUDGET.release(granted)))
+
+def fragment_metrics_text() -> str:
+    lines = [f"ytdlp_connections_in_use {FRAGMENT_BUDGET.in_use}"]
+    for platform, controller in sorted(FRAGMENT_CONTROLLERS.items()):
+        lines.append(f"ytdlp_fragment_concurrency{{platform=\"{platform}\"}} {controller.level}")
+        lines.append(f"ytdlp_throttled_total{{platform=\"{platform}\"}} {controller.throttled}")
+    return "\n".join(lines) + "\n"
+
+# ==================== ТАБЛО МЕТОДОВ ====================
+# Когда метод перестаёт работать у источника, мы платим его таймаут на каждом
+# запросе. Табло считает скользящую успешность и EWMA задержки каждого метода
+# и переставляет их: сначала методы с лучшим отношением успех/время.
+
+class MethodScoreboard:
+    """Статистика методов скачивания по группам (youtube, instagram) с epsilon-greedy исследованием."""
+
+    def __init__(self, file_path: str = METHOD_STATS_FILE, window: int = 50, alpha: float = 0.2,
+                 exploration_rate: float = METHOD_EXPLORATION_RATE, default_latency: float = 5.0):
+        self.file_path = file_path
+        self.window = window
+        self.alpha = alpha
+        self.exploration_rate = exploration_rate
+        self.default_latency = default_latency
+        self.stats: Dict[str, Dict[str, dict]] = {}
+        self.dirty = False
+
+    def _entry(self, group: str, name: str) -> dict:
+        methods = self.stats.setdefault(group, {})
+        if name not in methods:
+            methods[name] = {'results': deque(maxlen=self.window), 'latency': None, 'calls': 0,
+                             'success_latencies': deque(maxlen=self.window)}
+        return methods[name]
+
+    def record(self, group: str, name: str, success: bool, latency: float):
+        entry = self._entry(group, name)
+        entry['results'].append(bool(success))
+        entry['calls'] += 1
+        if success:
+            entry['success_latencies'].append(latency)
+        if entry['latency'] is None:
+            entry['latency'] = latency
+        else:
+            entry['latency'] = self.alpha * latency + (1 - self.alpha) * entry['latency']
+        self.dirty = True
+
+    def success_rate(self, group: str, name: str) -> float:
+        results = self._entry(group, name)['results']
+        # Сглаживание Лапласа: новый метод стартует с 0.5
+        return (sum(results) + 1) / (len(results) + 2)
+
+    def score(self, group: str, name: str) -> float:
+        """Успех в секунду: упорядочивание по p/t минимизирует ожидаемое время до успеха."""
+        latency = self._entry(group, name)['latency']
+        latency = max(0.1, latency if latency is not None else self.default_latency)
+        return self.success_rate(group, name) / latency
+
+    def latency_quantile(self, group: str, name: str, q: float, min_samples: int = 5) -> Optional[float]:
+        """Квантиль времени успешных вызовов метода или None, пока замеров мало."""
+        samples = sorted(self._entry(group, name)['success_latencies'])
+        if len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def order(self, group: str, methods: List[Tuple[str, Any]]) -> List[Tuple[str, Any]]:
+        """Сортирует методы по score. При равенстве сохраняется исходный порядок."""
+        ordered = sorted(methods, key=lambda m: -self.score(group, m[0]))
+        if len(ordered) > 1 and random.random() < self.exploration_rate:
+            # Исследование: изредка даём шанс методу не из лидеров
+            explore_index = random.randrange(1, len(ordered))
+            ordered.insert(0, ordered.pop(explore_index))
+            logger.debug(f"Исследуем метод {ordered[0][0]} ({group})")
+        return ordered
+
+    def snapshot(self) -> Dict[str, Dict[str, dict]]:
+        return {
+            group: {
+                name: {'results': list(e['results']), 'latency': e['latency'], 'calls': e['calls'],
+                       'success_latencies': list(e['success_latencies'])}
+                for name, e in methods.items()
+            }
+            for group, methods in self.stats.items()
+        }
+
+    def load(self):
+        try:
+            data = _read_json_file(self.file_path) or {}
+            for group, methods in data.items():
+                for name, e in methods.items():
+                    entry = self._entry(group, name)
+                    entry['results'].extend(bool(r) for r in e.get('results', []))
+                    entry['latency'] = e.get('latency')
+                    entry['calls'] = int(e.get('calls') or 0)
+                    entry['success_latencies'].extend(float(t) for t in e.get('success_latencies', []))
+            logger.info(f"Загружена статистика методов: {sum(len(m) for m in self.stats.values())} методов")
+        except Exception as e:
+            logger.error(f"Ошибка загрузки статистики методов: {e}")
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+        try:
+            await asyncio.to_thread(_atomic_write_json, self.file_path, self.snapshot())
+        except Exception as e:
+            self.dirty = True
+            logger.error(f"Ошибка сохранения статистики методов: {e}")
+
+METHOD_SCOREBOARD = MethodScoreboard()
+
+# ==================== HTTP КЛИЕНТ ====================
+# Одна долгоживущая сессия на всё приложение: соединения к CDN и API
+# переиспользуются (keep-alive), DNS кэшируется, число соединений к одному
+# хосту ограничено. Новая ClientSession на каждый запрос платила DNS, TCP и TLS заново.
+
+class HttpClientManager:
+    """Владелец общего aiohttp.ClientSession и его пула соединений."""
+
+    def __init__(self, limit: int = HTTP_POOL_LIMIT, limit_per_host: int = HTTP_POOL_LIMIT_PER_HOST,
+                 dns_cache_ttl: int = HTTP_DNS_CACHE_TTL, keepalive_timeout: float = HTTP_KEEPALIVE_TIMEOUT):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _create_session(self) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=self.dns_cache_ttl,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        # Cookie не копятся между запросами разных пользователей и сервисов
+        return aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar())
+
+    async def start(self):
+        self.session()
+        logger.info(f"HTTP пул: {self.limit} соединений, {self.limit_per_host} на хост")
+
+    def session(self) -> aiohttp.ClientSession:
+        """Общая сессия. Создаётся лениво, если пул ещё не запущен или уже закрыт."""
+        if self._session is None or self._session.closed:
+            self._session = self._create_session()
+        return self._session
+
+    def flow_session(self) -> aiohttp.ClientSession:
+        """Сессия одного многошагового обмена: свои cookie, соединения из общего пула.
+
+        Y2mate analyze -> convert, токены FastDL/iGram и редиректы share-ссылок
+        держат состояние в cookie. Закрытие такой сессии пул не закрывает.
+        """
+        return aiohttp.ClientSession(connector=self.session().connector, connector_owner=False,
+                                     cookie_jar=aiohttp.CookieJar())
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+HTTP_CLIENT = HttpClientManager()
+
+def get_http_session() -> aiohttp.ClientSession:
+    return HTTP_CLIENT.session()
+
+@contextlib.asynccontextmanager
+async def http_session():
+    """Сессия на один обмен с сервисом: cookie живут до выхода из блока, соединения - в общем пуле."""
+    session = HTTP_CLIENT.flow_session()
+    try:
+        yield session
+    finally:
+        await session.close()
+
+# ==================== ПОТОКОВАЯ ЗАГРУЗКА ====================
+# Ответ пишется на диск кусками по STREAM_CHUNK_SIZE, поэтому память на одну
+# загрузку не зависит от размера файла. Размер проверяется по Content-Length
+# до начала и по факту во время чтения, sha256 считается на лету.
+# Запись на диск идёт через AsyncFileSink: куски копятся в буфер и
+# записываются одним вызовом в потоке, event loop не ждёт диск.
+
+class AsyncFileSink:
+    """Асинхронная запись файла с адаптивным буфером и записью в потоке.
+
+    Буфер начинается с min_buffer и удваивается после каждого сброса до половины max_buffer:
+    мелкие файлы сбрасываются быстро, крупные - редкими большими записями.
+    Пока поток пишет один буфер, следующий уже накапливается; вместе они не больше
+    max_buffer (плюс один пришедший кусок) - дальше запись ждёт завершения сброса.
+    """
+
+    def __init__(self, path: str, min_buffer: int = FILE_SINK_MIN_BUFFER, max_buffer: int = FILE_SINK_MAX_BUFFER):
+        self.path = path
+        self.max_buffer = max(min_buffer, max_buffer)
+        self.target = min_buffer
+        self.size = 0
+        self._ceiling = max(min_buffer, self.max_buffer // 2)
+        self._chunks: List[bytes] = []
+        self._buffered = 0
+        self._in_flight = 0
+        self._file = None
+        self._pending: Optional[asyncio.Future] = None
+
+    async def __aenter__(self) -> 'AsyncFileSink':
+        self._file = await asyncio.to_thread(open, self.path, 'wb')
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                await self.flush()
+            elif self._pending:
+                await asyncio.gather(self._pending, return_exceptions=True)
+        finally:
+            await asyncio.to_thread(self._file.close)
+
+    async def write(self, data: bytes):
+        if not data:
+            return
+        if self._pending and self._in_flight + self._buffered + len(data) > self.max_buffer:
+            await self._wait_pending()
+        self._chunks.append(data)
+        self._buffered += len(data)
+        self.size += len(data)
+        if self._buffered >= self.target:
+            await self._submit()
+            self.target = min(self._ceiling, self.target * 2)
+
+    async def _wait_pending(self):
+        if self._pending:
+            pending, self._pending = self._pending, None
+            self._in_flight = 0
+            await pending
+
+    async def _submit(self):
+        if not self._chunks:
+            return
+        # Не больше одной записи в полёте
+        await self._wait_pending()
+        data = b''.join(self._chunks)
+        self._chunks = []
+        self._buffered = 0
+        self._in_flight = len(data)
+        self._pending = asyncio.ensure_future(asyncio.to_thread(self._file.write, data))
+
+    async def flush(self):
+        await self._submit()
+        await self._wait_pending()
+
+class StreamLimitError(Exception):
+    """Размер ответа вне допустимых границ."""
+
+class StreamedFile:
+    def __init__(self, path: str, size: int, sha256: str, content_type: str):
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+        self.content_type = content_type
+
+async def _stream_response(resp: aiohttp.ClientResponse, dest_path: str, min_size: int, max_size: int,
+                           chunk_size: int) -> StreamedFile:
+    declared = resp.content_length
+    if declared is not None:
+        if declared > max_size:
+            raise StreamLimitError(f"файл {declared} байт больше лимита {max_size}")
+        if declared < min_size:
+            raise StreamLimitError(f"файл {declared} байт меньше минимума {min_size}")
+    
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with AsyncFileSink(dest_path, min_buffer=chunk_size) as sink:
+            async for chunk in resp.content.iter_chunked(chunk_size):
+                size += len(chunk)
+                if size > max_size:
+                    raise StreamLimitError(f"поток превысил лимит {max_size} байт")
+                digest.update(chunk)
+                await sink.write(chunk)
+        if size < min_size:
+            raise StreamLimitError(f"файл {size} байт меньше минимума {min_size}")
+    except BaseException:
+        _remove_quietly(dest_path)
+        raise
+    
+    return StreamedFile(dest_path, size, digest.hexdigest(), resp.headers.get('content-type', ''))
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+async def stream_to_file(session: aiohttp.ClientSession, url: str, dest_path: str,
+                         headers: Optional[dict] = None, timeout: Optional[aiohttp.ClientTimeout] = None,
+                         min_size: int = 0, max_size: int = STREAM_MAX_SIZE,
+                         chunk_size: int = STREAM_CHUNK_SIZE) -> Optional[StreamedFile]:
+    """Скачивает url в dest_path. Возвращает None при HTTP ошибке, StreamLimitError при нарушении размера.
+    Недокачанный файл удаляется."""
+    async with session.get(url, headers=headers, timeout=timeout) as resp:
+        if resp.status != 200:
+            logger.debug(f"Потоковая загрузка: HTTP {resp.status} для {url[:80]}")
+            return None
+        return await _stream_response(resp, dest_path, min_size, max_size, chunk_size)
+
+# ==================== ПАРАЛЛЕЛЬНЫЕ ДИАПАЗОНЫ ====================
+# CDN обычно ограничивают скорость одного соединения. Если сервер отдаёт
+# Accept-Ranges, файл делится на сегменты, которые качаются параллельно и
+# пишутся через os.pwrite в заранее выделенный файл. Оборванный сегмент
+# докачивается с последнего записанного байта. Без поддержки диапазонов -
+# обычный поток.
+
+class RangeNotSupportedError(Exception):
+    """Сервер ответил на запрос диапазона не 206."""
+
+def _content_range_total(value: Optional[str]) -> Optional[int]:
+    """Полный размер из заголовка 'bytes 0-0/12345'."""
+    import re
+    match = re.match(r'bytes\s+\d+-\d+/(\d+)', value or '')
+    return int(match.group(1)) if match else None
+
+def _preallocate(fd: int, size: int):
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, size)
+
+def _pwrite_all(fd: int, data: bytes, offset: int):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+async def _await_through_cancel(future: asyncio.Future):
+    """Дожидается future, даже если ожидающего отменили; отмена пробрасывается после."""
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        while not future.done():
+            try:
+                await asyncio.wait({future})
+            except asyncio.CancelledError:
+                pass
+        if not future.cancelled():
+            future.exception()
+        raise
+
+async def _pwrite_in_thread(fd: int, data: bytes, offset: int):
+    """pwrite в потоке. Поток не отменить, поэтому отменённый сегмент ждёт свою запись:
+    иначе fd закроют (или переиспользуют), пока поток в него пишет."""
+    await _await_through_cancel(asyncio.ensure_future(asyncio.to_thread(_pwrite_all, fd, data, offset)))
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+async def _fetch_segment(session: aiohttp.ClientSession, url: str, fd: int, start: int, end: int,
+                         headers: Optional[dict], timeout: Optional[aiohttp.ClientTimeout],
+                         progress: Optional[List[int]] = None, index: int = 0,
+                         retries: int = RANGED_SEGMENT_RETRIES):
+    """Качает байты [start, end] в fd. После обрыва продолжает с последнего записанного байта.
+    progress[index] - следующий незаписанный байт сегмента, по нему работает докачка."""
+    offset = start
+    attempt = 0
+    while offset <= end:
+        try:
+            req_headers = {**(headers or {}), 'Range': f'bytes={offset}-{end}'}
+            async with session.get(url, headers=req_headers, timeout=timeout) as resp:
+                if resp.status != 206:
+                    raise RangeNotSupportedError(f"HTTP {resp.status} на запрос диапазона")
+                chunks: List[bytes] = []
+                buffered = 0
+                async for chunk in resp.content.iter_any():
+                    remaining = end - offset - buffered + 1
+                    if remaining <= 0:
+                        break
+                    chunk = chunk[:remaining]
+                    chunks.append(chunk)
+                    buffered += len(chunk)
+                    if buffered >= FILE_SINK_MIN_BUFFER:
+                        await _pwrite_in_thread(fd, b''.join(chunks), offset)
+                        offset += buffered
+                        chunks, buffered = [], 0
+                        if progress is not None:
+                            progress[index] = offset
+                if chunks:
+                    await _pwrite_in_thread(fd, b''.join(chunks), offset)
+                    offset += buffered
+                    if progress is not None:
+                        progress[index] = offset
+            if offset <= end:
+                raise aiohttp.ClientPayloadError(f"сегмент оборван на {offset}/{end}")
+        except (RangeNotSupportedError, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            attempt += 1
+            if attempt > retries:
+                raise
+            logger.debug(f"Сегмент {start}-{end}: повтор {attempt} с {offset} ({e})")
+            await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+
+async def download_direct(session: aiohttp.ClientSession, url: str, dest_path: str,
+                          headers: Optional[dict] = None, timeout: Optional[aiohttp.ClientTimeout] = None,
+                          min_size: int = 0, max_size: int = STREAM_MAX_SIZE,
+                          segments: int = RANGED_SEGMENTS, resume_key: Optional[str] = None) -> Optional[StreamedFile]:
+    """Скачивает прямую ссылку на медиа параллельными диапазонами, если сервер их поддерживает.
+    Контракт как у stream_to_file: None при HTTP ошибке, StreamLimitError при нарушении размера.
+    С resume_key недокачанный файл и прогресс сегментов сохраняются, и следующая попытка
+    с тем же ключом продолжает с места обрыва, если ETag/Last-Modified не изменились."""
+    if segments <= 1 or not hasattr(os, 'pwrite'):
+        return await stream_to_file(session, url, dest_path, headers=headers, timeout=timeout,
+                                    min_size=min_size, max_size=max_size)
+    
+    # Пробный запрос первого байта: 206 - диапазоны есть, 200 - сервер отдаёт файл целиком
+    probe_headers = {**(headers or {}), 'Range': 'bytes=0-0'}
+    async with session.get(url, headers=probe_headers, timeout=timeout) as resp:
+        if resp.status == 200:
+            return await _stream_response(resp, dest_path, min_size, max_size, STREAM_CHUNK_SIZE)
+        if resp.status != 206:
+            logger.debug(f"Загрузка по диапазонам: HTTP {resp.status} для {url[:80]}")
+            return None
+        total = _content_range_total(resp.headers.get('Content-Range'))
+        content_type = resp.headers.get('content-type', '')
+        etag = resp.headers.get('ETag')
+        last_modified = resp.headers.get('Last-Modified')
+    
+    if not total:
+        return await stream_to_file(session, url, dest_path, headers=headers, timeout=timeout,
+                                    min_size=min_size, max_size=max_size)
+    if total > max_size:
+        raise StreamLimitError(f"файл {total} байт больше лимита {max_size}")
+    if total < min_size:
+        raise StreamLimitError(f"файл {total} байт меньше минимума {min_size}")
+    
+    # Докачка возможна только с валидатором и если ключ не занят параллельной попыткой
+    state = None
+    if resume_key and (etag or last_modified) and DOWNLOAD_STATE.claim(resume_key):
+        state = DOWNLOAD_STATE.prepare(resume_key, url, total, etag, last_modified)
+    
+    if state:
+        work_path = state['path']
+        bounds = [tuple(b) for b in state['segments']]
+        progress = state['progress']
+        resumed = any(p > start for p, (start, _) in zip(progress, bounds))
+    else:
+        work_path = dest_path
+        count = max(1, min(segments, total // RANGED_MIN_SEGMENT_SIZE))
+        step = -(-total // count)
+        bounds = [(start, min(total, start + step) - 1) for start in range(0, total, step)]
+        progress = [start for start, _ in bounds]
+        resumed = False
+    if resumed:
+        done = sum(p - start for p, (start, _) in zip(progress, bounds))
+        logger.info(f"Докачка: {done}/{total} байт уже на диске")
+    
+    fd = -1
+    tasks: List[asyncio.Task] = []
+    try:
+        flags = os.O_WRONLY | os.O_CREAT | (0 if resumed else os.O_TRUNC)
+        fd = await asyncio.to_thread(os.open, work_path, flags, 0o644)
+        if not resumed:
+            await asyncio.to_thread(_preallocate, fd, total)
+        tasks = [asyncio.create_task(_fetch_segment(session, url, fd, progress[i], end, headers, timeout,
+                                                    progress=progress, index=i))
+                 for i, (_, end) in enumerate(bounds) if progress[i] <= end]
+        await asyncio.gather(*tasks)
+    except BaseException as e:
+        for task in tasks:
+            task.cancel()
+        # fd закрывается только после того, как все сегменты дождались своих записей
+        await _await_through_cancel(asyncio.gather(*tasks, return_exceptions=True))
+        if fd >= 0:
+            os.close(fd)
+            fd = -1
+        if isinstance(e, RangeNotSupportedError):
+            if state:
+                DOWNLOAD_STATE.discard(resume_key)
+            else:
+                _remove_quietly(work_path)
+            logger.debug(f"Диапазоны не поддержаны ({e}), качаем одним потоком")
+            return await stream_to_file(session, url, dest_path, headers=headers, timeout=timeout,
+                                        min_size=min_size, max_size=max_size)
+        if state:
+            # Недокачанный файл остаётся в PARTIALS_DIR для следующей попытки
+            DOWNLOAD_STATE.touch(resume_key)
+        else:
+            _remove_quietly(work_path)
+        raise
+    finally:
+        if fd >= 0:
+            os.close(fd)
+        if state:
+            DOWNLOAD_STATE.release(resume_key)
+    
+    if state:
+        import shutil
+        await asyncio.to_thread(shutil.move, work_path, dest_path)
+        DOWNLOAD_STATE.forget(resume_key)
+    
+    logger.debug(f"Скачано {total} байт в {len(bounds)} сегментов")
+    sha256 = await asyncio.to_thread(_file_sha256, dest_path)
+    return StreamedFile(dest_path, total, sha256, content_type)
+
+async def download_direct_to_temp(session: aiohttp.ClientSession, url: str, filename: str,
+                                  **kwargs) -> Optional[str]:
+    """download_direct в новую временную папку. Путь к файлу при успехе; при неудаче
+    или исключении папка удаляется."""
+    import shutil
+    temp_dir = tempfile.mkdtemp()
+    temp_file = os.path.join(temp_dir, filename)
+    downloaded = False
+    try:
+        downloaded = bool(await download_direct(session, url, temp_file, **kwargs))
+    finally:
+        if not downloaded:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    return temp_file if downloaded else None
+
+# ==================== ДОКАЧКА ====================
+# Состояние незавершённых загрузок по диапазонам: ссылка, валидатор
+# (ETag/Last-Modified), границы сегментов и сколько каждого уже на диске.
+# Недокачанные файлы лежат в PARTIALS_DIR, там же yt-dlp держит свои .part.
+# Всё, что не трогали дольше PARTIAL_MAX_AGE, удаляет фоновый уборщик.
+
+class DownloadStateStore:
+    """Персистентный реестр недокачанных файлов по ключу задачи."""
+
+    def __init__(self, file_path: str = DOWNLOAD_STATE_FILE, partials_dir: str = PARTIALS_DIR,
+                 max_age: int = PARTIAL_MAX_AGE):
+        self.file_path = file_path
+        self.partials_dir = partials_dir
+        self.max_age = max_age
+        self.entries: Dict[str, dict] = {}
+        self.active: set = set()
+        self.dirty = False
+
+    def load(self):
+        try:
+            os.makedirs(self.partials_dir, exist_ok=True)
+            data = _read_json_file(self.file_path) or {}
+            self.entries = {k: v for k, v in data.items() if isinstance(v, dict) and v.get('path')}
+            logger.info(f"Незавершённых загрузок: {len(self.entries)}")
+        except Exception as e:
+            logger.error(f"Ошибка загрузки состояния загрузок: {e}")
+            self.entries = {}
+
+    def partial_path(self, key: str) -> str:
+        return os.path.join(self.partials_dir, hashlib.sha1(key.encode()).hexdigest() + '.part')
+
+    def claim(self, key: str) -> bool:
+        """Занимает ключ. False - по нему уже идёт загрузка (например, параллельный метод)."""
+        if key in self.active:
+            return False
+        self.active.add(key)
+        return True
+
+    def release(self, key: str):
+        self.active.discard(key)
+
+    def prepare(self, key: str, url: str, total: int, etag: Optional[str],
+                last_modified: Optional[str]) -> dict:
+        """Возвращает запись для докачки или новую, если валидатор или размер изменились."""
+        entry = self.entries.get(key)
+        if (entry and entry.get('total') == total and entry.get('etag') == etag
+                and entry.get('last_modified') == last_modified and os.path.exists(entry['path'])
+                and os.path.getsize(entry['path']) == total):
+            entry['url'] = url
+            entry['updated'] = time.time()
+            self.dirty = True
+            return entry
+        if entry:
+            _remove_quietly(entry['path'])
+        os.makedirs(self.partials_dir, exist_ok=True)
+        count = max(1, min(RANGED_SEGMENTS, total // RANGED_MIN_SEGMENT_SIZE))
+        step = -(-total // count)
+        segments = [[start, min(total, start + step) - 1] for start in range(0, total, step)]
+        entry = {
+            'url': url,
+            'path': self.partial_path(key),
+            'total': total,
+            'etag': etag,
+            'last_modified': last_modified,
+            'segments': segments,
+            'progress': [start for start, _ in segments],
+            'updated': time.time(),
+        }
+        self.entries[key] = entry
+        self.dirty = True
+        return entry
+
+    def touch(self, key: str):
+        entry = self.entries.get(key)
+        if entry:
+            entry['updated'] = time.time()
+            self.dirty = True
+
+    def forget(self, key: str):
+        """Загрузка завершена: файл уже перемещён, запись больше не нужна."""
+        if self.entries.pop(key, None) is not None:
+            self.dirty = True
+
+    def discard(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry:
+            _remove_quietly(entry['path'])
+            self.dirty = True
+
+    def sweep(self) -> int:
+        """Удаляет брошенные докачки и файлы в PARTIALS_DIR старше max_age."""
+        now = time.time()
+        removed = 0
+        for key, entry in list(self.entries.items()):
+            if key in self.active:
+                continue
+            if now - entry.get('updated', 0) > self.max_age or not os.path.exists(entry['path']):
+                self.discard(key)
+                removed += 1
+        known = {entry['path'] for entry in self.entries.values()}
+        try:
+            names = os.listdir(self.partials_dir)
+        except OSError:
+            names = []
+        for name in names:
+            path = os.path.join(self.partials_dir, name)
+            if path in known:
+                continue
+            try:
+                if now - os.path.getmtime(path) > self.max_age:
+                    if os.path.isdir(path):
+                        import shutil
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+        return removed
+
+    async def flush(self):
+        # Пока идут загрузки, прогресс сегментов меняется без флага dirty
+        if not self.dirty and not self.active:
+            return
+        self.dirty = False
+        snapshot = copy.deepcopy(self.entries)
+        try:
+            await asyncio.to_thread(_atomic_write_json, self.file_path, snapshot)
+        except Exception as e:
+            self.dirty = True
+            logger.error(f"Ошибка сохранения состояния загрузок: {e}")
+
+DOWNLOAD_STATE = DownloadStateStore()
+PARTIAL_JANITOR_TASK: Optional[asyncio.Task] = None
+
+async def partial_janitor_loop():
+    """Фоновая уборка брошенных недокачанных файлов."""
+    while not SHUTDOWN_FLAG:
+        try:
+            removed = DOWNLOAD_STATE.sweep()
+            if removed:
+                logger.info(f"Удалено брошенных недокачек: {removed}")
+            await asyncio.sleep(PARTIAL_JANITOR_INTERVAL)
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            logger.error(f"Ошибка уборки недокачек: {e}")
+            await asyncio.sleep(PARTIAL_JANITOR_INTERVAL)
+
+# ==================== ЗАГРУЗКА ФОТО ====================
+# Фото карусели качаются параллельно (не больше PHOTO_FETCH_CONCURRENCY
+# одновременно), повторяющиеся ссылки - один раз. Порядок результата
+# совпадает с порядком ссылок, неудачные фото пропускаются.
+
+def photo_extension(content_type: str) -> str:
+    if 'jpeg' in content_type or 'jpg' in content_type:
+        return '.jpg'
+    if 'png' in content_type:
+        return '.png'
+    if 'webp' in content_type:
+        return '.webp'
+    return '.jpg'  # По умолчанию
+
+async def fetch_photos(session: aiohttp.ClientSession, photo_urls: List[str], dest_dir: str,
+                       headers: Optional[dict] = None, min_size: int = 5000,
+                       concurrency: int = PHOTO_FETCH_CONCURRENCY,
+                       timeout: Optional[aiohttp.ClientTimeout] = None) -> List[str]:
+    """Скачивает фото в dest_dir. Возвращает пути успешно скачанных фото в исходном порядке."""
+    unique_urls = list(dict.fromkeys(u for u in photo_urls if u))
+    if len(unique_urls) < len(photo_urls):
+        logger.debug(f"Пропущено повторяющихся фото: {len(photo_urls) - len(unique_urls)}")
+    timeout = timeout or aiohttp.ClientTimeout(total=30)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    
+    async def fetch_one(index: int, photo_url: str) -> Optional[str]:
+        async with semaphore:
+            part_file = os.path.join(dest_dir, f"photo_{index}.part")
+            try:
+                result = await stream_to_file(session, photo_url, part_file, headers=headers,
+                                              timeout=timeout, min_size=min_size)
+                if not result:
+                    return None
+                photo_file = os.path.join(dest_dir, f"photo_{index}{photo_extension(result.content_type)}")
+                os.replace(part_file, photo_file)
+                logger.debug(f"Фото {index} скачано: {result.size} bytes")
+                return photo_file
+            except Exception as e:
+                logger.warning(f"Ошибка скачивания фото {index}: {e}")
+                return None
+    
+    results = await asyncio.gather(*(fetch_one(i + 1, u) for i, u in enumerate(unique_urls)))
+    return [path for path in results if path]
+
+# ==================== ЗАЩИТА ВНЕШНИХ СЕРВИСОВ ====================
+# Cobalt, RapidSave, Y2mate, SnapSave, Invidious, FastDL и iGram регулярно
+# пропадают на часы. Автомат на каждый хост размыкается после серии ошибок,
+# и запросы к нему отклоняются мгновенно вместо ожидания таймаута.
+# Восстановление проверяет фоновая задача, а не пользовательский запрос.
+
+class CircuitOpenError(Exception):
+    """Хост временно исключён автоматом защиты."""
+
+class CircuitBreaker:
+    """Автомат одного хоста: closed -> open -> half_open -> closed."""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, host: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 base_cooldown: float = CIRCUIT_BASE_COOLDOWN, max_cooldown: float = CIRCUIT_MAX_COOLDOWN):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0  # размыканий подряд, задаёт экспоненту паузы
+        self.opened_at = 0.0
+        self.cooldown = base_cooldown
+        self.trial_started = 0.0
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос. В half_open пропускается один пробный запрос."""
+        now = time.monotonic()
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if now - self.opened_at < self.cooldown:
+                return False
+            self.state = self.HALF_OPEN
+            self.trial_started = 0.0
+        # half_open: пробный запрос, если предыдущий не завис
+        if self.trial_started and now - self.trial_started < 60:
+            return False
+        self.trial_started = now
+        return True
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info(f"🟢 {self.host}: сервис восстановлен")
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.trial_started = 0.0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self._trip()
+
+    def _trip(self):
+        self.cooldown = min(self.max_cooldown, self.base_cooldown * (2 ** self.trips))
+        self.trips += 1
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.trial_started = 0.0
+        logger.warning(f"🔴 {self.host}: автомат разомкнут на {self.cooldown:.0f}с (ошибок: {self.failures})")
+
+    def probe_due(self) -> bool:
+        return self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown
+
+    def record_response(self, status: int):
+        """Сбой сервиса - только 5xx и 429. Прочие 4xx - ответ на наш запрос, сервис жив."""
+        if status >= 500 or status == 429:
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def record_error(self, error: BaseException):
+        """Сбой - только ошибка соединения или таймаут. Остальное о здоровье хоста не говорит."""
+        if isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError)):
+            self.record_failure()
+        else:
+            self.trial_started = 0.0
+
+class CircuitBreakerRegistry:
+    """Автоматы по хостам внешних API."""
+
+    def __init__(self):
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.probe_urls: Dict[str, str] = {}
+
+    def get(self, url: str) -> CircuitBreaker:
+        host = urlsplit(url).netloc.lower()
+        if host not in self.breakers:
+            self.breakers[host] = CircuitBreaker(host)
+        return self.breakers[host]
+
+    def register_probe(self, probe_url: str):
+        """Лёгкий GET, которым фоновая задача проверяет хост (по умолчанию - корень)."""
+        self.probe_urls[urlsplit(probe_url).netloc.lower()] = probe_url
+
+    def probe_url(self, host: str) -> str:
+        return self.probe_urls.get(host) or f"https://{host}/"
+
+    def metrics_text(self) -> str:
+        lines = []
+        for host, breaker in sorted(self.breakers.items()):
+            # 0 - closed, 1 - half_open, 2 - open
+            state = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}[breaker.state]
+            lines.append(f"circuit_state{{host=\"{host}\"}} {state}")
+            lines.append(f"circuit_failures{{host=\"{host}\"}} {breaker.failures}")
+        return "\n".join(lines) + ("\n" if lines else "")
+
+CIRCUIT_BREAKERS = CircuitBreakerRegistry()
+CIRCUIT_PROBE_TASK: Optional[asyncio.Task] = None
+
+async def guarded_request(session: aiohttp.ClientSession, method: str, url: str,
+                          probe_url: Optional[str] = None, **kwargs) -> aiohttp.ClientResponse:
+    """Запрос к внешнему API через автомат хоста.
+
+    Ошибкой сервиса считаются только сбой соединения, таймаут, 5xx и 429.
+    probe_url - лёгкий GET на том же хосте для фоновой проверки после размыкания.
+    """
+    breaker = CIRCUIT_BREAKERS.get(url)
+    if probe_url:
+        CIRCUIT_BREAKERS.register_probe(probe_url)
+    if not breaker.allow():
+        raise CircuitOpenError(f"{breaker.host} временно недоступен")
+    try:
+        resp = await session.request(method, url, **kwargs)
+    except asyncio.CancelledError:
+        breaker.trial_started = 0.0
+        raise
+    except Exception as e:
+        breaker.record_error(e)
+        raise
+    breaker.record_response(resp.status)
+    return resp
+
+async def circuit_probe_loop():
+    """Фоновая проверка разомкнутых хостов их probe URL по тем же правилам, что и guarded_request."""
+    while not SHUTDOWN_FLAG:
+        try:
+            await asyncio.sleep(CIRCUIT_PROBE_INTERVAL)
+            due = [b for b in CIRCUIT_BREAKERS.breakers.values() if b.probe_due()]
+            if not due:
+                continue
+            async with http_session() as session:
+                for breaker in due:
+                    if not breaker.allow():
+                        continue
+                    try:
+                        async with session.get(CIRCUIT_BREAKERS.probe_url(breaker.host),
+                                               timeout=aiohttp.ClientTimeout(total=10)) as resp:
+                            breaker.record_response(resp.status)
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        logger.debug(f"Проверка {breaker.host} не удалась: {e}")
+                        breaker.record_error(e)
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            logger.error(f"Ошибка проверки автоматов: {e}")
+
 # ==================== YOUTUBE DOWNLOADER ====================
 
 async def refresh_youtube_visitor_data():
     """Обновляет YouTube visitor_data и PO Token через Playwright с перехватом сетевых запросов."""
-    global YOUTUBE_VISITOR_DATA, YOUTUBE_PO_TOKEN, YOUTUBE_COOKIES_LAST_REFRESH, YT_CONTEXT, YT_PLAYWRIGHT_READY
+    global YOUTUBE_VISITOR_DATA, YOUTUBE_PO_TOKEN, YOUTUBE_COOKIES_LAST_REFRESH
     
-    if not YT_PLAYWRIGHT_READY or not YT_CONTEXT:
+    if not BROWSERS.available('youtube'):
         logger.warning("YouTube Playwright не готов для обновления cookies")
         return False
+    try:
+        async with BROWSERS.session('youtube') as context:
+            tokens = await _capture_youtube_tokens(context)
+    except BrowserUnavailableError as e:
+        logger.warning(f"{e}")
+        return False
+    if not tokens:
+        return False
+    visitor_data, po_token, cookies = tokens
+    
+    # Обновляем глобальные переменные
+    if visitor_data:
+        YOUTUBE_VISITOR_DATA = visitor_data
+        YOUTUBE_COOKIES_LAST_REFRESH = datetime.now()
+        logger.info(f"YouTube visitor_data обновлён: {visitor_data[:20]}...")
     
+    if po_token:
+        YOUTUBE_PO_TOKEN = po_token
+        logger.info(f"YouTube PO Token сохранён")
+    
+    # Сохраняем cookies в файл для yt-dlp
+    cookie_file = "cookies_youtube.txt"
+    _write_youtube_cookiefile(cookie_file, cookies)
+    logger.info(f"YouTube cookies сохранены в {cookie_file}")
+    return True
+
+def _write_youtube_cookiefile(cookie_file: str, cookies: List[Dict[str, Any]]):
+    """Пишет cookies YouTube/Google в формате Netscape для yt-dlp."""
+    one_year_from_now = int(time.time()) + 365 * 24 * 60 * 60
+    with open(cookie_file, 'w', encoding='utf-8') as f:
+        f.write("# Netscape HTTP Cookie File\n")
+        for cookie in cookies:
+            domain = cookie.get('domain', '')
+            if 'youtube' in domain or 'google' in domain:
+                flag = 'TRUE' if domain.startswith('.') else 'FALSE'
+                path = cookie.get('path', '/')
+                secure = 'TRUE' if cookie.get('secure') else 'FALSE'
+                raw_expires = cookie.get('expires')
+                if raw_expires and isinstance(raw_expires, (int, float)) and raw_expires > time.time():
+                    expires = int(raw_expires)
+                else:
+                    expires = one_year_from_now
+                name = cookie.get('name', '')
+                value = cookie.get('value', '')
+                if name and value:
+                    f.write(f"{domain}\t{flag}\t{path}\t{secure}\t{expires}\t{name}\t{value}\n")
+
+# Страница YouTube готова к работе: документ загружен, шапка или плеер видны
+# и ничего их не перекрывает (нет окна согласия на cookies)
+YOUTUBE_PAGE_INTERACTIVE_JS = """() => {
+    if (document.readyState !== 'complete') return false;
+    if (document.querySelector('ytd-consent-bump-v2-lightbox, form[action*="consent"]')) return false;
+    const el = document.querySelector('ytd-masthead #search-input, ytd-masthead #logo, #movie_player');
+    if (!el) return false;
+    const rect = el.getBoundingClientRect();
+    if (!rect.width || !rect.height) return false;
+    const top = document.elementFromPoint(rect.left + rect.width / 2, rect.top + rect.height / 2);
+    return !!top && (el === top || el.contains(top));
+}"""
+
+async def _capture_youtube_tokens(context: BrowserContext) -> Optional[Tuple[Optional[str], Optional[str], List[Dict[str, Any]]]]:
+    """Открывает YouTube в context и перехватывает токены.
+    Возвращает (visitor_data, po_token, cookies) или None, если токенов нет."""
     page = None
     captured_po_token = None
     captured_visitor_data = None
+    player_seen = asyncio.Event()
     
     async def handle_response(response):
         """Перехватываем ответы от YouTube API для извлечения PO Token."""
@@ -692,12 +2753,15 @@ async def refresh_youtube_visitor_data():
                         logger.info(f"Захвачен visitorData из API: {vd[:20]}...")
                 except Exception:
                     pass
+                finally:
+                    if 'youtubei/v1/player' in url:
+                        player_seen.set()
         except Exception:
             pass
     
     try:
         logger.info("Обновление YouTube visitor_data и PO Token...")
-        page = await YT_CONTEXT.new_page()
+        page = await context.new_page()
         
         # Подписываемся на ответы до навигации
         page.on('response', handle_response)
@@ -717,7 +2781,6 @@ async def refresh_youtube_visitor_data():
         
         # Заходим на YouTube
         await page.goto("https://www.youtube.com", wait_until='domcontentloaded', timeout=30000)
-        await page.wait_for_timeout(2000)
         
         # Принимаем consent если есть
         consent_selectors = [
@@ -735,20 +2798,30 @@ async def refresh_youtube_visitor_data():
             'ytd-consent-bump-v2-lightbox button.yt-spec-button-shape-next--call-to-action',
         ]
         
+        # Ждём либо баннер consent, либо интерактивную страницу без него. ytcfg с VISITOR_DATA
+        # для этого не годится: он готов раньше, чем EU-баннер появляется
+        consent = page.locator(', '.join(consent_selectors)).first
+        await wait_first(
+            consent.wait_for(state='visible'),
+            page.wait_for_function(YOUTUBE_PAGE_INTERACTIVE_JS, polling=250),
+            timeout=PLAYWRIGHT_CONSENT_TIMEOUT,
+        )
+        # Баннер мог отрисоваться вслед за страницей: короткое ограниченное ожидание кнопки
+        try:
+            await consent.wait_for(state='visible', timeout=PLAYWRIGHT_CONSENT_BUTTON_TIMEOUT * 1000)
+        except Exception:
+            pass
         for selector in consent_selectors:
             try:
                 btn = page.locator(selector).first
-                if await btn.is_visible(timeout=500):
+                if await btn.is_visible():
                     await btn.click()
                     logger.info(f"Нажата кнопка consent: {selector[:50]}")
-                    await page.wait_for_timeout(2000)
+                    await wait_first(btn.wait_for(state='hidden'), timeout=PLAYWRIGHT_CONSENT_TIMEOUT)
                     break
             except Exception:
                 continue
         
-        # Ждём полной загрузки главной
-        await page.wait_for_timeout(3000)
-        
         # Переходим на популярное видео Shorts для получения PO Token
         # Shorts обычно лучше загружаются и дают токены
         test_video_urls = [
@@ -758,8 +2831,10 @@ async def refresh_youtube_visitor_data():
         
         for test_url in test_video_urls:
             try:
+                player_seen.clear()
                 await page.goto(test_url, wait_until='domcontentloaded', timeout=15000)
-                await page.wait_for_timeout(5000)  # Ждём загрузки плеера и API запросов
+                # Ждём первый ответ youtubei/v1/player, он уже разобран обработчиком
+                await wait_first(player_seen.wait())
                 
                 # Проверяем получили ли мы токены
                 if captured_po_token:
@@ -806,108 +2881,357 @@ async def refresh_youtube_visitor_data():
             except Exception as e:
                 logger.debug(f"Не удалось извлечь visitor_data из JS: {e}")
         
-        # Обновляем глобальные переменные
-        success = False
-        if visitor_data:
-            YOUTUBE_VISITOR_DATA = visitor_data
-            YOUTUBE_COOKIES_LAST_REFRESH = datetime.now()
-            logger.info(f"YouTube visitor_data обновлён: {visitor_data[:20]}...")
-            success = True
-        
-        if captured_po_token:
-            YOUTUBE_PO_TOKEN = captured_po_token
-            logger.info(f"YouTube PO Token сохранён")
-            success = True
-        
-        if success:
-            # Сохраняем cookies в файл для yt-dlp
-            cookie_file = "cookies_youtube.txt"
-            one_year_from_now = int(time.time()) + 365 * 24 * 60 * 60
-            with open(cookie_file, 'w', encoding='utf-8') as f:
-                f.write("# Netscape HTTP Cookie File\n")
-                for cookie in cookies:
-                    domain = cookie.get('domain', '')
-                    if 'youtube' in domain or 'google' in domain:
-                        flag = 'TRUE' if domain.startswith('.') else 'FALSE'
-                        path = cookie.get('path', '/')
-                        secure = 'TRUE' if cookie.get('secure') else 'FALSE'
-                        raw_expires = cookie.get('expires')
-                        if raw_expires and isinstance(raw_expires, (int, float)) and raw_expires > time.time():
-                            expires = int(raw_expires)
-                        else:
-                            expires = one_year_from_now
-                        name = cookie.get('name', '')
-                        value = cookie.get('value', '')
-                        if name and value:
-                            f.write(f"{domain}\t{flag}\t{path}\t{secure}\t{expires}\t{name}\t{value}\n")
-            
-            logger.info(f"YouTube cookies сохранены в {cookie_file}")
-            return True
+        if visitor_data or captured_po_token:
+            return visitor_data, captured_po_token, cookies
         else:
             cookie_names = [c.get('name') for c in cookies if 'youtube' in c.get('domain', '') or 'google' in c.get('domain', '')]
             logger.warning(f"Не удалось получить токены. Доступные cookies: {cookie_names[:10]}")
-            return False
+            return None
             
     except Exception as e:
         logger.error(f"Ошибка обновления YouTube токенов: {e}")
-        return False
+        return None
     finally:
         if page:
             try:
-                page.remove_listener('response', handle_response)
-                await page.close()
-            except Exception:
+                page.remove_listener('response', handle_response)
+                await page.close()
+            except Exception:
+                pass
+
+
+
+# Брокер токенов YouTube. Загрузки берут последний удачный visitor_data и PO
+# Token мгновенно и никогда не ждут браузер ради планового обновления: его
+# заранее (за YOUTUBE_TOKEN_REFRESH_AHEAD до истечения) делает фоновый цикл.
+# Обновления по ошибке блокировки идут через тот же брокер: одновременные
+# запросы ждут одно обновление под общей блокировкой, а если токены уже
+# сменились после неудачной попытки, обновление не повторяется.
+
+class TokenBroker:
+    """Единая точка получения и обновления токенов YouTube."""
+
+    def __init__(self, refresh: Callable[[], Awaitable[bool]], ttl: float = YOUTUBE_REFRESH_INTERVAL,
+                 refresh_ahead: float = YOUTUBE_TOKEN_REFRESH_AHEAD, min_interval: float = YOUTUBE_TOKEN_MIN_INTERVAL):
+        self._refresh = refresh
+        self.ttl = ttl
+        self.refresh_ahead = min(refresh_ahead, ttl / 2)
+        self.min_interval = min_interval
+        self._lock = asyncio.Lock()
+        self._background: Optional[asyncio.Task] = None
+        self.generation = 0  # растёт после каждого удачного обновления
+        self.last_attempt = 0.0
+        self.failures_in_row = 0
+        self.refreshes = 0
+        self.failures = 0
+        self.coalesced = 0
+
+    def current(self) -> Tuple[Optional[str], Optional[str], int]:
+        """Последние удачные (visitor_data, po_token, поколение) без ожидания."""
+        return YOUTUBE_VISITOR_DATA, YOUTUBE_PO_TOKEN, self.generation
+
+    def age(self) -> Optional[float]:
+        if YOUTUBE_COOKIES_LAST_REFRESH is None:
+            return None
+        return (datetime.now() - YOUTUBE_COOKIES_LAST_REFRESH).total_seconds()
+
+    def next_refresh_in(self) -> float:
+        """Секунд до следующего планового обновления."""
+        age = self.age()
+        if self.failures_in_row:
+            # Повтор после неудачи: 60, 120, 240... но не реже, чем раз в ttl
+            backoff = min(self.min_interval * 2 ** (self.failures_in_row - 1), self.ttl)
+            return max(0.0, self.last_attempt + backoff - time.monotonic())
+        if age is None:
+            return 0.0
+        return max(0.0, self.ttl - self.refresh_ahead - age)
+
+    async def refresh(self, reason: str, seen_generation: Optional[int] = None) -> bool:
+        """Обновляет токены. Вызовы, пришедшие во время обновления, ждут его и не запускают своё.
+
+        seen_generation - поколение токенов, с которыми случилась ошибка: если
+        они уже сменились, новые токены отдаются сразу.
+        """
+        if seen_generation is None:
+            seen_generation = self.generation
+        async with self._lock:
+            if self.generation != seen_generation:
+                self.coalesced += 1
+                return True
+            if self.failures_in_row and time.monotonic() - self.last_attempt < self.min_interval:
+                # Браузер только что не смог выдать токены: не штурмуем его снова
+                self.coalesced += 1
+                return False
+            logger.info(f"Обновление токенов YouTube ({reason})...")
+            self.last_attempt = time.monotonic()
+            try:
+                ok = await self._refresh()
+            except Exception as e:
+                logger.error(f"Ошибка обновления токенов YouTube: {e}")
+                ok = False
+            if ok:
+                self.generation += 1
+                self.refreshes += 1
+                self.failures_in_row = 0
+            else:
+                self.failures += 1
+                self.failures_in_row += 1
+            return ok
+
+    def refresh_soon(self, reason: str):
+        """Запускает обновление в фоне, если токенов нет или они устарели. Не ждёт его."""
+        age = self.age()
+        if age is not None and age < self.ttl - self.refresh_ahead:
+            return
+        if self._lock.locked() or (self._background and not self._background.done()):
+            return
+        self._background = asyncio.create_task(self.refresh(reason))
+
+    async def run(self):
+        """Фоновый цикл: обновляет токены заранее, до истечения ttl."""
+        while not SHUTDOWN_FLAG:
+            await asyncio.sleep(max(self.next_refresh_in(), 1.0))
+            if SHUTDOWN_FLAG:
+                break
+            await self.refresh("плановое")
+
+    def metrics_text(self) -> str:
+        age = self.age()
+        return (f"youtube_token_age_seconds {age if age is not None else -1:.0f}\n"
+                f"youtube_token_generation {self.generation}\n"
+                f"youtube_token_refreshes_total {self.refreshes}\n"
+                f"youtube_token_failures_total {self.failures}\n"
+                f"youtube_token_coalesced_total {self.coalesced}\n")
+
+TOKEN_BROKER = TokenBroker(refresh_youtube_visitor_data)
+
+# Пул личностей YouTube. Кроме основной пары visitor_data/PO Token (её ведёт
+# TOKEN_BROKER) пул держит YOUTUBE_TOKEN_POOL_SIZE личностей, каждая получена
+# в отдельном пустом контексте браузера и со своим файлом cookies. Загрузки
+# получают их по кругу, заблокированная личность выбывает и заменяется новой
+# в фоне, а загрузка сразу пробует следующую. Когда живых личностей нет,
+# используется основная пара.
+
+class YoutubeIdentity:
+    def __init__(self, name: str, visitor_data: Optional[str], po_token: Optional[str], cookiefile: str):
+        self.name = name
+        self.visitor_data = visitor_data
+        self.po_token = po_token
+        self.cookiefile = cookiefile
+        self.minted_at = time.monotonic()
+        self.in_use = 0
+        self.uses = 0
+        self.successes = 0
+        self.failures = 0
+        self.retired = False
+
+class TokenPool:
+    """Набор заранее полученных личностей YouTube с выдачей по кругу."""
+
+    def __init__(self, size: int = YOUTUBE_TOKEN_POOL_SIZE, directory: str = YOUTUBE_IDENTITIES_DIR,
+                 ttl: float = YOUTUBE_REFRESH_INTERVAL, retry_interval: float = YOUTUBE_TOKEN_MIN_INTERVAL):
+        self.size = max(0, size)
+        self.directory = directory
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self._identities: List[YoutubeIdentity] = []
+        self._retired: List[YoutubeIdentity] = []  # ещё заняты загрузками, файл удалим после
+        self._cursor = 0
+        self._serial = 0
+        self._lease_serial = 0
+        self._wake = asyncio.Event()
+        self.minted = 0
+        self.mint_failures = 0
+        self.retired_total = 0
+        self.blocks = 0
+
+    def _expired(self, identity: YoutubeIdentity) -> bool:
+        return time.monotonic() - identity.minted_at >= self.ttl
+
+    def live(self) -> List[YoutubeIdentity]:
+        return [i for i in self._identities if not i.retired and not self._expired(i)]
+
+    def acquire(self) -> Optional[YoutubeIdentity]:
+        """Следующая живая личность по кругу или None. Вернуть её надо через release().
+        Одну личность могут держать несколько загрузок: cookies каждой - своя копия (lease_cookiefile)."""
+        live = self.live()
+        if not live:
+            return None
+        identity = live[self._cursor % len(live)]
+        self._cursor += 1
+        identity.in_use += 1
+        identity.uses += 1
+        return identity
+
+    def lease_cookiefile(self, identity: YoutubeIdentity) -> str:
+        """Копия файла cookies личности для одной загрузки: yt-dlp перезаписывает cookiefile
+        при закрытии, и общие файлы параллельных загрузок затирали бы друг друга.
+        Копию удаляет вызывающий; остатки убирает close()."""
+        import shutil
+        self._lease_serial += 1
+        path = os.path.join(self.directory, f"{identity.name}.lease-{self._lease_serial}.txt")
+        shutil.copyfile(identity.cookiefile, path)
+        return path
+
+    def release(self, identity: YoutubeIdentity, ok: bool, blocked: bool = False):
+        identity.in_use -= 1
+        if ok:
+            identity.successes += 1
+        else:
+            identity.failures += 1
+        if blocked:
+            self.blocks += 1
+            self.retire(identity, "блокировка")
+        self._collect()
+
+    def retire(self, identity: YoutubeIdentity, reason: str):
+        if identity.retired:
+            return
+        identity.retired = True
+        self.retired_total += 1
+        if identity in self._identities:
+            self._identities.remove(identity)
+        self._retired.append(identity)
+        logger.info(f"Личность YouTube {identity.name} выведена: {reason}")
+        self._wake.set()
+
+    def _collect(self):
+        """Удаляет файлы cookies выбывших личностей, которые больше никто не использует."""
+        for identity in [i for i in self._retired if i.in_use <= 0]:
+            self._retired.remove(identity)
+            _remove_quietly(identity.cookiefile)
+
+    async def mint(self) -> Optional[YoutubeIdentity]:
+        """Получает новую личность в отдельном контексте браузера."""
+        if not BROWSERS.available('youtube'):
+            return None
+        self._serial += 1
+        name = f"identity-{self._serial}"
+        try:
+            async with BROWSERS.fresh_context('youtube') as context:
+                tokens = await _capture_youtube_tokens(context)
+        except BrowserUnavailableError as e:
+            logger.warning(f"{e}")
+            return None
+        if not tokens:
+            return None
+        visitor_data, po_token, cookies = tokens
+        os.makedirs(self.directory, exist_ok=True)
+        cookiefile = os.path.join(self.directory, f"{name}.txt")
+        await asyncio.to_thread(_write_youtube_cookiefile, cookiefile, cookies)
+        logger.info(f"Получена личность YouTube {name}")
+        return YoutubeIdentity(name, visitor_data, po_token, cookiefile)
+
+    def next_expiry_in(self) -> float:
+        if not self._identities:
+            return self.ttl
+        oldest = min(i.minted_at for i in self._identities)
+        return max(0.0, oldest + self.ttl - time.monotonic())
+
+    async def run(self):
+        """Фоновый цикл: выводит истёкшие личности и добирает пул до size."""
+        if self.size <= 0:
+            return
+        failures_in_row = 0
+        while not SHUTDOWN_FLAG:
+            try:
+                for identity in [i for i in self._identities if self._expired(i)]:
+                    self.retire(identity, "истёк срок")
+                self._collect()
+                if len(self._identities) < self.size and BROWSERS.available('youtube'):
+                    identity = await self.mint()
+                    if identity:
+                        self._identities.append(identity)
+                        self.minted += 1
+                        failures_in_row = 0
+                        continue
+                    self.mint_failures += 1
+                    failures_in_row += 1
+                    delay = min(self.retry_interval * 2 ** (failures_in_row - 1), self.ttl)
+                else:
+                    delay = self.next_expiry_in() if len(self._identities) >= self.size else self.retry_interval
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Сбой одной итерации (браузер, диск) не должен останавливать пул
+                logger.error(f"Ошибка пула личностей YouTube: {e}")
+                self.mint_failures += 1
+                failures_in_row += 1
+                delay = min(self.retry_interval * 2 ** (failures_in_row - 1), self.ttl)
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=max(delay, 1.0))
+            except asyncio.TimeoutError:
                 pass
 
+    def close(self):
+        """Удаляет файлы cookies всех личностей и их копий, включая оставшиеся от прошлых запусков."""
+        import glob
+        self._identities.clear()
+        self._retired.clear()
+        for path in glob.glob(os.path.join(self.directory, "identity-*.txt")):
+            _remove_quietly(path)
+
+    def metrics_text(self) -> str:
+        lines = [
+            f"youtube_identities_live {len(self.live())}",
+            f"youtube_identities_minted_total {self.minted}",
+            f"youtube_identities_mint_failures_total {self.mint_failures}",
+            f"youtube_identities_retired_total {self.retired_total}",
+            f"youtube_identities_blocks_total {self.blocks}",
+        ]
+        for identity in self._identities:
+            labels = f'{{identity="{identity.name}"}}'
+            lines.append(f"youtube_identity_uses_total{labels} {identity.uses}")
+            lines.append(f"youtube_identity_successes_total{labels} {identity.successes}")
+            lines.append(f"youtube_identity_failures_total{labels} {identity.failures}")
+        return "\n".join(lines) + "\n"
 
+TOKEN_POOL = TokenPool()
 
 async def youtube_cookie_refresh_loop():
     """Фоновый цикл обновления YouTube cookies."""
-    global YOUTUBE_REFRESH_INTERVAL, SHUTDOWN_FLAG
-    
-    # Первоначальная задержка для инициализации Playwright
+    # Первоначальная задержка для инициализации бота
     await asyncio.sleep(10)
-    
-    while not SHUTDOWN_FLAG:
-        try:
-            if SHUTDOWN_FLAG:
-                break
-            await refresh_youtube_visitor_data()
-        except asyncio.CancelledError:
-            logger.info("YouTube cookie refresh loop cancelled")
-            break
-        except Exception as e:
-            if SHUTDOWN_FLAG:
-                break
-            logger.error(f"Ошибка в цикле обновления YouTube cookies: {e}")
-        
-        # Ждём перед следующим обновлением
-        try:
-            await asyncio.sleep(YOUTUBE_REFRESH_INTERVAL)
-        except asyncio.CancelledError:
-            logger.info("YouTube cookie refresh loop cancelled during sleep")
-            break
+    try:
+        await TOKEN_BROKER.run()
+    except asyncio.CancelledError:
+        logger.info("YouTube cookie refresh loop cancelled")
+
+async def youtube_identity_pool_loop():
+    """Фоновое пополнение пула личностей YouTube (отдельно от основного брокера)."""
+    await asyncio.sleep(10)
+    try:
+        await TOKEN_POOL.run()
+    except asyncio.CancelledError:
+        logger.info("YouTube identity pool loop cancelled")
 
 
 async def refresh_instagram_cookies():
     """Обновляет Instagram cookies через Playwright."""
-    global IG_CONTEXT, IG_PLAYWRIGHT_READY, INSTAGRAM_COOKIES_LAST_REFRESH, INSTAGRAM_SESSION_ID
-    
-    if not IG_PLAYWRIGHT_READY or not IG_CONTEXT:
+    if not BROWSERS.available('instagram'):
         logger.warning("Instagram Playwright не готов для обновления cookies")
         return False
+    try:
+        async with BROWSERS.session('instagram') as context:
+            return await _capture_instagram_cookies(context)
+    except BrowserUnavailableError as e:
+        logger.warning(f"{e}")
+        return False
+
+async def _capture_instagram_cookies(context: BrowserContext) -> bool:
+    global INSTAGRAM_COOKIES_LAST_REFRESH, INSTAGRAM_SESSION_ID
     
     page = None
     try:
         logger.info("Обновление Instagram cookies...")
-        page = await IG_CONTEXT.new_page()
+        page = await context.new_page()
         
         # Устанавливаем мобильный viewport
         await page.set_viewport_size({"width": 375, "height": 812})
         
         # Заходим на Instagram главную
         await page.goto("https://www.instagram.com/", wait_until='domcontentloaded', timeout=30000)
-        await page.wait_for_timeout(3000)
         
         # Принимаем cookies политику если есть
         cookie_accept_selectors = [
@@ -917,20 +3241,23 @@ async def refresh_instagram_cookies():
             '[role="button"]:has-text("Accept")',
         ]
         
+        # Ждём либо баннер cookies, либо полную загрузку страницы без него
+        await wait_first(
+            page.locator(', '.join(cookie_accept_selectors)).first.wait_for(state='visible'),
+            page.wait_for_load_state('load'),
+            timeout=PLAYWRIGHT_CONSENT_TIMEOUT,
+        )
         for selector in cookie_accept_selectors:
             try:
                 btn = page.locator(selector).first
-                if await btn.is_visible(timeout=1000):
+                if await btn.is_visible():
                     await btn.click()
                     logger.info(f"Нажата кнопка cookie consent: {selector[:50]}")
-                    await page.wait_for_timeout(1000)
+                    await wait_first(btn.wait_for(state='hidden'), timeout=PLAYWRIGHT_CONSENT_TIMEOUT)
                     break
             except Exception:
                 continue
         
-        # Ждём загрузки страницы
-        await page.wait_for_timeout(2000)
-        
         # Переходим на какой-нибудь публичный Reel для активации сессии
         test_urls = [
             "https://www.instagram.com/reels/",
@@ -939,8 +3266,16 @@ async def refresh_instagram_cookies():
         
         for test_url in test_urls:
             try:
-                await page.goto(test_url, wait_until='domcontentloaded', timeout=15000)
-                await page.wait_for_timeout(3000)
+                # Сессионные cookies обновляются первым же запросом страницы к API.
+                # Подписываемся до навигации, чтобы не пропустить ранний ответ
+                api_response = asyncio.ensure_future(
+                    page.wait_for_response(lambda r: '/graphql' in r.url or '/api/v1/' in r.url)
+                )
+                try:
+                    await page.goto(test_url, wait_until='domcontentloaded', timeout=15000)
+                    await wait_first(api_response)
+                finally:
+                    api_response.cancel()
                 break
             except Exception:
                 continue
@@ -1026,47 +3361,56 @@ async def instagram_cookie_refresh_loop():
             logger.info("Instagram cookie refresh loop cancelled during sleep")
             break
 
+def extract_youtube_video_id(url: str) -> Optional[str]:
+    """Извлекает 11-символьный video_id из ссылки YouTube."""
+    import re
+    patterns = [
+        r'(?:youtube\.com/watch\?v=|youtu\.be/|youtube\.com/shorts/)([a-zA-Z0-9_-]{11})',
+        r'(?:youtube\.com/embed/)([a-zA-Z0-9_-]{11})',
+    ]
+    for pattern in patterns:
+        match = re.search(pattern, url)
+        if match:
+            return match.group(1)
+    return None
+
 async def download_youtube(url: str, quality: str = "720p") -> Optional[str]:
     """Скачивание с YouTube через yt-dlp + внешние API."""
-    global YOUTUBE_VISITOR_DATA, YOUTUBE_PO_TOKEN, YOUTUBE_COOKIES_LAST_REFRESH
-    
     logger.info(f"Скачивание YouTube: {url[:60]}... (качество={quality})")
     
-    # Проверяем возраст cookies - обновляем если старше 25 минут
-    if YOUTUBE_COOKIES_LAST_REFRESH:
-        age_seconds = (datetime.now() - YOUTUBE_COOKIES_LAST_REFRESH).total_seconds()
-        if age_seconds > 1500:  # 25 минут
-            logger.info(f"Cookies устарели ({age_seconds/60:.1f} мин) - обновляем...")
-            await refresh_youtube_visitor_data()
-    elif YOUTUBE_COOKIES_LAST_REFRESH is None:
-        await refresh_youtube_visitor_data()
+    # Устаревшие или отсутствующие токены обновляются в фоне, загрузка их не ждёт
+    TOKEN_BROKER.refresh_soon("устарели")
     
     # =============== МЕТОД 1: yt-dlp с cookies ===============
-    async def _try_ydl() -> Optional[str]:
+    async def _try_ydl(visitor_data: Optional[str], po_token: Optional[str],
+                       cookiefile: Optional[str] = None) -> Optional[str]:
         ydl_opts = get_ydl_opts(quality, use_youtube_cookies=True)
+        if cookiefile:
+            ydl_opts['cookiefile'] = cookiefile
         
         # Добавляем visitor_data и PO Token если есть
         ydl_opts['extractor_args'] = ydl_opts.get('extractor_args') or {}
         ydl_opts['extractor_args']['youtube'] = ydl_opts['extractor_args'].get('youtube') or {}
         
-        if YOUTUBE_VISITOR_DATA:
-            ydl_opts['extractor_args']['youtube']['visitor_data'] = [YOUTUBE_VISITOR_DATA]
+        if visitor_data:
+            ydl_opts['extractor_args']['youtube']['visitor_data'] = [visitor_data]
         
         # Добавляем PO Token для обхода детекции бота
         # Формат: web.gvs+TOKEN или mweb.gvs+TOKEN
-        if YOUTUBE_PO_TOKEN:
+        if po_token:
             # mweb.gvs для мобильного клиента который обычно лучше работает
-            po_token_value = f"mweb.gvs+{YOUTUBE_PO_TOKEN}"
+            po_token_value = f"mweb.gvs+{po_token}"
             ydl_opts['extractor_args']['youtube']['po_token'] = [po_token_value]
             logger.debug(f"Используем PO Token для yt-dlp")
         
+        choose_format = fit_format_chooser(quality)
         try:
-            return await asyncio.to_thread(_ydl_download_path, url, ydl_opts)
+            return await run_ydl_download('youtube', url, ydl_opts, choose_format)
         except Exception as e:
             if "Impersonate target" in str(e) and "not available" in str(e) and ydl_opts.get('impersonate'):
                 ydl_opts_retry = dict(ydl_opts)
                 ydl_opts_retry.pop('impersonate', None)
-                return await asyncio.to_thread(_ydl_download_path, url, ydl_opts_retry)
+                return await run_ydl_download('youtube', url, ydl_opts_retry, choose_format)
             raise
     
     # Паттерны ошибок блокировки
@@ -1078,49 +3422,68 @@ async def download_youtube(url: str, quality: str = "720p") -> Optional[str]:
         return any(p.lower() in err_str for p in BLOCK_PATTERNS)
     
     # Попытка 1: yt-dlp
-    try:
-        result = await _try_ydl()
-        if result:
-            logger.info("YouTube скачан через yt-dlp")
-            return result
-    except Exception as e:
-        logger.warning(f"yt-dlp ошибка: {str(e)[:100]}")
+    async def try_ytdlp() -> Optional[str]:
+        # Сначала личности пула: при блокировке личность выбывает, пробуем следующую
+        for _ in range(YOUTUBE_IDENTITY_ATTEMPTS):
+            identity = TOKEN_POOL.acquire()
+            if identity is None:
+                break
+            result = None
+            blocked = False
+            cookiefile = None
+            try:
+                cookiefile = await asyncio.to_thread(TOKEN_POOL.lease_cookiefile, identity)
+                result = await _try_ydl(identity.visitor_data, identity.po_token, cookiefile)
+            except Exception as e:
+                logger.warning(f"yt-dlp ошибка ({identity.name}): {str(e)[:100]}")
+                blocked = _is_block_error(e)
+            finally:
+                TOKEN_POOL.release(identity, ok=bool(result), blocked=blocked)
+                if cookiefile:
+                    _remove_quietly(cookiefile)
+            if result:
+                logger.info(f"YouTube скачан через yt-dlp ({identity.name})")
+                return result
+            if not blocked:
+                # Сбой не из-за личности: следующая вряд ли поможет, пробуем основную пару
+                break
         
-        # Если блокировка - обновляем cookies и пробуем ещё раз
-        if _is_block_error(e):
-            logger.info("Блокировка! Обновляем cookies...")
-            if await refresh_youtube_visitor_data():
-                try:
-                    result = await _try_ydl()
-                    if result:
-                        logger.info("YouTube скачан после обновления cookies!")
-                        return result
-                except Exception as e2:
-                    logger.warning(f"yt-dlp retry ошибка: {str(e2)[:80]}")
+        # Основная пара токенов от брокера
+        visitor_data, po_token, generation = TOKEN_BROKER.current()
+        try:
+            result = await _try_ydl(visitor_data, po_token)
+            if result:
+                logger.info("YouTube скачан через yt-dlp")
+                return result
+        except Exception as e:
+            logger.warning(f"yt-dlp ошибка: {str(e)[:100]}")
+            
+            # Если блокировка - обновляем cookies и пробуем ещё раз
+            if _is_block_error(e):
+                logger.info("Блокировка! Обновляем cookies...")
+                if await TOKEN_BROKER.refresh("блокировка yt-dlp", seen_generation=generation):
+                    try:
+                        visitor_data, po_token, _ = TOKEN_BROKER.current()
+                        result = await _try_ydl(visitor_data, po_token)
+                        if result:
+                            logger.info("YouTube скачан после обновления cookies!")
+                            return result
+                    except Exception as e2:
+                        logger.warning(f"yt-dlp retry ошибка: {str(e2)[:80]}")
+        return None
     
     # =============== МЕТОД 2: Внешние API ===============
     
     # Извлекаем video_id
-    video_id = None
-    import re
-    patterns = [
-        r'(?:youtube\.com/watch\?v=|youtu\.be/|youtube\.com/shorts/)([a-zA-Z0-9_-]{11})',
-        r'(?:youtube\.com/embed/)([a-zA-Z0-9_-]{11})',
-    ]
-    for pattern in patterns:
-        match = re.search(pattern, url)
-        if match:
-            video_id = match.group(1)
-            break
+    video_id = extract_youtube_video_id(url)
     
     if not video_id:
         logger.error("Не удалось извлечь video_id")
-        return None
     
     # API 1: Cobalt.tools (v7 API)
     async def try_cobalt() -> Optional[str]:
         logger.info("Пробуем Cobalt API...")
-        async with aiohttp.ClientSession() as session:
+        async with http_session() as session:
             try:
                 payload = {
                     "url": f"https://www.youtube.com/watch?v={video_id}",
@@ -1136,18 +3499,19 @@ async def download_youtube(url: str, quality: str = "720p") -> Optional[str]:
                     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/120.0.0.0",
                 }
                 
-                # Актуальные эндпоинты Cobalt
+                # Актуальные эндпоинты Cobalt и их GET с информацией о сервере для проверки автомата
                 endpoints = [
-                    ("https://api.cobalt.tools/", {"Accept": "application/json", "Content-Type": "application/json"}),
-                    ("https://cobalt-api.hyper.lol/", {"Accept": "application/json", "Content-Type": "application/json"}),
-                    ("https://co.wuk.sh/api/json", {"Accept": "application/json", "Content-Type": "application/json"}),
+                    ("https://api.cobalt.tools/", "https://api.cobalt.tools/", {"Accept": "application/json", "Content-Type": "application/json"}),
+                    ("https://cobalt-api.hyper.lol/", "https://cobalt-api.hyper.lol/", {"Accept": "application/json", "Content-Type": "application/json"}),
+                    ("https://co.wuk.sh/api/json", "https://co.wuk.sh/api/serverInfo", {"Accept": "application/json", "Content-Type": "application/json"}),
                 ]
                 
-                for endpoint, extra_headers in endpoints:
+                for endpoint, probe_url, extra_headers in endpoints:
                     try:
                         req_headers = {**headers, **extra_headers}
-                        async with session.post(
+                        async with await guarded_request(session, 'POST',
                             endpoint,
+                            probe_url=probe_url,
                             json=payload,
                             headers=req_headers,
                             timeout=aiohttp.ClientTimeout(total=30)
@@ -1179,16 +3543,13 @@ async def download_youtube(url: str, quality: str = "720p") -> Optional[str]:
                                 
                                 if download_url:
                                     logger.info(f"Cobalt вернул URL ({status}), скачиваем...")
-                                    async with session.get(download_url, timeout=aiohttp.ClientTimeout(total=300)) as dl_resp:
-                                        if dl_resp.status == 200:
-                                            temp_dir = tempfile.mkdtemp()
-                                            temp_file = os.path.join(temp_dir, f"{video_id}.mp4")
-                                            with open(temp_file, 'wb') as f:
-                                                async for chunk in dl_resp.content.iter_chunked(8192):
-                                                    f.write(chunk)
-                                            if os.path.getsize(temp_file) > 10000:
-                                                logger.info("Скачано через Cobalt!")
-                                                return temp_file
+                                    temp_file = await download_direct_to_temp(
+                                        session, download_url, f"{video_id}.mp4",
+                                        timeout=aiohttp.ClientTimeout(total=300), min_size=10000,
+                                        resume_key=f"youtube:{video_id}:{quality}:cobalt")
+                                    if temp_file:
+                                        logger.info("Скачано через Cobalt!")
+                                        return temp_file
                                 else:
                                     logger.debug(f"Cobalt ответ: status={status}, данные: {resp_text[:200]}")
                             elif resp.status == 400:
@@ -1203,7 +3564,7 @@ async def download_youtube(url: str, quality: str = "720p") -> Optional[str]:
     # API 2: RapidSave
     async def try_rapidsave() -> Optional[str]:
         logger.info("Пробуем RapidSave API...")
-        async with aiohttp.ClientSession() as session:
+        async with http_session() as session:
             try:
                 api_url = "https://rapidsave.com/api/ajax/download"
                 headers = {
@@ -1213,22 +3574,19 @@ async def download_youtube(url: str, quality: str = "720p") -> Optional[str]:
                     "Referer": "https://rapidsave.com/",
                 }
                 data = {"url": f"https://www.youtube.com/watch?v={video_id}"}
-                async with session.post(api_url, data=data, headers=headers, timeout=aiohttp.ClientTimeout(total=30)) as resp:
+                async with await guarded_request(session, 'POST', api_url, probe_url="https://rapidsave.com/", data=data, headers=headers, timeout=aiohttp.ClientTimeout(total=30)) as resp:
                     if resp.status == 200:
                         result = await resp.json()
                         logger.debug(f"RapidSave response: {str(result)[:200]}")
                         download_url = result.get("url") or result.get("download_url")
                         if download_url:
-                            async with session.get(download_url, timeout=aiohttp.ClientTimeout(total=300)) as dl_resp:
-                                if dl_resp.status == 200:
-                                    temp_dir = tempfile.mkdtemp()
-                                    temp_file = os.path.join(temp_dir, f"{video_id}.mp4")
-                                    with open(temp_file, 'wb') as f:
-                                        async for chunk in dl_resp.content.iter_chunked(8192):
-                                            f.write(chunk)
-                                    if os.path.getsize(temp_file) > 10000:
-                                        logger.info("Скачано через RapidSave!")
-                                        return temp_file
+                            temp_file = await download_direct_to_temp(
+                                session, download_url, f"{video_id}.mp4",
+                                timeout=aiohttp.ClientTimeout(total=300), min_size=10000,
+                                resume_key=f"youtube:{video_id}:{quality}:rapidsave")
+                            if temp_file:
+                                logger.info("Скачано через RapidSave!")
+                                return temp_file
                     else:
                         logger.debug(f"RapidSave status {resp.status}")
             except Exception as e:
@@ -1238,7 +3596,7 @@ async def download_youtube(url: str, quality: str = "720p") -> Optional[str]:
     # API 3: Y2mate (улучшенный)
     async def try_y2mate() -> Optional[str]:
         logger.info("Пробуем Y2mate API...")
-        async with aiohttp.ClientSession() as session:
+        async with http_session() as session:
             try:
                 # Шаг 1: Analyze
                 analyze_url = "https://www.y2mate.com/mates/analyzeV2/ajax"
@@ -1249,7 +3607,7 @@ async def download_youtube(url: str, quality: str = "720p") -> Optional[str]:
                     "Origin": "https://www.y2mate.com",
                     "Referer": "https://www.y2mate.com/",
                 }
-                async with session.post(analyze_url, data=form_data, headers=headers, timeout=aiohttp.ClientTimeout(total=30)) as resp:
+                async with await guarded_request(session, 'POST', analyze_url, probe_url="https://www.y2mate.com/", data=form_data, headers=headers, timeout=aiohttp.ClientTimeout(total=30)) as resp:
                     if resp.status != 200:
                         logger.debug(f"Y2mate analyze status {resp.status}")
                         return None
@@ -1282,7 +3640,7 @@ async def download_youtube(url: str, quality: str = "720p") -> Optional[str]:
                     # Шаг 2: Convert
                     convert_url = "https://www.y2mate.com/mates/convertV2/index"
                     convert_data = {"vid": vid, "k": target_key}
-                    async with session.post(convert_url, data=convert_data, headers=headers, timeout=aiohttp.ClientTimeout(total=60)) as conv_resp:
+                    async with await guarded_request(session, 'POST', convert_url, data=convert_data, headers=headers, timeout=aiohttp.ClientTimeout(total=60)) as conv_resp:
                         if conv_resp.status != 200:
                             logger.debug(f"Y2mate convert status {conv_resp.status}")
                             return None
@@ -1295,18 +3653,15 @@ async def download_youtube(url: str, quality: str = "720p") -> Optional[str]:
                             return None
                         
                         # Скачиваем
-                        async with session.get(download_url, headers={"User-Agent": headers["User-Agent"]}, timeout=aiohttp.ClientTimeout(total=300)) as dl_resp:
-                            if dl_resp.status == 200:
-                                temp_dir = tempfile.mkdtemp()
-                                temp_file = os.path.join(temp_dir, f"{video_id}.mp4")
-                                with open(temp_file, 'wb') as f:
-                                    async for chunk in dl_resp.content.iter_chunked(8192):
-                                        f.write(chunk)
-                                if os.path.getsize(temp_file) > 10000:
-                                    logger.info("Скачано через Y2mate!")
-                                    return temp_file
-                            else:
-                                logger.debug(f"Y2mate download status {dl_resp.status}")
+                        temp_file = await download_direct_to_temp(
+                            session, download_url, f"{video_id}.mp4",
+                            headers={"User-Agent": headers["User-Agent"]},
+                            timeout=aiohttp.ClientTimeout(total=300), min_size=10000,
+                            resume_key=f"youtube:{video_id}:{quality}:y2mate")
+                        if temp_file:
+                            logger.info("Скачано через Y2mate!")
+                            return temp_file
+                        logger.debug("Y2mate: файл не скачан")
             except Exception as e:
                 logger.warning(f"Y2mate ошибка: {e}")
         return None
@@ -1314,7 +3669,7 @@ async def download_youtube(url: str, quality: str = "720p") -> Optional[str]:
     # API 4: SnapSave
     async def try_snapsave() -> Optional[str]:
         logger.info("Пробуем SnapSave API...")
-        async with aiohttp.ClientSession() as session:
+        async with http_session() as session:
             try:
                 api_url = "https://snapsave.io/action.php"
                 headers = {
@@ -1323,7 +3678,7 @@ async def download_youtube(url: str, quality: str = "720p") -> Optional[str]:
                     "Origin": "https://snapsave.io",
                 }
                 data = {"url": f"https://www.youtube.com/watch?v={video_id}"}
-                async with session.post(api_url, data=data, headers=headers, timeout=aiohttp.ClientTimeout(total=30)) as resp:
+                async with await guarded_request(session, 'POST', api_url, probe_url="https://snapsave.io/", data=data, headers=headers, timeout=aiohttp.ClientTimeout(total=30)) as resp:
                     if resp.status == 200:
                         result = await resp.text()
                         logger.debug(f"SnapSave response: {result[:200]}")
@@ -1332,16 +3687,13 @@ async def download_youtube(url: str, quality: str = "720p") -> Optional[str]:
                         urls = re.findall(r'href="(https://[^"]+\.mp4[^"]*)"', result)
                         if urls:
                             download_url = urls[0]
-                            async with session.get(download_url, timeout=aiohttp.ClientTimeout(total=300)) as dl_resp:
-                                if dl_resp.status == 200:
-                                    temp_dir = tempfile.mkdtemp()
-                                    temp_file = os.path.join(temp_dir, f"{video_id}.mp4")
-                                    with open(temp_file, 'wb') as f:
-                                        async for chunk in dl_resp.content.iter_chunked(8192):
-                                            f.write(chunk)
-                                    if os.path.getsize(temp_file) > 10000:
-                                        logger.info("Скачано через SnapSave!")
-                                        return temp_file
+                            temp_file = await download_direct_to_temp(
+                                session, download_url, f"{video_id}.mp4",
+                                timeout=aiohttp.ClientTimeout(total=300), min_size=10000,
+                                resume_key=f"youtube:{video_id}:{quality}:snapsave")
+                            if temp_file:
+                                logger.info("Скачано через SnapSave!")
+                                return temp_file
             except Exception as e:
                 logger.warning(f"SnapSave ошибка: {e}")
         return None
@@ -1349,6 +3701,7 @@ async def download_youtube(url: str, quality: str = "720p") -> Optional[str]:
     # API 5: pytubefix (не зависит от yt-dlp)
     async def try_pytubefix(retry_with_cookies: bool = False) -> Optional[str]:
         logger.info(f"Пробуем pytubefix...{' (повторная попытка)' if retry_with_cookies else ''}")
+        generation = TOKEN_BROKER.generation
         try:
             from pytubefix import YouTube
             from pytubefix.cli import on_progress
@@ -1368,10 +3721,16 @@ async def download_youtube(url: str, quality: str = "720p") -> Optional[str]:
                         stream = yt.streams.filter(adaptive=True, file_extension='mp4').order_by('resolution').desc().first()
                 
                 if stream:
+                    import shutil
                     temp_dir = tempfile.mkdtemp()
-                    output_path = stream.download(output_path=temp_dir)
-                    if output_path and os.path.exists(output_path) and os.path.getsize(output_path) > 10000:
-                        return output_path
+                    output_path = None
+                    try:
+                        output_path = stream.download(output_path=temp_dir)
+                    finally:
+                        if not (output_path and os.path.exists(output_path) and os.path.getsize(output_path) > 10000):
+                            shutil.rmtree(temp_dir, ignore_errors=True)
+                            output_path = None
+                    return output_path
                 return None
             
             result = await asyncio.to_thread(_download_with_pytubefix)
@@ -1387,7 +3746,7 @@ async def download_youtube(url: str, quality: str = "720p") -> Optional[str]:
             # Если это первая попытка и ошибка похожа на блокировку - обновляем cookies и пробуем ещё раз
             if not retry_with_cookies and _is_block_error(e):
                 logger.info("pytubefix блокировка! Обновляем cookies и пробуем снова...")
-                if await refresh_youtube_visitor_data():
+                if await TOKEN_BROKER.refresh("блокировка pytubefix", seen_generation=generation):
                     return await try_pytubefix(retry_with_cookies=True)
         return None
     
@@ -1403,13 +3762,14 @@ async def download_youtube(url: str, quality: str = "720p") -> Optional[str]:
             "https://yewtu.be",
         ]
         
-        async with aiohttp.ClientSession() as session:
+        async with http_session() as session:
             for instance in invidious_instances:
                 try:
                     # Получаем информацию о видео
                     api_url = f"{instance}/api/v1/videos/{video_id}"
-                    async with session.get(
+                    async with await guarded_request(session, 'GET',
                         api_url,
+                        probe_url=f"{instance}/api/v1/stats",
                         timeout=aiohttp.ClientTimeout(total=15),
                         headers={"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/120.0.0.0"}
                     ) as resp:
@@ -1438,70 +3798,82 @@ async def download_youtube(url: str, quality: str = "720p") -> Optional[str]:
                         
                         if download_url:
                             logger.info(f"Invidious ({instance}) вернул URL, скачиваем...")
-                            async with session.get(
-                                download_url,
+                            temp_file = await download_direct_to_temp(
+                                session, download_url, f"{video_id}.mp4",
                                 timeout=aiohttp.ClientTimeout(total=300),
-                                headers={"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/120.0.0.0"}
-                            ) as dl_resp:
-                                if dl_resp.status == 200:
-                                    temp_dir = tempfile.mkdtemp()
-                                    temp_file = os.path.join(temp_dir, f"{video_id}.mp4")
-                                    with open(temp_file, 'wb') as f:
-                                        async for chunk in dl_resp.content.iter_chunked(8192):
-                                            f.write(chunk)
-                                    if os.path.getsize(temp_file) > 10000:
-                                        logger.info(f"Скачано через Invidious ({instance})!")
-                                        return temp_file
+                                headers={"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/120.0.0.0"},
+                                min_size=10000,
+                                resume_key=f"youtube:{video_id}:{quality}:invidious",
+                            )
+                            if temp_file:
+                                logger.info(f"Скачано через Invidious ({instance})!")
+                                return temp_file
                 except Exception as e:
                     logger.debug(f"Invidious {instance} ошибка: {e}")
                     continue
         return None
     
-    # Пробуем pytubefix первым (самый надёжный)
-    result = await try_pytubefix()
-    if result:
-        return result
+    # Базовый порядок: yt-dlp → pytubefix → внешние API.
+    # Табло методов переставляет их по живой статистике успеха и скорости.
+    strategies = [('yt-dlp', try_ytdlp)]
+    if video_id:
+        strategies += [
+            ('pytubefix', try_pytubefix),
+            ('Cobalt', try_cobalt),
+            ('RapidSave', try_rapidsave),
+            ('Y2mate', try_y2mate),
+            ('SnapSave', try_snapsave),
+        ]
     
-    # Пробуем внешние API
-    for api_func in [try_cobalt, try_rapidsave, try_y2mate, try_snapsave]:
+    for name, strategy in METHOD_SCOREBOARD.order('youtube', strategies):
+        started = time.monotonic()
         try:
-            result = await api_func()
-            if result:
-                return result
+            result = await strategy()
         except Exception as e:
-            logger.debug(f"API ошибка: {e}")
-            continue
+            logger.debug(f"{name} ошибка: {e}")
+            result = None
+        METHOD_SCOREBOARD.record('youtube', name, bool(result), time.monotonic() - started)
+        if result:
+            return result
     
     logger.error("Все методы скачивания YouTube исчерпаны")
     return None
 
 async def download_youtube_with_playwright(url: str, quality: str = "720p") -> Optional[str]:
     """Резервный метод через Playwright"""
-    global YT_CONTEXT
-    if not YT_PLAYWRIGHT_READY or not YT_CONTEXT:
+    if not BROWSERS.available('youtube'):
         return None
 
     logger.info(f"Скачивание через Playwright (качество={quality})...")
-    page = None
     temp_cookies_file = None
     try:
-        page = await YT_CONTEXT.new_page()
-        await page.goto(url, wait_until='networkidle')
+        # Страница нужна для согласия с cookies и самих cookies: на время загрузки её возвращаем в пул
+        async with BROWSERS.page('youtube') as page:
+            await page.goto(url, wait_until='domcontentloaded')
 
-        if "consent.youtube.com" in page.url:
-            try:
-                accept_button = page.get_by_text("I agree", exact=True)
-                if await accept_button.count() > 0:
-                    await accept_button.click()
-                    await page.wait_for_load_state('networkidle')
-            except Exception:
-                pass
+            if "consent.youtube.com" in page.url:
+                try:
+                    accept_button = page.get_by_text("I agree", exact=True)
+                    if await accept_button.count() > 0:
+                        await accept_button.click()
+                        await page.wait_for_load_state('domcontentloaded')
+                except Exception:
+                    pass
+            cookies = await page.context.cookies()
 
-        # Не используем куки, так как пользователь просил их убрать
+        # Общий cookies_youtube.txt не используем: yt-dlp получает cookies этой страницы
+        # (с принятым согласием) в своём временном файле
         ydl_opts = get_ydl_opts(quality, use_youtube_cookies=False)
+        if cookies:
+            fd, cookie_path = tempfile.mkstemp(prefix="yt_page_cookies_", suffix=".txt")
+            os.close(fd)
+            temp_cookies_file = Path(cookie_path)
+            _write_youtube_cookiefile(cookie_path, cookies)
+            ydl_opts['cookiefile'] = cookie_path
+        choose_format = fit_format_chooser(quality)
 
         try:
-            temp_file = await asyncio.to_thread(_ydl_download_path, url, ydl_opts)
+            temp_file = await run_ydl_download('youtube', url, ydl_opts, choose_format)
             if temp_file:
                 logger.info(f"Видео скачано через Playwright")
                 return temp_file
@@ -1509,7 +3881,7 @@ async def download_youtube_with_playwright(url: str, quality: str = "720p") -> O
             if "Impersonate target" in str(e) and "not available" in str(e) and ydl_opts.get('impersonate'):
                 ydl_opts_retry = dict(ydl_opts)
                 ydl_opts_retry.pop('impersonate', None)
-                temp_file = await asyncio.to_thread(_ydl_download_path, url, ydl_opts_retry)
+                temp_file = await run_ydl_download('youtube', url, ydl_opts_retry, choose_format)
                 if temp_file:
                     logger.info(f"Видео скачано через Playwright")
                     return temp_file
@@ -1518,8 +3890,6 @@ async def download_youtube_with_playwright(url: str, quality: str = "720p") -> O
     except Exception as e:
         logger.error(f"Ошибка в Playwright: {e}")
     finally:
-        if page:
-            await page.close()
         if temp_cookies_file and temp_cookies_file.exists():
             temp_cookies_file.unlink(missing_ok=True)
     
@@ -1531,9 +3901,10 @@ async def download_rutube(url: str, quality: str = "720p") -> Optional[str]:
     ydl_opts = get_ydl_opts(quality, use_youtube_cookies=False)
     ydl_opts['http_headers'] = dict(ydl_opts.get('http_headers') or {})
     ydl_opts['http_headers']['Referer'] = 'https://rutube.ru/'
+    choose_format = fit_format_chooser(quality)
 
     try:
-        temp_file = await asyncio.to_thread(_ydl_download_path, url, ydl_opts)
+        temp_file = await run_ydl_download('rutube', url, ydl_opts, choose_format)
         if temp_file:
             logger.info("Видео RuTube скачано")
             return temp_file
@@ -1542,7 +3913,7 @@ async def download_rutube(url: str, quality: str = "720p") -> Optional[str]:
             try:
                 ydl_opts_retry = dict(ydl_opts)
                 ydl_opts_retry.pop('impersonate', None)
-                temp_file = await asyncio.to_thread(_ydl_download_path, url, ydl_opts_retry)
+                temp_file = await run_ydl_download('rutube', url, ydl_opts_retry, choose_format)
                 if temp_file:
                     logger.info("Видео RuTube скачано")
                     return temp_file
@@ -1565,10 +3936,12 @@ async def download_tiktok(url: str, quality: str = "720p") -> Optional[str]:
         'ignoreerrors': False,
         'no_warnings': False,
         'quiet': False,
+        'paths': {'temp': PARTIALS_DIR},
+        'continuedl': True,
     }
 
     try:
-        temp_file = await asyncio.to_thread(_ydl_download_path, url, ydl_opts)
+        temp_file = await run_ydl_download('tiktok', url, ydl_opts)
         if temp_file:
             logger.info(f"Видео TikTok скачано")
             return temp_file
@@ -1577,6 +3950,24 @@ async def download_tiktok(url: str, quality: str = "720p") -> Optional[str]:
     
     return None
 
+def _tiktok_photo_urls(info: Any) -> List[str]:
+    """Прямые ссылки на изображения из метаданных yt-dlp (записи слайдшоу или форматы)."""
+    image_exts = ('jpg', 'jpeg', 'png', 'webp')
+    if not isinstance(info, dict):
+        return []
+    urls = []
+    for entry in (info.get('entries') or [info])[:10]:
+        if not isinstance(entry, dict):
+            continue
+        if entry.get('ext') in image_exts and entry.get('url'):
+            urls.append(entry['url'])
+            continue
+        images = [f for f in entry.get('formats') or [] if f.get('ext') in image_exts and f.get('url')]
+        if images:
+            best = max(images, key=lambda f: (f.get('width') or 0) * (f.get('height') or 0))
+            urls.append(best['url'])
+    return urls
+
 async def download_tiktok_photos(url: str) -> Tuple[Optional[List[str]], str]:
     """Скачивание фото с TikTok"""
     logger.info(f"Скачивание фото с TikTok...")
@@ -1592,6 +3983,24 @@ async def download_tiktok_photos(url: str) -> Tuple[Optional[List[str]], str]:
         'playlistend': 10,
     }
 
+    # Сначала только метаданные: ссылки на фото качаем сами параллельно
+    try:
+        info = await asyncio.to_thread(_ydl_probe_info, url, ydl_opts)
+        photo_urls = _tiktok_photo_urls(info)
+        if photo_urls:
+            temp_dir = tempfile.mkdtemp(prefix="tt_photos_")
+            photo_files = await fetch_photos(get_http_session(), photo_urls, temp_dir,
+                                             headers={'User-Agent': 'Mozilla/5.0', 'Referer': 'https://www.tiktok.com/'},
+                                             min_size=1000)
+            if photo_files:
+                description = info.get('description', '') or info.get('title', '')
+                logger.info(f"Скачано {len(photo_files)} фото из TikTok")
+                return photo_files, description
+            import shutil
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    except Exception as e:
+        logger.debug(f"Фото TikTok по ссылкам не получены: {e}")
+    
     try:
         info = await asyncio.to_thread(_ydl_extract_info, url, ydl_opts)
         temp_dir = info.get('id') if isinstance(info, dict) else None
@@ -1610,6 +4019,15 @@ async def download_tiktok_photos(url: str) -> Tuple[Optional[List[str]], str]:
 
 # ==================== INSTAGRAM DOWNLOADER ====================
 
+# Временные папки, созданные текущей попыткой скачивания Instagram
+_IG_TEMP_DIRS: contextvars.ContextVar[Optional[List[str]]] = contextvars.ContextVar('ig_temp_dirs', default=None)
+
+INSTAGRAM_HEDGED = (os.getenv("INSTAGRAM_HEDGED") or "1").strip().lower() in {"1", "true", "yes"}
+# Следующий метод стартует, когда текущий дольше квантиля своих успешных вызовов;
+# INSTAGRAM_HEDGE_DELAY - задержка, пока статистики по методу мало
+INSTAGRAM_HEDGE_DELAY = float(os.getenv("INSTAGRAM_HEDGE_DELAY", 3.0))
+INSTAGRAM_HEDGE_QUANTILE = float(os.getenv("INSTAGRAM_HEDGE_QUANTILE", 0.9))
+
 class InstagramDownloader:
     """Класс для скачивания Instagram контента (Reels, посты, фото)."""
     
@@ -1620,8 +4038,23 @@ class InstagramDownloader:
         'Accept-Language': 'en-US,en;q=0.5',
     }
     
-    def __init__(self):
+    # Пост готов к разбору: есть видео (og:video или <video>) или данные фото.
+    # Данные поста ищутся только в JSON-скриптах, а не во всём innerHTML на каждом опросе
+    _POST_READY_JS = """() => !!document.querySelector('meta[property="og:video"], video')
+        || Array.from(document.querySelectorAll('script[type="application/json"]'))
+            .some(s => s.textContent.includes('"display_url"'))"""
+    
+    def __init__(self, hedged: bool = INSTAGRAM_HEDGED, hedge_delay: float = INSTAGRAM_HEDGE_DELAY,
+                 hedge_quantile: float = INSTAGRAM_HEDGE_QUANTILE):
         self.logger = logging.getLogger('InstagramDownloader')
+        self.hedged = hedged
+        self.hedge_delay = hedge_delay
+        self.hedge_quantile = hedge_quantile
+    
+    def _hedge_delay(self, name: str) -> float:
+        """Сколько ждать метод name до подстраховки: p90 его успешных вызовов по табло."""
+        quantile = METHOD_SCOREBOARD.latency_quantile('instagram', name, self.hedge_quantile)
+        return quantile if quantile is not None else self.hedge_delay
     
     async def download(self, url: str) -> Tuple[Optional[str], Optional[List[str]], str]:
         """
@@ -1642,37 +4075,133 @@ class InstagramDownloader:
         # Определяем тип контента
         is_video_url = any(x in url.lower() for x in ['/reel/', '/reels/', '/tv/'])
         
-        # 2. Пробуем методы последовательно
-        methods = [
+        # 2. Пробуем методы (порядок - по живой статистике табло методов)
+        methods = METHOD_SCOREBOARD.order('instagram', [
             ('yt-dlp', self._method_ytdlp),
             ('Embed API', self._method_embed),
             ('FastDL', self._method_fastdl),
             ('iGram', self._method_igram),
             ('Playwright', self._method_playwright),
-        ]
+        ])
         
-        for name, method in methods:
-            try:
-                self.logger.info(f"Пробуем метод: {name}")
-                result = await method(url)
-                if result[0] or result[1]:  # video или photos
-                    self.logger.info(f"Успех через {name}!")
-                    return result
-            except Exception as e:
-                self.logger.warning(f"Метод {name} не сработал: {e}")
-                continue
+        if self.hedged:
+            result = await self._download_hedged(url, methods)
+            if result:
+                return result
+        else:
+            for name, method in methods:
+                try:
+                    self.logger.info(f"Пробуем метод: {name}")
+                    result, _ = await self._run_tracked(name, method, url)
+                    if result[0] or result[1]:  # video или photos
+                        self.logger.info(f"Успех через {name}!")
+                        return result
+                except Exception as e:
+                    self.logger.warning(f"Метод {name} не сработал: {e}")
+                    continue
         
         self.logger.error("Все методы скачивания Instagram исчерпаны")
         return None, None, ""
     
+    def _mkdtemp(self, prefix: str) -> str:
+        """Создаёт временную папку и запоминает её за текущей попыткой."""
+        temp_dir = tempfile.mkdtemp(prefix=prefix)
+        tracked = _IG_TEMP_DIRS.get()
+        if tracked is not None:
+            tracked.append(temp_dir)
+        return temp_dir
+    
+    def _remove_dirs(self, dirs: List[str]):
+        import shutil
+        for temp_dir in dirs:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    
+    async def _run_tracked(self, name: str, method, url: str) -> Tuple[Tuple[Optional[str], Optional[List[str]], str], List[str]]:
+        """Выполняет метод, собирая созданные им временные папки. Неудачные попытки убирают за собой."""
+        dirs: List[str] = []
+        token = _IG_TEMP_DIRS.set(dirs)
+        started = time.monotonic()
+        try:
+            result = await method(url)
+        except asyncio.CancelledError:
+            # Отменённая попытка ничего не говорит о качестве метода
+            self._remove_dirs(dirs)
+            raise
+        except BaseException:
+            METHOD_SCOREBOARD.record('instagram', name, False, time.monotonic() - started)
+            self._remove_dirs(dirs)
+            raise
+        finally:
+            _IG_TEMP_DIRS.reset(token)
+        success = bool(result[0] or result[1])
+        METHOD_SCOREBOARD.record('instagram', name, success, time.monotonic() - started)
+        if not success:
+            self._remove_dirs(dirs)
+        return result, dirs
+    
+    async def _download_hedged(self, url: str, methods) -> Optional[Tuple[Optional[str], Optional[List[str]], str]]:
+        """Хеджированный запуск: следующий метод стартует, если предыдущие не ответили за hedge_delay.
+        
+        Побеждает первый успешный результат, остальные попытки отменяются и чистят временные папки
+        (папки удаляются только после того, как отменённая попытка реально завершилась).
+        """
+        pending: Dict[asyncio.Task, str] = {}
+        next_index = 0
+        hedge_at = 0.0
+        
+        def launch_next():
+            nonlocal next_index, hedge_at
+            name, method = methods[next_index]
+            next_index += 1
+            self.logger.info(f"Пробуем метод: {name}")
+            pending[asyncio.create_task(self._run_tracked(name, method, url))] = name
+            hedge_at = time.monotonic() + self._hedge_delay(name)
+        
+        launch_next()
+        winner = None
+        try:
+            while pending and winner is None:
+                timeout = max(0.0, hedge_at - time.monotonic()) if next_index < len(methods) else None
+                done, _ = await asyncio.wait(pending.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Текущие методы медлят - подстраховываемся следующим
+                    launch_next()
+                    continue
+                for task in done:
+                    name = pending.pop(task)
+                    try:
+                        result, dirs = task.result()
+                    except Exception as e:
+                        self.logger.warning(f"Метод {name} не сработал: {e}")
+                        continue
+                    if not (result[0] or result[1]):
+                        self.logger.info(f"Метод {name} ничего не нашёл")
+                    elif winner is None:
+                        self.logger.info(f"Успех через {name}!")
+                        winner = result
+                    else:
+                        # Одновременный второй успех не нужен
+                        self._remove_dirs(dirs)
+                if winner is None and not pending and next_index < len(methods):
+                    launch_next()
+            return winner
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                outcomes = await asyncio.gather(*pending.keys(), return_exceptions=True)
+                for outcome in outcomes:
+                    if isinstance(outcome, tuple):
+                        self._remove_dirs(outcome[1])
+    
     async def _expand_share_url(self, url: str) -> Optional[str]:
         """Разворачивает share-ссылку в полный URL."""
         import re
         import aiohttp
         
         try:
-            async with aiohttp.ClientSession(headers=self.HEADERS) as session:
-                async with session.get(url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=10)) as resp:
+            async with http_session() as session:
+                async with session.get(url, headers=self.HEADERS, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=10)) as resp:
                     final_url = str(resp.url)
                     
                     # Очищаем от tracking параметров
@@ -1707,8 +4236,6 @@ class InstagramDownloader:
     async def _download_video(self, video_url: str, session: 'aiohttp.ClientSession' = None, extra_cookies: dict = None) -> Optional[str]:
         """Скачивает видео по прямой ссылке с поддержкой cookies."""
         import aiohttp
-        global IG_CONTEXT
-        
         headers = {
             'User-Agent': self.HEADERS['User-Agent'],
             'Referer': 'https://www.instagram.com/',
@@ -1723,8 +4250,8 @@ class InstagramDownloader:
         else:
             # Пробуем получить cookies из Playwright контекста
             try:
-                if IG_CONTEXT:
-                    cookies = await IG_CONTEXT.cookies()
+                cookies = await BROWSERS.cookies('instagram')
+                if cookies:
                     ig_cookies = {c['name']: c['value'] for c in cookies if 'instagram' in c.get('domain', '')}
                     if ig_cookies:
                         cookie_str = "; ".join(f"{k}={v}" for k, v in ig_cookies.items())
@@ -1734,37 +4261,30 @@ class InstagramDownloader:
         if cookie_str:
             headers['Cookie'] = cookie_str
         
-        close_session = False
         if session is None:
-            session = aiohttp.ClientSession()
-            close_session = True
+            session = get_http_session()
         
         try:
-            async with session.get(video_url, headers=headers, timeout=aiohttp.ClientTimeout(total=60)) as resp:
-                if resp.status == 200:
-                    content = await resp.read()
-                    if len(content) > 10000:  # Минимум 10KB
-                        temp_dir = tempfile.mkdtemp(prefix="ig_")
-                        temp_file = os.path.join(temp_dir, "video.mp4")
-                        with open(temp_file, 'wb') as f:
-                            f.write(content)
-                        self.logger.info(f"Видео скачано: {len(content)} bytes")
-                        return temp_file
-                else:
-                    self.logger.debug(f"Ошибка скачивания: HTTP {resp.status}")
+            temp_dir = self._mkdtemp(prefix="ig_")
+            temp_file = os.path.join(temp_dir, "video.mp4")
+            result = await download_direct(
+                session, video_url, temp_file,
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=60),
+                min_size=10000,  # Минимум 10KB
+                # Путь на CDN стабилен, подпись в query меняется от запроса к запросу
+                resume_key=f"instagram:{urlsplit(video_url).path}",
+            )
+            if result:
+                self.logger.info(f"Видео скачано: {result.size} bytes, sha256 {result.sha256[:12]}")
+                return temp_file
         except Exception as e:
             self.logger.warning(f"Ошибка скачивания видео: {e}")
-        finally:
-            if close_session:
-                await session.close()
         
         return None
     
     async def _download_photos(self, photo_urls: List[str], session: 'aiohttp.ClientSession' = None) -> Optional[List[str]]:
         """Скачивает фото по прямым ссылкам."""
-        import aiohttp
-        global IG_CONTEXT
-        
         headers = {
             'User-Agent': self.HEADERS['User-Agent'],
             'Referer': 'https://www.instagram.com/',
@@ -1775,8 +4295,8 @@ class InstagramDownloader:
         # Собираем cookies
         cookie_str = ""
         try:
-            if IG_CONTEXT:
-                cookies = await IG_CONTEXT.cookies()
+            cookies = await BROWSERS.cookies('instagram')
+            if cookies:
                 ig_cookies = {c['name']: c['value'] for c in cookies if 'instagram' in c.get('domain', '')}
                 if ig_cookies:
                     cookie_str = "; ".join(f"{k}={v}" for k, v in ig_cookies.items())
@@ -1786,46 +4306,15 @@ class InstagramDownloader:
         if cookie_str:
             headers['Cookie'] = cookie_str
         
-        close_session = False
         if session is None:
-            session = aiohttp.ClientSession()
-            close_session = True
+            session = get_http_session()
         
-        downloaded_photos = []
-        temp_dir = tempfile.mkdtemp(prefix="ig_photos_")
+        temp_dir = self._mkdtemp(prefix="ig_photos_")
+        downloaded_photos = await fetch_photos(session, photo_urls, temp_dir, headers=headers)
         
-        try:
-            for i, photo_url in enumerate(photo_urls):
-                try:
-                    async with session.get(photo_url, headers=headers, timeout=aiohttp.ClientTimeout(total=30)) as resp:
-                        if resp.status == 200:
-                            content = await resp.read()
-                            if len(content) > 5000:  # Минимум 5KB для фото
-                                # Определяем расширение
-                                content_type = resp.headers.get('content-type', '')
-                                if 'jpeg' in content_type or 'jpg' in content_type:
-                                    ext = '.jpg'
-                                elif 'png' in content_type:
-                                    ext = '.png'
-                                elif 'webp' in content_type:
-                                    ext = '.webp'
-                                else:
-                                    ext = '.jpg'  # По умолчанию
-                                
-                                temp_file = os.path.join(temp_dir, f"photo_{i+1}{ext}")
-                                with open(temp_file, 'wb') as f:
-                                    f.write(content)
-                                downloaded_photos.append(temp_file)
-                                self.logger.debug(f"Фото {i+1} скачано: {len(content)} bytes")
-                except Exception as e:
-                    self.logger.warning(f"Ошибка скачивания фото {i+1}: {e}")
-            
-            if downloaded_photos:
-                self.logger.info(f"Скачано {len(downloaded_photos)} фото")
-                return downloaded_photos
-        finally:
-            if close_session:
-                await session.close()
+        if downloaded_photos:
+            self.logger.info(f"Скачано {len(downloaded_photos)} фото")
+            return downloaded_photos
         
         return None
     
@@ -1833,7 +4322,7 @@ class InstagramDownloader:
     
     async def _method_ytdlp(self, url: str) -> Tuple[Optional[str], Optional[List[str]], str]:
         """Скачивание через yt-dlp с поддержкой cookies."""
-        temp_dir = tempfile.mkdtemp(prefix="ig_ytdlp_")
+        temp_dir = self._mkdtemp(prefix="ig_ytdlp_")
         
         ydl_opts = {
             'format': 'best[ext=mp4]/best',
@@ -1858,7 +4347,7 @@ class InstagramDownloader:
             self.logger.debug(f"Используем Instagram cookies из {cookie_file}")
         
         try:
-            info = await asyncio.to_thread(self._ytdlp_extract, url, ydl_opts)
+            info = await self._run_ytdlp_thread(url, ydl_opts)
             
             if isinstance(info, dict):
                 description = info.get('description', '') or info.get('title', '')
@@ -1891,11 +4380,34 @@ class InstagramDownloader:
         
         return None, None, ""
     
-    def _ytdlp_extract(self, url: str, opts: dict):
-        """Синхронная обёртка для yt-dlp."""
+    def _ytdlp_extract(self, url: str, opts: dict, cancel: Optional[threading.Event] = None):
+        """Синхронная обёртка для yt-dlp. Взведённый cancel прерывает скачивание из progress hook."""
+        if cancel is not None:
+            def stop_if_cancelled(_status):
+                if cancel.is_set():
+                    raise yt_dlp.utils.DownloadCancelled('попытка отменена')
+            opts = dict(opts, progress_hooks=[*opts.get('progress_hooks', []), stop_if_cancelled])
         with yt_dlp.YoutubeDL(opts) as ydl:
             return ydl.extract_info(url, download=True)
     
+    async def _run_ytdlp_thread(self, url: str, opts: dict):
+        """Поток yt-dlp нельзя отменить снаружи: при отмене просим его остановиться
+        и ждём возврата, чтобы папку попытки не удалили, пока поток в неё пишет."""
+        cancel = threading.Event()
+        job = asyncio.ensure_future(asyncio.to_thread(self._ytdlp_extract, url, opts, cancel))
+        try:
+            return await asyncio.shield(job)
+        except asyncio.CancelledError:
+            cancel.set()
+            while not job.done():
+                try:
+                    await asyncio.wait({job})
+                except asyncio.CancelledError:
+                    pass
+            if not job.cancelled():
+                job.exception()
+            raise
+    
     # ==================== МЕТОД 2: EMBED API ====================
     
     def _get_best_photo_urls(self, photo_urls: List[str]) -> List[str]:
@@ -1961,10 +4473,10 @@ class InstagramDownloader:
             f"https://www.instagram.com/reel/{shortcode}/embed/captioned/",
         ]
         
-        async with aiohttp.ClientSession() as session:
+        async with http_session() as session:
             for embed_url in embed_urls:
                 try:
-                    async with session.get(embed_url, headers=self.HEADERS, timeout=aiohttp.ClientTimeout(total=15)) as resp:
+                    async with await guarded_request(session, 'GET', embed_url, probe_url="https://www.instagram.com/", headers=self.HEADERS, timeout=aiohttp.ClientTimeout(total=15)) as resp:
                         if resp.status != 200:
                             continue
                         
@@ -2041,12 +4553,12 @@ class InstagramDownloader:
             'Referer': 'https://fastdl.app/en',
         }
         
-        async with aiohttp.ClientSession() as session:
+        async with http_session() as session:
             try:
                 form_data = aiohttp.FormData()
                 form_data.add_field('url', url)
                 
-                async with session.post('https://fastdl.app/api/convert', data=form_data, headers=api_headers, timeout=aiohttp.ClientTimeout(total=15)) as resp:
+                async with await guarded_request(session, 'POST', 'https://fastdl.app/api/convert', probe_url='https://fastdl.app/en', data=form_data, headers=api_headers, timeout=aiohttp.ClientTimeout(total=15)) as resp:
                     if resp.status != 200:
                         return None, None, ""
                     
@@ -2105,13 +4617,13 @@ class InstagramDownloader:
             'Referer': 'https://igram.world/',
         }
         
-        async with aiohttp.ClientSession() as session:
+        async with http_session() as session:
             try:
                 form_data = aiohttp.FormData()
                 form_data.add_field('url', url)
                 form_data.add_field('locale', 'en')
                 
-                async with session.post('https://api.igram.world/api/convert', data=form_data, headers=api_headers, timeout=aiohttp.ClientTimeout(total=15)) as resp:
+                async with await guarded_request(session, 'POST', 'https://api.igram.world/api/convert', probe_url='https://api.igram.world/', data=form_data, headers=api_headers, timeout=aiohttp.ClientTimeout(total=15)) as resp:
                     if resp.status != 200:
                         return None, None, ""
                     
@@ -2154,16 +4666,14 @@ class InstagramDownloader:
         
         Извлекает фото/видео напрямую из данных поста, а не перехватывает все сетевые запросы.
         Это исключает попадание рекомендаций, аватарок и других посторонних изображений.
+        Страница пула занята только на время разбора поста, файлы качаются уже без неё.
         """
-        import re
-        global IG_CONTEXT, IG_PLAYWRIGHT_READY
-        
-        if not IG_PLAYWRIGHT_READY or not IG_CONTEXT:
-            self.logger.info("Playwright не инициализирован, пропускаем")
+        if not BROWSERS.available('instagram'):
+            self.logger.info("Playwright недоступен, пропускаем")
             return None, None, ""
         
-        page = None
         captured_video_urls: List[str] = []
+        video_seen = asyncio.Event()
         
         async def on_response(response):
             """Перехват только видео URL из сетевых запросов."""
@@ -2175,120 +4685,26 @@ class InstagramDownloader:
                 if 'video' in content_type.lower() or any(x in url_str for x in ['/o1/v/t16/', '/o1/v/t2/', '.mp4']):
                     if response.url not in captured_video_urls:
                         captured_video_urls.append(response.url)
+                        video_seen.set()
                         self.logger.debug(f"Перехвачен video URL: {response.url[:80]}...")
             except:
                 pass
         
         try:
-            page = await IG_CONTEXT.new_page()
-            page.on('response', on_response)
-            
-            await page.set_viewport_size({"width": 375, "height": 812})
-            
-            # Загружаем страницу
-            await page.goto(url, wait_until='networkidle', timeout=20000)
-            await page.wait_for_timeout(2000)
-            
-            # Пробуем активировать видео
-            try:
-                video_el = page.locator('video')
-                if await video_el.count() > 0:
-                    await video_el.first.click(timeout=2000)
-                    await page.wait_for_timeout(2000)
-            except:
-                pass
-            
-            description = ""
-            try:
-                og_desc = page.locator('meta[property="og:description"]')
-                if await og_desc.count() > 0:
-                    description = await og_desc.first.get_attribute('content') or ""
-            except:
-                pass
+            async with BROWSERS.page('instagram') as page:
+                page.on('response', on_response)
+                try:
+                    video_urls, post_photo_urls, description = await self._extract_playwright_post(
+                        page, url, captured_video_urls, video_seen
+                    )
+                finally:
+                    page.remove_listener('response', on_response)
             
-            # Скачиваем перехваченное видео
-            if captured_video_urls:
-                # Приоритет: /o1/v/t16/ > /o1/v/t2/ > .mp4 > любой
-                best_url = None
-                for pattern in ['/o1/v/t16/', '/o1/v/t2/', '.mp4']:
-                    for u in captured_video_urls:
-                        if pattern in u.lower():
-                            best_url = u
-                            break
-                    if best_url:
-                        break
-                
-                if not best_url:
-                    best_url = captured_video_urls[0]
-                
-                self.logger.info(f"Используем перехваченный video URL: {best_url[:60]}...")
-                video_path = await self._download_video(best_url)
+            for video_url in video_urls:
+                video_path = await self._download_video(video_url)
                 if video_path:
                     return video_path, None, description
             
-            # Fallback: og:video
-            try:
-                og_video = page.locator('meta[property="og:video"], meta[property="og:video:secure_url"]')
-                if await og_video.count() > 0:
-                    video_url = await og_video.first.get_attribute('content')
-                    if video_url:
-                        video_path = await self._download_video(video_url)
-                        if video_path:
-                            return video_path, None, description
-            except:
-                pass
-            
-            # ========== ИЗВЛЕЧЕНИЕ ФОТО ИЗ ДАННЫХ ПОСТА ==========
-            # Вместо перехвата всех сетевых запросов, парсим данные поста напрямую
-            post_photo_urls = []
-            
-            try:
-                # Получаем HTML страницы
-                html_content = await page.content()
-                
-                # Ищем JSON данные поста в различных местах
-                # 1. window._sharedData (старый формат)
-                shared_data_match = re.search(r'window\._sharedData\s*=\s*(\{.+?\});</script>', html_content)
-                if shared_data_match:
-                    try:
-                        import json
-                        shared_data = json.loads(shared_data_match.group(1))
-                        media = shared_data.get('entry_data', {}).get('PostPage', [{}])[0].get('graphql', {}).get('shortcode_media', {})
-                        
-                        # Одиночное фото
-                        if media.get('display_url'):
-                            post_photo_urls.append(media['display_url'])
-                        
-                        # Карусель
-                        edges = media.get('edge_sidecar_to_children', {}).get('edges', [])
-                        for edge in edges:
-                            node = edge.get('node', {})
-                            if node.get('display_url') and not node.get('is_video'):
-                                if node['display_url'] not in post_photo_urls:
-                                    post_photo_urls.append(node['display_url'])
-                    except Exception as e:
-                        self.logger.debug(f"Ошибка парсинга _sharedData: {e}")
-                
-                # 2. Ищем display_url напрямую в HTML (более надёжно)
-                if not post_photo_urls:
-                    # Паттерн для display_url с полным размером
-                    display_urls = re.findall(r'"display_url"\s*:\s*"(https://scontent[^"]+)"', html_content)
-                    for url in display_urls:
-                        clean_url = url.replace('\\u0026', '&').replace('\\/', '/')
-                        # Берём только уникальные URL
-                        if clean_url not in post_photo_urls:
-                            post_photo_urls.append(clean_url)
-                
-                # 3. Ищем в meta тегах og:image (последний fallback)
-                if not post_photo_urls:
-                    og_images = re.findall(r'<meta[^>]+property="og:image"[^>]+content="([^"]+)"', html_content)
-                    for img_url in og_images:
-                        if 'scontent' in img_url and img_url not in post_photo_urls:
-                            post_photo_urls.append(img_url)
-            
-            except Exception as e:
-                self.logger.debug(f"Ошибка извлечения фото из HTML: {e}")
-            
             # Скачиваем найденные фото поста
             if post_photo_urls:
                 # Ограничиваем количество - обычно в посте не больше 10 фото
@@ -2306,12 +4722,120 @@ class InstagramDownloader:
             
         except Exception as e:
             self.logger.error(f"Playwright ошибка: {e}")
-        finally:
-            if page:
-                await page.close()
         
         return None, None, ""
 
+    async def _extract_playwright_post(self, page, url: str, captured_video_urls: List[str],
+                                       video_seen: asyncio.Event) -> Tuple[List[str], List[str], str]:
+        """Открывает пост на странице пула. Возвращает (видео URL по приоритету, фото URL, описание)."""
+        import re
+        
+        # Загружаем страницу и ждём первое из: ответ с видео, og:video/<video>, данные фото поста
+        await page.goto(url, wait_until='domcontentloaded', timeout=20000)
+        await wait_first(
+            video_seen.wait(),
+            page.wait_for_function(self._POST_READY_JS, polling=250),
+        )
+        
+        # Пробуем активировать видео, если его поток ещё не пошёл
+        try:
+            video_el = page.locator('video')
+            if not video_seen.is_set() and await video_el.count() > 0:
+                await video_el.first.click(timeout=2000)
+                await wait_first(video_seen.wait())
+        except:
+            pass
+        
+        description = ""
+        try:
+            og_desc = page.locator('meta[property="og:description"]')
+            if await og_desc.count() > 0:
+                description = await og_desc.first.get_attribute('content') or ""
+        except:
+            pass
+        
+        video_urls: List[str] = []
+        
+        # Перехваченное видео
+        if captured_video_urls:
+            # Приоритет: /o1/v/t16/ > /o1/v/t2/ > .mp4 > любой
+            best_url = None
+            for pattern in ['/o1/v/t16/', '/o1/v/t2/', '.mp4']:
+                for u in captured_video_urls:
+                    if pattern in u.lower():
+                        best_url = u
+                        break
+                if best_url:
+                    break
+            
+            if not best_url:
+                best_url = captured_video_urls[0]
+            
+            self.logger.info(f"Используем перехваченный video URL: {best_url[:60]}...")
+            video_urls.append(best_url)
+        
+        # Fallback: og:video
+        try:
+            og_video = page.locator('meta[property="og:video"], meta[property="og:video:secure_url"]')
+            if await og_video.count() > 0:
+                video_url = await og_video.first.get_attribute('content')
+                if video_url and video_url not in video_urls:
+                    video_urls.append(video_url)
+        except:
+            pass
+        
+        # ========== ИЗВЛЕЧЕНИЕ ФОТО ИЗ ДАННЫХ ПОСТА ==========
+        # Вместо перехвата всех сетевых запросов, парсим данные поста напрямую
+        post_photo_urls = []
+        
+        try:
+            # Получаем HTML страницы
+            html_content = await page.content()
+            
+            # Ищем JSON данные поста в различных местах
+            # 1. window._sharedData (старый формат)
+            shared_data_match = re.search(r'window\._sharedData\s*=\s*(\{.+?\});</script>', html_content)
+            if shared_data_match:
+                try:
+                    shared_data = json.loads(shared_data_match.group(1))
+                    media = shared_data.get('entry_data', {}).get('PostPage', [{}])[0].get('graphql', {}).get('shortcode_media', {})
+                    
+                    # Одиночное фото
+                    if media.get('display_url'):
+                        post_photo_urls.append(media['display_url'])
+                    
+                    # Карусель
+                    edges = media.get('edge_sidecar_to_children', {}).get('edges', [])
+                    for edge in edges:
+                        node = edge.get('node', {})
+                        if node.get('display_url') and not node.get('is_video'):
+                            if node['display_url'] not in post_photo_urls:
+                                post_photo_urls.append(node['display_url'])
+                except Exception as e:
+                    self.logger.debug(f"Ошибка парсинга _sharedData: {e}")
+            
+            # 2. Ищем display_url напрямую в HTML (более надёжно)
+            if not post_photo_urls:
+                # Паттерн для display_url с полным размером
+                display_urls = re.findall(r'"display_url"\s*:\s*"(https://scontent[^"]+)"', html_content)
+                for raw_url in display_urls:
+                    clean_url = raw_url.replace('\\u0026', '&').replace('\\/', '/')
+                    # Берём только уникальные URL
+                    if clean_url not in post_photo_urls:
+                        post_photo_urls.append(clean_url)
+            
+            # 3. Ищем в meta тегах og:image (последний fallback)
+            if not post_photo_urls:
+                og_images = re.findall(r'<meta[^>]+property="og:image"[^>]+content="([^"]+)"', html_content)
+                for img_url in og_images:
+                    if 'scontent' in img_url and img_url not in post_photo_urls:
+                        post_photo_urls.append(img_url)
+        
+        except Exception as e:
+            self.logger.debug(f"Ошибка извлечения фото из HTML: {e}")
+        
+        return video_urls, post_photo_urls, description
+
 
 # Глобальный экземпляр загрузчика
 _instagram_downloader = InstagramDownloader()
@@ -2331,7 +4855,7 @@ async def expand_instagram_share_url(url: str) -> Optional[str]:
 async def upload_to_0x0(file_path: str) -> Optional[str]:
     url = (os.getenv('ZEROX0_URL') or 'https://0x0.st').strip()
     try:
-        async with aiohttp.ClientSession() as session:
+        async with http_session() as session:
             with open(file_path, 'rb') as f:
                 data = aiohttp.FormData()
                 data.add_field('file', f, filename=Path(file_path).name)
@@ -2347,7 +4871,7 @@ async def upload_to_0x0(file_path: str) -> Optional[str]:
 async def upload_to_uguu(file_path: str) -> Optional[str]:
     url = (os.getenv('UGUU_URL') or 'https://uguu.se/upload').strip()
     try:
-        async with aiohttp.ClientSession() as session:
+        async with http_session() as session:
             with open(file_path, 'rb') as f:
                 data = aiohttp.FormData()
                 data.add_field('files[]', f, filename=Path(file_path).name)
@@ -2395,7 +4919,7 @@ async def upload_to_fileio(file_path: str) -> Optional[str]:
         return None
 
     try:
-        async with aiohttp.ClientSession() as session:
+        async with http_session() as session:
             for url in url_candidates:
                 try:
                     with open(file_path, 'rb') as f:
@@ -2424,7 +4948,271 @@ async def upload_to_fileio(file_path: str) -> Optional[str]:
     except Exception as e:
         logger.error(f"Ошибка загрузки на file.io: {e}")
     
-    return None
+    return None
+
+# ==================== MP4 МЕТАДАННЫЕ ====================
+# Разбор верхнего уровня MP4 по заголовкам боксов: несколько seek вместо
+# запуска ffmpeg. Если moov уже перед mdat, файл не фрагментирован и
+# длительность известна - перепаковка не нужна.
+
+MP4_MAX_MOOV_SIZE = 64 * 1024 * 1024  # больший moov не читаем в память
+
+class Mp4Info:
+    def __init__(self):
+        self.boxes: List[Tuple[str, int, int]] = []  # (тип, смещение, размер) верхнего уровня
+        self.faststart = False
+        self.fragmented = False
+        self.duration: Optional[float] = None
+        self.width: Optional[int] = None
+        self.height: Optional[int] = None
+
+    @property
+    def needs_remux(self) -> bool:
+        return not self.faststart or self.fragmented or not self.duration
+
+def _iter_boxes(data: bytes, start: int = 0, end: Optional[int] = None):
+    """Дочерние боксы внутри буфера: (тип, начало тела, конец бокса)."""
+    end = len(data) if end is None else end
+    pos = start
+    while pos + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', data, pos)
+        header = 8
+        if size == 1:
+            if pos + 16 > end:
+                return
+            size = struct.unpack_from('>Q', data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            return
+        yield kind.decode('latin-1'), pos + header, pos + size
+        pos += size
+
+def _parse_moov(moov: bytes, info: Mp4Info):
+    for kind, body, end in _iter_boxes(moov):
+        if kind == 'mvhd':
+            version = moov[body]
+            if version == 1:
+                timescale, duration = struct.unpack_from('>IQ', moov, body + 20)
+            else:
+                timescale, duration = struct.unpack_from('>II', moov, body + 12)
+            if timescale and duration and duration not in (0xFFFFFFFF, 0xFFFFFFFFFFFFFFFF):
+                info.duration = duration / timescale
+        elif kind == 'mvex':
+            info.fragmented = True
+        elif kind == 'trak' and info.width is None:
+            size = None
+            is_video = False
+            for child, child_body, child_end in _iter_boxes(moov, body, end):
+                if child == 'tkhd' and child_end - child_body >= 84:
+                    # Ширина и высота - последние 8 байт tkhd в формате 16.16
+                    width, height = struct.unpack_from('>II', moov, child_end - 8)
+                    size = (width >> 16, height >> 16)
+                elif child == 'mdia':
+                    for sub, sub_body, sub_end in _iter_boxes(moov, child_body, child_end):
+                        if sub == 'hdlr' and moov[sub_body + 8:sub_body + 12] == b'vide':
+                            is_video = True
+            if is_video and size and all(size):
+                info.width, info.height = size
+
+def probe_mp4(file_path: str) -> Optional[Mp4Info]:
+    """Сканирует боксы верхнего уровня. None - не MP4 или файл повреждён."""
+    info = Mp4Info()
+    try:
+        file_size = os.path.getsize(file_path)
+        with open(file_path, 'rb') as f:
+            pos = 0
+            moov_at = None
+            while pos + 8 <= file_size:
+                f.seek(pos)
+                header = f.read(16)
+                size, kind = struct.unpack_from('>I4s', header)
+                header_size = 8
+                if size == 1:
+                    size = struct.unpack_from('>Q', header, 8)[0]
+                    header_size = 16
+                elif size == 0:
+                    size = file_size - pos
+                if size < header_size:
+                    return None
+                info.boxes.append((kind.decode('latin-1'), pos, size))
+                if kind == b'moov':
+                    moov_at = (pos + header_size, size - header_size)
+                pos += size
+            if not info.boxes or info.boxes[0][0] != 'ftyp':
+                return None
+            kinds = [box[0] for box in info.boxes]
+            if 'moof' in kinds:
+                info.fragmented = True
+            if moov_at is None:
+                return info
+            info.faststart = 'mdat' not in kinds or kinds.index('moov') < kinds.index('mdat')
+            if moov_at[1] <= MP4_MAX_MOOV_SIZE:
+                f.seek(moov_at[0])
+                _parse_moov(f.read(moov_at[1]), info)
+    except (OSError, struct.error, IndexError):
+        return None
+    return info
+
+FASTSTART_BUFFER_SIZE = 1024 * 1024
+_STBL_PATH_BOXES = {'moov', 'trak', 'mdia', 'minf', 'stbl'}
+
+def _patch_chunk_offsets(moov: bytearray, start: int, end: int, moov_start: int, shift: int) -> bool:
+    """Сдвигает stco/co64 на shift для данных, лежавших до moov. False - нужен переход stco на co64."""
+    for kind, body, box_end in _iter_boxes(moov, start, end):
+        if kind in _STBL_PATH_BOXES:
+            if not _patch_chunk_offsets(moov, body, box_end, moov_start, shift):
+                return False
+        elif kind in ('stco', 'co64'):
+            count = struct.unpack_from('>I', moov, body + 4)[0]
+            fmt, width = ('>I', 4) if kind == 'stco' else ('>Q', 8)
+            if body + 8 + count * width > box_end:
+                return False
+            for i in range(count):
+                pos = body + 8 + i * width
+                offset = struct.unpack_from(fmt, moov, pos)[0]
+                if offset < moov_start:
+                    offset += shift
+                if kind == 'stco' and offset > 0xFFFFFFFF:
+                    return False
+                struct.pack_into(fmt, moov, pos, offset)
+    return True
+
+def faststart_mp4(src_path: str, dst_path: str, info: Optional[Mp4Info] = None) -> bool:
+    """Переносит moov перед mdat без ffmpeg. False - случай не поддержан, нужен ffmpeg."""
+    info = info or probe_mp4(src_path)
+    if not info or info.faststart or info.fragmented:
+        return False
+    kinds = [box[0] for box in info.boxes]
+    if kinds.count('moov') != 1 or kinds[0] != 'ftyp':
+        return False
+    _, moov_start, moov_size = info.boxes[kinds.index('moov')]
+    if moov_size > MP4_MAX_MOOV_SIZE:
+        return False
+    
+    with open(src_path, 'rb') as src:
+        src.seek(moov_start)
+        moov = bytearray(src.read(moov_size))
+        header = 16 if struct.unpack_from('>I', moov)[0] == 1 else 8
+        # Сжатый moov (cmov) и прочую экзотику оставляем ffmpeg
+        if any(kind == 'cmov' for kind, _, _ in _iter_boxes(moov, header)):
+            return False
+        if not _patch_chunk_offsets(moov, header, len(moov), moov_start, moov_size):
+            return False
+        
+        buffer = memoryview(bytearray(FASTSTART_BUFFER_SIZE))
+        with open(dst_path, 'wb') as dst:
+            for index, (kind, offset, size) in enumerate(info.boxes):
+                if kind == 'moov':
+                    continue
+                src.seek(offset)
+                remaining = size
+                while remaining:
+                    read = src.readinto(buffer[:min(remaining, FASTSTART_BUFFER_SIZE)])
+                    if not read:
+                        raise OSError("файл обрезан")
+                    dst.write(buffer[:read])
+                    remaining -= read
+                if index == 0:
+                    dst.write(moov)
+    return True
+
+def video_send_kwargs(file_path: str) -> Dict[str, int]:
+    """duration/width/height для send_video, чтобы Telegram не угадывал их сам."""
+    info = probe_mp4(file_path)
+    if not info:
+        return {}
+    kwargs = {}
+    if info.duration:
+        kwargs['duration'] = max(1, int(round(info.duration)))
+    if info.width and info.height:
+        kwargs['width'] = info.width
+        kwargs['height'] = info.height
+    return kwargs
+
+# ==================== FFMPEG ====================
+# Процессы ffmpeg запускаются через asyncio.create_subprocess_exec и не
+# занимают поток пула. Одновременно работает не больше FFMPEG_CONCURRENCY
+# процессов (по числу ядер), при отмене или таймауте процесс убивается.
+# CPU время задачи берётся из вывода -benchmark.
+
+class FfmpegResult:
+    def __init__(self, returncode: int, stderr: str, wall_time: float, cpu_time: Optional[float]):
+        self.returncode = returncode
+        self.stderr = stderr
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+
+class FfmpegPool:
+    """Ограниченный пул асинхронных процессов ffmpeg."""
+
+    def __init__(self, concurrency: int = FFMPEG_CONCURRENCY):
+        self.concurrency = max(1, concurrency)
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self.running = 0
+        self.jobs = 0
+        self.failures = 0
+        self.cpu_seconds = 0.0
+
+    @staticmethod
+    def binary() -> Optional[str]:
+        import shutil
+        return shutil.which('ffmpeg')
+
+    @staticmethod
+    def unique_output(directory: str, suffix: str = '.mp4', prefix: str = 'ffmpeg_') -> str:
+        """Резервирует уникальное имя выходного файла: параллельные задачи не перезапишут друг друга."""
+        fd, path = tempfile.mkstemp(suffix=suffix, prefix=prefix, dir=directory or os.curdir)
+        os.close(fd)
+        return path
+
+    @staticmethod
+    def _cpu_time(stderr: str) -> Optional[float]:
+        import re
+        match = re.search(r'bench:\s+utime=([\d.]+)s\s+stime=([\d.]+)s', stderr)
+        return float(match.group(1)) + float(match.group(2)) if match else None
+
+    async def run(self, args: List[str], timeout: float = FFMPEG_TIMEOUT) -> FfmpegResult:
+        """Запускает ffmpeg с аргументами args (без имени программы). Возвращает код, stderr и время."""
+        ffmpeg_path = self.binary()
+        if not ffmpeg_path:
+            raise FileNotFoundError("ffmpeg не найден")
+        async with self._semaphore:
+            self.running += 1
+            started = time.monotonic()
+            process = await asyncio.create_subprocess_exec(
+                ffmpeg_path, '-hide_banner', '-nostdin', '-benchmark', *args,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            try:
+                _, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+            except BaseException:
+                # Таймаут или отмена задачи: процесс не должен пережить её
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                self.failures += 1
+                raise
+            finally:
+                self.running -= 1
+                self.jobs += 1
+        text = stderr.decode('utf-8', errors='ignore') if stderr else ''
+        result = FfmpegResult(process.returncode, text, time.monotonic() - started, self._cpu_time(text))
+        if result.returncode != 0:
+            self.failures += 1
+        if result.cpu_time:
+            self.cpu_seconds += result.cpu_time
+        return result
+
+    def metrics_text(self) -> str:
+        return (f"ffmpeg_running {self.running}\n"
+                f"ffmpeg_jobs_total {self.jobs}\n"
+                f"ffmpeg_failures_total {self.failures}\n"
+                f"ffmpeg_cpu_seconds_total {self.cpu_seconds:.3f}\n")
+
+FFMPEG_POOL = FfmpegPool()
 
 async def fix_video_for_telegram(file_path: str) -> Optional[str]:
     """Исправляет метаданные видео для корректного воспроизведения в Telegram.
@@ -2436,23 +5224,41 @@ async def fix_video_for_telegram(file_path: str) -> Optional[str]:
     
     Эта функция использует ffmpeg для перепаковки видео с правильными метаданными.
     """
-    import subprocess
-    import shutil
+    # Файл уже faststart с известной длительностью - копировать его незачем
+    if file_path.lower().endswith(('.mp4', '.mov')):
+        info = await asyncio.to_thread(probe_mp4, file_path)
+        if info and not info.needs_remux:
+            logger.debug(f"MP4 уже faststart ({info.duration:.1f}с), ffmpeg не нужен")
+            return file_path
+        # moov в конце обычного MP4 - переносим сами, без процесса ffmpeg
+        if info and info.duration and not info.fragmented:
+            fixed_file = FfmpegPool.unique_output(os.path.dirname(file_path), prefix='faststart_')
+            try:
+                if await asyncio.to_thread(faststart_mp4, file_path, fixed_file, info):
+                    logger.info(f"moov перенесён в начало без ffmpeg: {fixed_file}")
+                    try:
+                        os.remove(file_path)
+                    except Exception:
+                        pass
+                    return fixed_file
+            except Exception as e:
+                logger.warning(f"Ошибка переноса moov, пробуем ffmpeg: {e}")
+            try:
+                os.remove(fixed_file)
+            except OSError:
+                pass
     
-    # Проверяем наличие ffmpeg
-    ffmpeg_path = shutil.which('ffmpeg')
-    if not ffmpeg_path:
+    if not FFMPEG_POOL.binary():
         logger.warning("ffmpeg не найден в системе, пропускаем исправление метаданных")
         return file_path
     
+    fixed_file = None
     try:
-        # Создаём временный файл для выходного видео
-        temp_dir = os.path.dirname(file_path)
-        fixed_file = os.path.join(temp_dir, "fixed_video.mp4")
+        # Уникальное имя рядом с исходником
+        fixed_file = FfmpegPool.unique_output(os.path.dirname(file_path), prefix='fixed_')
         
-        # ffmpeg команда для перепаковки с moov atom в начале
-        cmd = [
-            ffmpeg_path,
+        # Перепаковка с moov atom в начале
+        args = [
             '-y',  # Перезаписать без запроса
             '-i', file_path,
             '-c', 'copy',  # Копируем потоки без перекодирования (быстро)
@@ -2462,19 +5268,13 @@ async def fix_video_for_telegram(file_path: str) -> Optional[str]:
         ]
         
         logger.info("Исправление метаданных видео через ffmpeg...")
+        result = await FFMPEG_POOL.run(args)
         
-        # Запускаем ffmpeg
-        process = await asyncio.to_thread(
-            subprocess.run,
-            cmd,
-            capture_output=True,
-            timeout=60
-        )
-        
-        if process.returncode == 0 and os.path.exists(fixed_file):
+        if result.returncode == 0 and os.path.exists(fixed_file):
             fixed_size = os.path.getsize(fixed_file)
             if fixed_size > 10000:  # Минимум 10KB
-                logger.info(f"Видео исправлено: {fixed_file} ({fixed_size} bytes)")
+                cpu = f", CPU {result.cpu_time:.2f}с" if result.cpu_time is not None else ""
+                logger.info(f"Видео исправлено: {fixed_file} ({fixed_size} bytes, {result.wall_time:.2f}с{cpu})")
                 # Удаляем оригинальный файл
                 try:
                     os.remove(file_path)
@@ -2483,59 +5283,746 @@ async def fix_video_for_telegram(file_path: str) -> Optional[str]:
                 return fixed_file
             else:
                 logger.warning(f"Исправленный файл слишком маленький: {fixed_size} bytes")
-                try:
-                    os.remove(fixed_file)
-                except Exception:
-                    pass
         else:
-            stderr = process.stderr.decode('utf-8', errors='ignore') if process.stderr else ''
-            logger.warning(f"ffmpeg вернул код {process.returncode}: {stderr[:200]}")
+            logger.warning(f"ffmpeg вернул код {result.returncode}: {result.stderr[-200:]}")
             
-    except subprocess.TimeoutExpired:
+    except asyncio.TimeoutError:
         logger.warning("ffmpeg таймаут при исправлении видео")
+    except asyncio.CancelledError:
+        if fixed_file:
+            _remove_quietly(fixed_file)
+        raise
     except Exception as e:
         logger.warning(f"Ошибка при исправлении видео: {e}")
     
+    if fixed_file:
+        _remove_quietly(fixed_file)
     return file_path
 
-async def send_video_or_message(chat_id: int, file_path: str, caption: str = ""):
-    """Отправка видео или файла"""
-    max_telegram_file_size = 50 * 1024 * 1024
+# ==================== КЭШ FILE_ID ====================
+# Популярные ролики запрашивают многие пользователи. После первой отправки
+# Telegram возвращает file_id, по которому файл можно переслать без скачивания.
+
+class FileIdCache:
+    """Персистентный кэш file_id Telegram по каноническому ID медиа и качеству."""
+
+    def __init__(self, file_path: str = FILE_ID_CACHE_FILE, ttl: int = FILE_ID_CACHE_TTL,
+                 max_entries: int = FILE_ID_CACHE_MAX_ENTRIES):
+        self.file_path = file_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries: Dict[str, dict] = {}
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        try:
+            data = _read_json_file(self.file_path) or {}
+            now = time.time()
+            fresh = [(k, v) for k, v in data.items()
+                     if isinstance(v, dict) and now - v.get('created', 0) < self.ttl]
+            # Порядок словаря - порядок создания: вытеснение берёт записи с начала
+            fresh.sort(key=lambda kv: kv[1].get('created', 0))
+            self.entries = dict(fresh)
+            logger.info(f"Загружено {len(self.entries)} file_id из кэша")
+        except Exception as e:
+            logger.error(f"Ошибка загрузки кэша file_id: {e}")
+            self.entries = {}
+
+    def get(self, key: Optional[str]) -> Optional[dict]:
+        if not key:
+            return None
+        entry = self.entries.get(key)
+        if entry and time.time() - entry.get('created', 0) >= self.ttl:
+            self.invalidate(key)
+            entry = None
+        if entry:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return entry
+
+    def put(self, key: Optional[str], kind: str, file_ids: List[str]):
+        if not key or not file_ids:
+            return
+        # Перезапись переносит ключ в конец, поэтому начало словаря - самые старые записи
+        self.entries.pop(key, None)
+        self.entries[key] = {'kind': kind, 'file_ids': list(file_ids), 'created': time.time()}
+        while len(self.entries) > self.max_entries:
+            self.entries.pop(next(iter(self.entries)))
+        self.dirty = True
+
+    def invalidate(self, key: Optional[str]):
+        if key and self.entries.pop(key, None) is not None:
+            self.dirty = True
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+        snapshot = dict(self.entries)
+        try:
+            await asyncio.to_thread(_atomic_write_json, self.file_path, snapshot)
+        except Exception as e:
+            self.dirty = True
+            logger.error(f"Ошибка сохранения кэша file_id: {e}")
+
+    def metrics_text(self) -> str:
+        return (f"file_id_cache_entries {len(self.entries)}\n"
+                f"file_id_cache_hits_total {self.hits}\n"
+                f"file_id_cache_misses_total {self.misses}\n")
+
+FILE_ID_CACHE = FileIdCache()
+
+def canonical_media_key(platform: str, url: str, quality: str = "") -> Optional[str]:
+    """Строит ключ кэша вида platform:media_id[:quality]. None - если ID не распознан."""
+    import re
+    media_id = None
+    if platform == "youtube":
+        media_id = extract_youtube_video_id(url)
+    elif platform == "rutube":
+        match = re.search(r'rutube\.ru/(?:video|shorts|play/embed)/([a-zA-Z0-9]+)', url)
+        media_id = match.group(1) if match else None
+    elif platform == "tiktok":
+        match = re.search(r'/(?:video|photo)/(\d+)', url)
+        if match:
+            media_id = match.group(1)
+        else:
+            # Короткие ссылки vm./vt.tiktok.com стабильны для одного ролика
+            match = re.search(r'(v[mt]\.tiktok\.com/[A-Za-z0-9]+)', url)
+            media_id = match.group(1) if match else None
+    elif platform == "instagram":
+        media_id = _instagram_downloader._extract_shortcode(url)
+    if not media_id:
+        return None
+    # Instagram и TikTok качают без выбора качества
+    if platform in ("youtube", "rutube"):
+        return f"{platform}:{media_id}:{quality}"
+    return f"{platform}:{media_id}"
+
+async def send_cached_media(chat_id: int, cache_key: Optional[str]) -> bool:
+    """Отправляет медиа по сохранённым file_id. False - если кэша нет или file_id устарел."""
+    entry = FILE_ID_CACHE.get(cache_key)
+    if not entry:
+        return False
+    kind = entry.get('kind')
+    file_ids = entry.get('file_ids') or []
+    try:
+        if kind == 'video':
+            await bot.send_video(chat_id=chat_id, video=file_ids[0], supports_streaming=True)
+        elif kind == 'photo':
+            await bot.send_photo(chat_id=chat_id, photo=file_ids[0])
+        elif kind == 'document':
+            await bot.send_document(chat_id=chat_id, document=file_ids[0])
+        elif kind == 'album':
+            media_group = [InputMediaPhoto(media=file_id) for file_id in file_ids]
+            batch_size = 10
+            for i in range(0, len(media_group), batch_size):
+                await bot.send_media_group(chat_id=chat_id, media=media_group[i:i + batch_size])
+        else:
+            FILE_ID_CACHE.invalidate(cache_key)
+            return False
+        logger.info(f"Отправлено из кэша file_id: {cache_key}")
+        return True
+    except TelegramBadRequest as e:
+        logger.warning(f"Telegram отклонил file_id для {cache_key}: {e}")
+        FILE_ID_CACHE.invalidate(cache_key)
+        return False
+
+async def send_photo_album(chat_id: int, photos: List[str], cache_key: Optional[str] = None):
+    """Отправляет фото альбомами по 10 и запоминает их file_id."""
+    media_group = [InputMediaPhoto(media=FSInputFile(photo)) for photo in photos]
+    file_ids: List[str] = []
+    
+    batch_size = 10
+    for i in range(0, len(media_group), batch_size):
+        batch = media_group[i:i + batch_size]
+        sent_messages = await bot.send_media_group(chat_id=chat_id, media=batch)
+        for sent in sent_messages or []:
+            if sent.photo:
+                file_ids.append(sent.photo[-1].file_id)
+    
+    if len(file_ids) == len(photos):
+        FILE_ID_CACHE.put(cache_key, 'album', file_ids)
+
+async def send_video_or_message(chat_id: int, file_path: str, caption: str = "", cache_key: Optional[str] = None,
+                                fix_video: bool = True, link_cache: Optional[Dict[str, str]] = None):
+    """Отправка видео или файла. link_cache - уже выданные внешние ссылки на большие файлы {путь: ссылка}."""
+    max_telegram_file_size = TELEGRAM_FILE_LIMIT
     file_size = os.path.getsize(file_path)
     
     # Исправляем метаданные видео для корректного отображения в Telegram
-    if file_path.lower().endswith(('.mp4', '.mkv', '.webm', '.mov')):
+    if fix_video and file_path.lower().endswith(('.mp4', '.mkv', '.webm', '.mov')):
         fixed_path = await fix_video_for_telegram(file_path)
         if fixed_path and fixed_path != file_path:
             file_path = fixed_path
             file_size = os.path.getsize(file_path)
     
     if file_size > max_telegram_file_size:
-        link = await upload_to_0x0(file_path)
+        link = link_cache.get(file_path) if link_cache is not None else None
         if not link:
-            link = await upload_to_uguu(file_path)
+            link = await upload_to_0x0(file_path)
+            if not link:
+                link = await upload_to_uguu(file_path)
+            if link and link_cache is not None:
+                link_cache[file_path] = link
         if link:
             await bot.send_message(chat_id, f"Файл слишком большой для Telegram.\nСсылка: {link}")
         else:
             await bot.send_message(chat_id, "Не удалось загрузить файл.")
     else:
         input_file = FSInputFile(file_path)
+        video_kwargs = await asyncio.to_thread(video_send_kwargs, file_path)
         try:
-            await bot.send_video(chat_id=chat_id, video=input_file, caption=caption, supports_streaming=True)
+            sent = await bot.send_video(chat_id=chat_id, video=input_file, caption=caption, supports_streaming=True,
+                                        **video_kwargs)
+            if sent.video:
+                FILE_ID_CACHE.put(cache_key, 'video', [sent.video.file_id])
+            elif sent.document:
+                FILE_ID_CACHE.put(cache_key, 'document', [sent.document.file_id])
         except TelegramBadRequest as e:
             if "Wrong type of the web page content" in str(e):
                 try:
-                    await bot.send_photo(chat_id=chat_id, photo=input_file, caption=caption)
+                    sent = await bot.send_photo(chat_id=chat_id, photo=input_file, caption=caption)
+                    if sent.photo:
+                        FILE_ID_CACHE.put(cache_key, 'photo', [sent.photo[-1].file_id])
                 except TelegramBadRequest:
-                    await bot.send_document(chat_id=chat_id, document=input_file, caption=caption)
+                    sent = await bot.send_document(chat_id=chat_id, document=input_file, caption=caption)
+                    if sent.document:
+                        FILE_ID_CACHE.put(cache_key, 'document', [sent.document.file_id])
             else:
                 # Пробуем отправить как документ при любой другой ошибке
                 try:
-                    await bot.send_document(chat_id=chat_id, document=input_file, caption=caption)
+                    sent = await bot.send_document(chat_id=chat_id, document=input_file, caption=caption)
+                    if sent.document:
+                        FILE_ID_CACHE.put(cache_key, 'document', [sent.document.file_id])
                 except Exception:
                     await bot.send_message(chat_id, f"Ошибка при отправке файла.")
 
 
+# ==================== ОБЪЕДИНЕНИЕ ЗАГРУЗОК ====================
+# Когда ссылка "взрывается", десятки пользователей присылают её одновременно.
+# Первый запрос качает, остальные ждут тот же результат.
+
+MediaResult = Tuple[Optional[str], Optional[List[str]], str]
+
+PLATFORM_TITLES = {
+    "youtube": "YouTube",
+    "rutube": "RuTube",
+    "tiktok": "TikTok",
+    "instagram": "Instagram",
+}
+
+TRACKING_QUERY_PARAMS = {'si', 'feature', 'igsh', 'igshid', 'is_from_webapp', 'sender_device', 'pp'}
+
+def canonical_url(url: str) -> str:
+    """Убирает из ссылки фрагмент и трекинговые параметры."""
+    try:
+        parts = urlsplit(url.strip())
+        query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                 if k not in TRACKING_QUERY_PARAMS and not k.startswith('utm_')]
+        netloc = parts.netloc.lower()
+        if netloc.startswith('m.'):
+            netloc = 'www.' + netloc[2:]
+        return urlunsplit((parts.scheme.lower(), netloc, parts.path.rstrip('/'), urlencode(query), ''))
+    except Exception:
+        return url.strip()
+
+class _Flight:
+    def __init__(self, future: 'asyncio.Future'):
+        self.future = future
+        self.waiters = 0
+        # Первая отправка идёт под замком: она загружает файл в Telegram (или на внешний
+        # хостинг). После неё остальные получатели шлют параллельно по file_id или ссылке
+        self.send_lock = asyncio.Lock()
+        self.uploaded = False
+        self.external_links: Dict[str, str] = {}
+        # Уровень очереди и задача планировщика: присоединившийся премиум поднимает уровень
+        self.tier = TIER_FREE
+        self.job: Optional['DownloadJob'] = None
+        # Статусы "вы в очереди" всех получателей, а не только лидера
+        self.queue_listeners: List[Callable[[int], Awaitable[None]]] = []
+
+    async def notify_queued(self, position: int):
+        for listener in list(self.queue_listeners):
+            try:
+                await listener(position)
+            except Exception:
+                pass
+
+class FlightAbortedError(Exception):
+    """Лидер общей загрузки отменён, не получив результата."""
+
+class DownloadCoalescer:
+    """Реестр загрузок "в полёте": одна загрузка на ключ, остальные ждут её результат."""
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self.coalesced = 0
+
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    async def run(self, key: str, factory: Callable[['_Flight'], Awaitable[MediaResult]],
+                  tier: Optional[str] = None,
+                  on_queued: Optional[Callable[[int], Awaitable[None]]] = None) -> Tuple[MediaResult, _Flight]:
+        """factory получает объект полёта, должна привязать к нему задачу планировщика (flight.job)
+        и передать планировщику flight.notify_queued, чтобы позицию в очереди видели все получатели."""
+        flight = self._flights.get(key)
+        if flight is not None:
+            flight.waiters += 1
+            self.coalesced += 1
+            logger.info(f"Присоединяемся к уже идущей загрузке: {key}")
+            if tier and DOWNLOAD_SCHEDULER.outranks(tier, flight.tier):
+                flight.tier = tier
+                if flight.job is not None:
+                    DOWNLOAD_SCHEDULER.promote(flight.job, tier)
+            if on_queued:
+                flight.queue_listeners.append(on_queued)
+                position = DOWNLOAD_SCHEDULER.position(flight.job) if flight.job is not None else 0
+                if position:
+                    try:
+                        await on_queued(position)
+                    except Exception:
+                        pass
+            try:
+                return await asyncio.shield(flight.future), flight
+            except FlightAbortedError:
+                # Лидер отменён (например, его пользователь ушёл): загрузку ведёт
+                # первый из ожидавших, остальные присоединяются к нему
+                logger.info(f"Лидер загрузки {key} отменён, выбираем нового")
+                return await self.run(key, factory, tier, on_queued)
+            except asyncio.CancelledError:
+                future = flight.future
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    # Лидер уже учёл нас во владельцах файлов
+                    release_media(future.result())
+                else:
+                    flight.waiters -= 1
+                raise
+
+        flight = _Flight(asyncio.get_running_loop().create_future())
+        flight.tier = tier or TIER_FREE
+        if on_queued:
+            flight.queue_listeners.append(on_queued)
+        self._flights[key] = flight
+        try:
+            result = await factory(flight)
+        except BaseException as e:
+            self._flights.pop(key, None)
+            if isinstance(e, Exception):
+                flight.future.set_exception(e)
+                if flight.waiters == 0:
+                    flight.future.exception()
+            else:
+                # Ожидающие не должны получить голый CancelledError
+                flight.future.set_exception(FlightAbortedError(key))
+                if flight.waiters == 0:
+                    flight.future.exception()
+            raise
+        self._flights.pop(key, None)
+        retain_media(result, flight.waiters)
+        flight.future.set_result(result)
+        return result, flight
+
+DOWNLOAD_COALESCER = DownloadCoalescer()
+
+def retain_media(result: MediaResult, count: int):
+    video_path, photos, _ = result
+    retain_file(video_path, count)
+    for photo in photos or []:
+        retain_file(photo, count)
+
+def release_media(result: MediaResult):
+    video_path, photos, _ = result
+    if video_path:
+        cleanup_file(video_path)
+    if photos:
+        cleanup_files(photos)
+
+async def download_media(platform: str, url: str, quality: str) -> MediaResult:
+    """Скачивает медиа с платформы и готовит видео к отправке в Telegram."""
+    video_path: Optional[str] = None
+    photos: Optional[List[str]] = None
+    description = ""
+    
+    if platform == "youtube":
+        video_path = await download_youtube(url, quality)
+        if not video_path:
+            video_path = await download_youtube_with_playwright(url, quality)
+    elif platform == "rutube":
+        video_path = await download_rutube(url, quality)
+    elif platform == "tiktok":
+        if '/photo/' in url.lower():
+            photos, description = await download_tiktok_photos(url)
+        else:
+            video_path = await download_tiktok(url, quality)
+    elif platform == "instagram":
+        video_path, photos, description = await download_instagram(url)
+    
+    # Исправляем видео один раз для всех получателей
+    if video_path and video_path.lower().endswith(('.mp4', '.mkv', '.webm', '.mov')):
+        fixed_path = await fix_video_for_telegram(video_path)
+        if fixed_path:
+            video_path = fixed_path
+    
+    return video_path, photos, description
+
+async def deliver_media(chat_id: int, video_path: Optional[str], photos: Optional[List[str]],
+                        cache_key: Optional[str] = None, flight: Optional[_Flight] = None):
+    """Отправляет скачанное медиа. При общей загрузке - по file_id или внешней ссылке первого получателя."""
+    async def _send():
+        if cache_key and await send_cached_media(chat_id, cache_key):
+            return
+        if video_path:
+            await send_video_or_message(chat_id, video_path, cache_key=cache_key, fix_video=False,
+                                        link_cache=flight.external_links if flight else None)
+        elif photos:
+            await send_photo_album(chat_id, photos, cache_key=cache_key)
+    
+    if flight is not None and not flight.uploaded:
+        async with flight.send_lock:
+            if not flight.uploaded:
+                await _send()
+                # Без ключа кэша и внешней ссылки каждому получателю придётся загружать файл заново
+                flight.uploaded = bool((cache_key and cache_key in FILE_ID_CACHE.entries) or flight.external_links)
+                return
+    await _send()
+
+def download_failed_text(platform: str, url: str) -> str:
+    if platform == "youtube":
+        return (
+            "Не удалось скачать видео.\n\n"
+            "Возможные причины:\n"
+            "• Видео приватное или удалено\n"
+            "• Проблемы с доступом к платформе\n"
+            "• Некорректная ссылка"
+        )
+    if platform == "rutube":
+        return "Не удалось скачать видео с RuTube."
+    if platform == "tiktok":
+        if '/photo/' in url.lower():
+            return "Не удалось скачать фото с TikTok."
+        return "Не удалось скачать видео с TikTok."
+    return "Не удалось скачать медиа с Instagram."
+
+
+# ==================== ОЧЕРЕДЬ ЗАГРУЗОК ====================
+# Загрузки выполняются ограниченным числом воркеров на платформу,
+# чтобы yt-dlp и ffmpeg не боролись за CPU и канал.
+# Премиум и бесплатные задачи стоят в разных очередях и выбираются
+# взвешенно-справедливо: премиум идёт первым, но бесплатные не голодают.
+
+TIER_PREMIUM = "premium"
+TIER_FREE = "free"
+MIN_TIER_WEIGHT = 0.01  # нижняя граница веса уровня в очереди
+
+class QueueFullError(Exception):
+    """Очередь платформы переполнена - запрос не принят."""
+
+class DownloadJob:
+    def __init__(self, platform: str, factory: Callable[[], Awaitable[Any]], tier: str = TIER_FREE,
+                 discard: Optional[Callable[[Any], None]] = None):
+        self.platform = platform
+        self.factory = factory
+        self.tier = tier
+        # Освобождает результат, который уже некому отдать (ожидающий отменён)
+        self.discard = discard
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.task: Optional[asyncio.Task] = None
+        self.enqueued_at = time.monotonic()
+        self.started_at: Optional[float] = None
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+class DownloadScheduler:
+    """Очередь загрузок с пулом воркеров на каждую платформу, приоритетом премиума и контролем допуска."""
+
+    def __init__(self, workers: Dict[str, int], max_queue: int, tier_weights: Dict[str, float],
+                 premium_reserve: int = 0):
+        self.worker_counts = dict(workers)
+        # Общий предел очереди платформы для всех уровней; последние premium_reserve мест
+        # в нём достаются только премиуму
+        self.max_queue = max_queue
+        self.premium_reserve = max(0, min(premium_reserve, max_queue))
+        # Нулевой или отрицательный вес из окружения дал бы деление на ноль в виртуальном времени
+        self.tier_weights = {tier: max(MIN_TIER_WEIGHT, float(weight)) for tier, weight in tier_weights.items()}
+        self._queues: Dict[str, Dict[str, deque]] = {}
+        # Виртуальное время обслуживания каждого уровня (weighted fair queuing)
+        self._vtime: Dict[str, Dict[str, float]] = {}
+        self._idle: Dict[str, deque] = {}  # futures простаивающих воркеров
+        self._workers: List[asyncio.Task] = []
+        self._running: Dict[str, int] = {}
+        self._stats: Dict[str, Dict[str, int]] = {}
+        self._wait_times: Dict[str, deque] = {}
+        self._tier_wait_times: Dict[str, deque] = {tier: deque(maxlen=1000) for tier in self.tier_weights}
+
+    def _ensure_platform(self, platform: str):
+        if platform not in self._queues:
+            self._queues[platform] = {tier: deque() for tier in self.tier_weights}
+            self._vtime[platform] = {tier: 0.0 for tier in self.tier_weights}
+            self._idle[platform] = deque()
+            self._running[platform] = 0
+            self._stats[platform] = {'completed': 0, 'failed': 0, 'rejected': 0}
+            self._wait_times[platform] = deque(maxlen=500)
+
+    def start(self):
+        for platform, count in self.worker_counts.items():
+            self._ensure_platform(platform)
+            for i in range(max(1, count)):
+                self._workers.append(asyncio.create_task(self._worker(platform, i)))
+        logger.info(f"Очередь загрузок запущена: {self.worker_counts}, веса {self.tier_weights}")
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        for task in self._workers:
+            try:
+                await asyncio.wait_for(task, timeout=2.0)
+            except (asyncio.CancelledError, asyncio.TimeoutError):
+                pass
+            except Exception:
+                pass
+        self._workers = []
+
+    def _queued(self, platform: str) -> int:
+        return sum(len(q) for q in self._queues[platform].values())
+
+    def submit(self, platform: str, factory: Callable[[], Awaitable[Any]], tier: str = TIER_FREE,
+               discard: Optional[Callable[[Any], None]] = None) -> DownloadJob:
+        if platform not in self.worker_counts:
+            raise ValueError(f"Неизвестная платформа: {platform}")
+        if tier not in self.tier_weights:
+            tier = TIER_FREE
+        self._ensure_platform(platform)
+        queues = self._queues[platform]
+        limit = self.max_queue if tier == TIER_PREMIUM else self.max_queue - self.premium_reserve
+        if self._queued(platform) >= limit:
+            self._stats[platform]['rejected'] += 1
+            raise QueueFullError(platform)
+        if not queues[tier]:
+            # Уровень, простаивавший в очереди, не получает накопленного преимущества
+            active = [self._vtime[platform][t] for t, q in queues.items() if q]
+            floor = min(active) if active else max(self._vtime[platform].values())
+            self._vtime[platform][tier] = max(self._vtime[platform][tier], floor)
+        job = DownloadJob(platform, factory, tier, discard)
+        queues[tier].append(job)
+        self._wake_worker(platform)
+        return job
+
+    def _wake_worker(self, platform: str):
+        idle = self._idle[platform]
+        while idle:
+            waiter = idle.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    def outranks(self, tier: str, other: str) -> bool:
+        return self.tier_weights.get(tier, 0.0) > self.tier_weights.get(other, 0.0)
+
+    def promote(self, job: DownloadJob, tier: str):
+        """Переносит ждущую задачу в очередь более высокого уровня (её место там - в конце)."""
+        if tier not in self.tier_weights or not self.outranks(tier, job.tier):
+            return
+        queues = self._queues.get(job.platform)
+        if queues is not None and job in queues[job.tier]:
+            queues[job.tier].remove(job)
+            if not queues[tier]:
+                active = [self._vtime[job.platform][t] for t, q in queues.items() if q]
+                floor = min(active) if active else max(self._vtime[job.platform].values())
+                self._vtime[job.platform][tier] = max(self._vtime[job.platform][tier], floor)
+            queues[tier].append(job)
+        job.tier = tier
+
+    def _pick_tier(self, platform: str, queues: Dict[str, deque], vtime: Dict[str, float]) -> Optional[str]:
+        candidates = [tier for tier, q in queues.items() if q]
+        if not candidates:
+            return None
+        # При равенстве виртуального времени выигрывает больший вес
+        return min(candidates, key=lambda t: (vtime[t], -self.tier_weights[t]))
+
+    def _pop_next(self, platform: str) -> Optional[DownloadJob]:
+        queues = self._queues[platform]
+        vtime = self._vtime[platform]
+        tier = self._pick_tier(platform, queues, vtime)
+        if tier is None:
+            return None
+        vtime[tier] += 1.0 / self.tier_weights[tier]
+        return queues[tier].popleft()
+
+    def position(self, job: DownloadJob) -> int:
+        """Позиция в порядке выдачи (1 - следующий), 0 - уже выполняется.
+
+        Считается по длинам очередей уровней: задача с индексом i своего уровня выйдет,
+        когда его виртуальное время дойдёт до vtime + i / вес. До неё успеют выйти задачи
+        других уровней с меньшим виртуальным временем (при равенстве - с большим весом).
+        """
+        queues = self._queues.get(job.platform)
+        if not queues:
+            return 0
+        try:
+            index = queues[job.tier].index(job)
+        except (KeyError, ValueError):
+            return 0
+        vtime = self._vtime[job.platform]
+        tiers = list(queues)
+        weight = self.tier_weights[job.tier]
+        target = vtime[job.tier] + index / weight
+        position = index + 1
+        for tier, queue in queues.items():
+            if tier == job.tier or not queue:
+                continue
+            # Округление гасит погрешность суммирования 1/вес в _pop_next
+            span = round((target - vtime[tier]) * self.tier_weights[tier], 9)
+            # Ничью по виртуальному времени _pick_tier отдаёт большему весу, затем первому уровню
+            wins_tie = (self.tier_weights[tier], -tiers.index(tier)) > (weight, -tiers.index(job.tier))
+            ahead = math.floor(span) + 1 if wins_tie else math.ceil(span)
+            position += min(len(queue), max(0, ahead))
+        return position
+
+    async def run(self, platform: str, factory: Callable[[], Awaitable[Any]],
+                  on_queued: Optional[Callable[[int], Awaitable[None]]] = None,
+                  tier: str = TIER_FREE, discard: Optional[Callable[[Any], None]] = None,
+                  on_submit: Optional[Callable[[DownloadJob], None]] = None) -> Any:
+        job = self.submit(platform, factory, tier, discard)
+        if on_submit:
+            on_submit(job)
+        position = self.position(job)
+        if on_queued and position > self._idle_workers(platform):
+            try:
+                await on_queued(position)
+            except Exception:
+                pass
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            try:
+                self._queues[platform][job.tier].remove(job)
+            except ValueError:
+                pass
+            # Уже запущенную загрузку тоже останавливаем: её результат никому не нужен
+            if job.task and not job.task.done():
+                job.task.cancel()
+            raise
+
+    def _idle_workers(self, platform: str) -> int:
+        return max(0, self.worker_counts.get(platform, 0) - self._running.get(platform, 0))
+
+    async def _worker(self, platform: str, index: int):
+        idle = self._idle[platform]
+        loop = asyncio.get_running_loop()
+        while True:
+            job = self._pop_next(platform)
+            while job is None:
+                waiter = loop.create_future()
+                idle.append(waiter)
+                try:
+                    await waiter
+                finally:
+                    if waiter in idle:
+                        idle.remove(waiter)
+                job = self._pop_next(platform)
+            if job.future.done():
+                continue
+            job.started_at = time.monotonic()
+            wait = job.started_at - job.enqueued_at
+            self._wait_times[platform].append(wait)
+            self._tier_wait_times[job.tier].append(wait)
+            self._running[platform] += 1
+            job.task = asyncio.ensure_future(job.factory())
+            try:
+                # asyncio.wait не пробрасывает отмену самой задачи в воркер
+                await asyncio.wait({job.task})
+            except asyncio.CancelledError:
+                job.task.cancel()
+                if not job.future.done():
+                    job.future.cancel()
+                raise
+            finally:
+                self._running[platform] -= 1
+            if job.task.cancelled():
+                if not job.future.done():
+                    job.future.cancel()
+            elif job.task.exception() is not None:
+                self._stats[platform]['failed'] += 1
+                if not job.future.done():
+                    job.future.set_exception(job.task.exception())
+            else:
+                result = job.task.result()
+                self._stats[platform]['completed'] += 1
+                if not job.future.done():
+                    job.future.set_result(result)
+                elif job.discard:
+                    # Ожидающий ушёл, пока загрузка завершалась: файлы иначе останутся на диске
+                    try:
+                        job.discard(result)
+                    except Exception as e:
+                        logger.warning(f"Ошибка освобождения результата загрузки: {e}")
+
+    def metrics(self) -> Dict[str, Dict[str, Any]]:
+        result = {}
+        for platform in self.worker_counts:
+            self._ensure_platform(platform)
+            waits = list(self._wait_times[platform])
+            result[platform] = {
+                'queued': self._queued(platform),
+                **{f'queued_{tier}': len(q) for tier, q in self._queues[platform].items()},
+                'running': self._running[platform],
+                'workers': self.worker_counts[platform],
+                **self._stats[platform],
+                'avg_wait_s': round(sum(waits) / len(waits), 3) if waits else 0.0,
+                'max_wait_s': round(max(waits), 3) if waits else 0.0,
+            }
+        return result
+
+    def tier_wait_percentiles(self) -> Dict[str, Dict[str, float]]:
+        """Перцентили ожидания в очереди по уровням (для контроля SLA премиума)."""
+        result = {}
+        for tier, waits in self._tier_wait_times.items():
+            values = list(waits)
+            result[tier] = {
+                'count': len(values),
+                'p50': round(_percentile(values, 0.50), 3),
+                'p90': round(_percentile(values, 0.90), 3),
+                'p99': round(_percentile(values, 0.99), 3),
+            }
+        return result
+
+    def metrics_text(self) -> str:
+        lines = []
+        for platform, values in self.metrics().items():
+            for name, value in values.items():
+                lines.append(f"download_queue_{name}{{platform=\"{platform}\"}} {value}")
+        for tier, values in self.tier_wait_percentiles().items():
+            lines.append(f"download_wait_count{{tier=\"{tier}\"}} {values['count']}")
+            for quantile in ('p50', 'p90', 'p99'):
+                lines.append(f"download_wait_seconds{{tier=\"{tier}\",quantile=\"{quantile}\"}} {values[quantile]}")
+        return "\n".join(lines) + "\n"
+
+DOWNLOAD_SCHEDULER = DownloadScheduler(
+    workers={
+        "youtube": int(os.getenv("YOUTUBE_WORKERS", 3)),
+        "rutube": int(os.getenv("RUTUBE_WORKERS", 2)),
+        "tiktok": int(os.getenv("TIKTOK_WORKERS", 3)),
+        "instagram": int(os.getenv("INSTAGRAM_WORKERS", 3)),
+    },
+    max_queue=int(os.getenv("DOWNLOAD_QUEUE_MAX", 50)),
+    tier_weights={
+        TIER_PREMIUM: float(os.getenv("SCHEDULER_PREMIUM_WEIGHT", 4)),
+        TIER_FREE: 1.0,
+    },
+    # Места в DOWNLOAD_QUEUE_MAX, недоступные бесплатным: премиум встаёт в очередь и когда она забита ими
+    premium_reserve=int(os.getenv("DOWNLOAD_QUEUE_PREMIUM_RESERVE", 10)),
+)
+
+
 # ==================== КЛАВИАТУРЫ ====================
 
 def main_keyboard() -> ReplyKeyboardMarkup:
@@ -2661,7 +6148,8 @@ async def cmd_start(message: Message):
                         referrer.setdefault('referrals_completed', []).append(user_id)
                         activate_premium(referrer_id)
                         activate_premium(user_id)
-                        save_users_data()
+                        save_user(referrer_id)
+                        save_user(user_id)
                         is_new_referral = True
                         logger.info(f"Пользователь {user_id} зарегистрирован по реферальной ссылке {referrer_id}. Премиум активирован для обоих.")
                         
@@ -2674,7 +6162,7 @@ async def cmd_start(message: Message):
                         except Exception as e:
                             logger.error(f"Не удалось уведомить реферера {referrer_id}: {e}")
                     else:
-                        save_users_data()
+                        save_user(user_id)
                         logger.info(f"Пользователь {user_id} зарегистрирован по реферальной ссылке {referrer_id}.")
 
     if is_new_referral:
@@ -2847,7 +6335,7 @@ async def process_quality_choice(callback: CallbackQuery):
     quality = callback.data
     
     user_settings[user_id] = quality
-    save_user_settings()
+    save_user_setting(user_id)
     
     await callback.answer(f"Качество установлено: {quality}")
     await callback.message.edit_text(
@@ -2966,151 +6454,63 @@ async def handle_link(message: Message):
     temp_file = None
     temp_photos = []
     
+    # Повторная ссылка - пересылаем по file_id без скачивания
+    cache_key = canonical_media_key(platform, url, quality)
     try:
-        if platform == "youtube":
-            status_msg = None
-            try:
-                status_msg = await message.answer("Скачиваю с YouTube...")
-            except Exception:
-                pass
-
-            try:
-                temp_file = await download_youtube(url, quality)
-                if not temp_file:
-                    temp_file = await download_youtube_with_playwright(url, quality)
-            finally:
-                if status_msg:
-                    try:
-                        await status_msg.delete()
-                    except Exception:
-                        pass
-            
-            if temp_file:
-                await send_video_or_message(chat_id, temp_file)
-                cleanup_file(temp_file)
-                increment_downloads(user_id)
-                
-            else:
-                await message.answer(
-                    "Не удалось скачать видео.\n\n"
-                    "Возможные причины:\n"
-                    "• Видео приватное или удалено\n"
-                    "• Проблемы с доступом к платформе\n"
-                    "• Некорректная ссылка"
+        if await send_cached_media(chat_id, cache_key):
+            increment_downloads(user_id)
+            return
+    except Exception as e:
+        logger.warning(f"Ошибка отправки из кэша file_id: {e}")
+    
+    flight_key = cache_key or f"{platform}:{canonical_url(url)}:{quality}"
+    tier = TIER_PREMIUM if is_premium(user_id) else TIER_FREE
+    
+    try:
+        # Показываем исчезающее статусное сообщение
+        status_msg = None
+        try:
+            status_msg = await message.answer(f"Скачиваю с {PLATFORM_TITLES[platform]}...")
+        except Exception:
+            pass
+        
+        async def on_queued(position: int):
+            if status_msg:
+                await status_msg.edit_text(
+                    f"Вы в очереди: {position}. Скачаю с {PLATFORM_TITLES[platform]}, как только освободится место..."
                 )
-
-        elif platform == "rutube":
-            status_msg = None
-            try:
-                status_msg = await message.answer("Скачиваю с RuTube...")
-            except Exception:
-                pass
-
-            try:
-                temp_file = await download_rutube(url, quality)
-            finally:
-                if status_msg:
-                    try:
-                        await status_msg.delete()
-                    except Exception:
-                        pass
-
-            if temp_file:
-                await send_video_or_message(chat_id, temp_file)
-                cleanup_file(temp_file)
-                increment_downloads(user_id)
-            else:
-                await message.answer("Не удалось скачать видео с RuTube.")
         
-        elif platform == "tiktok":
-            if '/photo/' in url.lower():
-                status_msg = None
-                try:
-                    status_msg = await message.answer("Скачиваю с TikTok...")
-                except Exception:
-                    pass
-
-                try:
-                    photos, description = await download_tiktok_photos(url)
-                finally:
-                    if status_msg:
-                        try:
-                            await status_msg.delete()
-                        except Exception:
-                            pass
-
-                if photos:
-                    temp_photos = photos
-                    media_group = [InputMediaPhoto(media=FSInputFile(photo)) for photo in photos]
-                    
-                    batch_size = 10
-                    for i in range(0, len(media_group), batch_size):
-                        batch = media_group[i:i + batch_size]
-                        await bot.send_media_group(chat_id=chat_id, media=batch)
-                    
-                    cleanup_files(photos)
-                    increment_downloads(user_id)
-                else:
-                    await message.answer("Не удалось скачать фото с TikTok.")
-            else:
-                status_msg = None
+        try:
+            (temp_file, photos, description), flight = await DOWNLOAD_COALESCER.run(
+                flight_key,
+                lambda flight: DOWNLOAD_SCHEDULER.run(
+                    platform, lambda: download_media(platform, url, quality), flight.notify_queued,
+                    tier=flight.tier, discard=release_media, on_submit=lambda job: setattr(flight, 'job', job),
+                ),
+                tier=tier,
+                on_queued=on_queued,
+            )
+            temp_photos = photos or []
+        finally:
+            # Удаляем статусное сообщение
+            if status_msg:
                 try:
-                    status_msg = await message.answer("Скачиваю с TikTok...")
+                    await status_msg.delete()
                 except Exception:
                     pass
-
-                try:
-                    temp_file = await download_tiktok(url, quality)
-                finally:
-                    if status_msg:
-                        try:
-                            await status_msg.delete()
-                        except Exception:
-                            pass
-
-                if temp_file:
-                    await send_video_or_message(chat_id, temp_file)
-                    cleanup_file(temp_file)
-                    increment_downloads(user_id)
-                else:
-                    await message.answer("Не удалось скачать видео с TikTok.")
         
-        elif platform == "instagram":
-            # Показываем исчезающее статусное сообщение
-            status_msg = None
-            try:
-                status_msg = await message.answer("Скачиваю с Instagram...")
-            except Exception:
-                pass
-            
-            try:
-                video_path, photos, description = await download_instagram(url)
-            finally:
-                # Удаляем статусное сообщение
-                if status_msg:
-                    try:
-                        await status_msg.delete()
-                    except Exception:
-                        pass
-            
-            if video_path:
-                await send_video_or_message(chat_id, video_path)
-                cleanup_file(video_path)
-                increment_downloads(user_id)
-            elif photos:
-                temp_photos = photos
-                media_group = [InputMediaPhoto(media=FSInputFile(photo)) for photo in photos]
-                
-                batch_size = 10
-                for i in range(0, len(media_group), batch_size):
-                    batch = media_group[i:i + batch_size]
-                    await bot.send_media_group(chat_id=chat_id, media=batch)
-                
-                cleanup_files(photos)
-                increment_downloads(user_id)
-            else:
-                await message.answer("Не удалось скачать медиа с Instagram.")
+        if temp_file or temp_photos:
+            await deliver_media(chat_id, temp_file, temp_photos, cache_key, flight)
+            increment_downloads(user_id)
+        else:
+            await message.answer(download_failed_text(platform, url))
     
+    except QueueFullError:
+        logger.warning(f"Очередь {platform} переполнена, запрос {user_id} отклонён")
+        await message.answer(
+            f"Сейчас слишком много запросов к {PLATFORM_TITLES[platform]}.\n\n"
+            "Попробуйте через пару минут."
+        )
     except Exception as e:
         logger.error(f"Ошибка обработки ссылки: {e}")
         await message.answer(
@@ -3118,6 +6518,7 @@ async def handle_link(message: Message):
             "Попробуйте позже или обратитесь к администратору."
         )
     finally:
+        # Каждый получатель освобождает свою долю общих файлов ровно один раз
         if temp_file:
             cleanup_file(temp_file)
         if temp_photos:
@@ -3127,7 +6528,7 @@ async def handle_link(message: Message):
 
 async def shutdown_cleanup():
     """Очистка ресурсов при завершении"""
-    global SHUTDOWN_FLAG, YOUTUBE_REFRESH_TASK, IG_BROWSER, YT_BROWSER
+    global SHUTDOWN_FLAG
     
     logger.info("Начало cleanup...")
     SHUTDOWN_FLAG = True
@@ -3140,6 +6541,14 @@ async def shutdown_cleanup():
         except (asyncio.CancelledError, asyncio.TimeoutError):
             pass
     
+    if YOUTUBE_POOL_TASK and not YOUTUBE_POOL_TASK.done():
+        YOUTUBE_POOL_TASK.cancel()
+        try:
+            await asyncio.wait_for(YOUTUBE_POOL_TASK, timeout=2.0)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            pass
+    TOKEN_POOL.close()
+    
     if INSTAGRAM_REFRESH_TASK and not INSTAGRAM_REFRESH_TASK.done():
         INSTAGRAM_REFRESH_TASK.cancel()
         try:
@@ -3147,25 +6556,65 @@ async def shutdown_cleanup():
         except (asyncio.CancelledError, asyncio.TimeoutError):
             pass
     
-    # Закрываем браузеры
-    if IG_BROWSER:
+    await DOWNLOAD_SCHEDULER.stop()
+    
+    if PARTIAL_JANITOR_TASK and not PARTIAL_JANITOR_TASK.done():
+        PARTIAL_JANITOR_TASK.cancel()
         try:
-            await IG_BROWSER.close()
-        except Exception as e:
-            logger.debug(f"Error closing IG browser: {e}")
+            await asyncio.wait_for(PARTIAL_JANITOR_TASK, timeout=2.0)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            pass
     
-    if YT_BROWSER:
+    if CIRCUIT_PROBE_TASK and not CIRCUIT_PROBE_TASK.done():
+        CIRCUIT_PROBE_TASK.cancel()
         try:
-            await YT_BROWSER.close()
-        except Exception as e:
-            logger.debug(f"Error closing YT browser: {e}")
+            await asyncio.wait_for(CIRCUIT_PROBE_TASK, timeout=2.0)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            pass
+    
+    if PERSIST_FLUSH_TASK and not PERSIST_FLUSH_TASK.done():
+        PERSIST_FLUSH_TASK.cancel()
+        try:
+            await asyncio.wait_for(PERSIST_FLUSH_TASK, timeout=2.0)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            pass
+    
+    # Финальный сброс накопленных изменений
+    try:
+        await flush_user_data()
+        await FILE_ID_CACHE.flush()
+        await METHOD_SCOREBOARD.flush()
+        await DOWNLOAD_STATE.flush()
+    except Exception as e:
+        logger.error(f"Ошибка финального сохранения данных: {e}")
+    
+    if BROWSER_MAINTENANCE_TASK and not BROWSER_MAINTENANCE_TASK.done():
+        BROWSER_MAINTENANCE_TASK.cancel()
+        try:
+            await asyncio.wait_for(BROWSER_MAINTENANCE_TASK, timeout=2.0)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            pass
+    
+    # Закрываем браузеры и драйвер Playwright
+    try:
+        await BROWSERS.close()
+    except Exception as e:
+        logger.debug(f"Error closing browsers: {e}")
+    
+    if user_store:
+        # Дожидаемся записи, которая ещё может идти в потоке
+        async with _flush_lock:
+            user_store.close()
+    
+    await HTTP_CLIENT.close()
     
     logger.info("Cleanup завершён")
 
 
 async def main():
     """Основная функция запуска"""
-    global bot, YOUTUBE_REFRESH_TASK, INSTAGRAM_REFRESH_TASK, SHUTDOWN_FLAG
+    global bot, YOUTUBE_REFRESH_TASK, YOUTUBE_POOL_TASK, INSTAGRAM_REFRESH_TASK, PERSIST_FLUSH_TASK
+    global CIRCUIT_PROBE_TASK, PARTIAL_JANITOR_TASK, BROWSER_MAINTENANCE_TASK, SHUTDOWN_FLAG
     logger.info("Запуск бота...")
     
     SHUTDOWN_FLAG = False
@@ -3174,15 +6623,22 @@ async def main():
         raise ValueError("BOT_TOKEN не найден в переменных окружения")
     
     init_cookies_from_env()
-    load_user_settings()
-    load_users_data()
-    load_referrals()
+    init_user_store()
+    FILE_ID_CACHE.load()
+    METHOD_SCOREBOARD.load()
+    DOWNLOAD_STATE.load()
+    await HTTP_CLIENT.start()
+    PERSIST_FLUSH_TASK = asyncio.create_task(persistence_flush_loop())
+    DOWNLOAD_SCHEDULER.start()
+    CIRCUIT_PROBE_TASK = asyncio.create_task(circuit_probe_loop())
+    PARTIAL_JANITOR_TASK = asyncio.create_task(partial_janitor_loop())
     
-    await init_instagram_playwright()
-    await init_youtube_playwright()
+    # Браузеры Playwright запускаются при первом обращении
+    BROWSER_MAINTENANCE_TASK = asyncio.create_task(browser_maintenance_loop())
     
     # Запускаем фоновые задачи обновления cookies
     YOUTUBE_REFRESH_TASK = asyncio.create_task(youtube_cookie_refresh_loop())
+    YOUTUBE_POOL_TASK = asyncio.create_task(youtube_identity_pool_loop())
     logger.info("Фоновое обновление YouTube cookies запущено")
     
     INSTAGRAM_REFRESH_TASK = asyncio.create_task(instagram_cookie_refresh_loop())
@@ -3190,65 +6646,71 @@ async def main():
     
     bot = Bot(token=BOT_TOKEN, session=AiohttpSession())
     
-    webhook_url = os.getenv("WEBHOOK_URL", "")
-    if webhook_url and webhook_url.strip():
-        logger.info(f"Работаю в рэжиме Webhook: {webhook_url}")
-        try:
-            await bot.delete_webhook(drop_pending_updates=True)
-            allowed_updates = dp.resolve_used_update_types()
-            await bot.set_webhook(webhook_url, allowed_updates=allowed_updates)
+    try:
+        webhook_url = os.getenv("WEBHOOK_URL", "")
+        if webhook_url and webhook_url.strip():
+            logger.info(f"Работаю в рэжиме Webhook: {webhook_url}")
+            try:
+                await bot.delete_webhook(drop_pending_updates=True)
+                allowed_updates = dp.resolve_used_update_types()
+                await bot.set_webhook(webhook_url, allowed_updates=allowed_updates)
             
-            app = aiohttp.web.Application()
-            from aiogram.webhook.aiohttp_server import SimpleRequestHandler
-            webhook_requests_handler = SimpleRequestHandler(dispatcher=dp, bot=bot)
-            webhook_requests_handler.register(app, path="/webhook")
+                app = aiohttp.web.Application()
+                from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+                webhook_requests_handler = SimpleRequestHandler(dispatcher=dp, bot=bot)
+                webhook_requests_handler.register(app, path="/webhook")
             
-            async def health(request):
-                return aiohttp.web.Response(text="OK")
+                async def health(request):
+                    return aiohttp.web.Response(text="OK")
             
-            async def webhook_info(request):
-                """Эндпоинт для проверки информации о webhook"""
-                try:
-                    webhook_info = await bot.get_webhook_info()
-                    info_text = f"Webhook URL: {webhook_info.url}\n"
-                    info_text += f"Custom certificate: {webhook_info.use_custom_certificate}\n"
-                    info_text += f"Max connections: {webhook_info.max_connections}\n"
-                    info_text += f"Allowed updates: {webhook_info.allowed_updates}\n"
-                    info_text += f"Pending update count: {webhook_info.pending_update_count}\n"
-                    info_text += f"Last error: {webhook_info.last_error_message}\n"
-                    return aiohttp.web.Response(text=info_text, content_type="text/plain")
-                except Exception as e:
-                    return aiohttp.web.Response(text=f"Error: {e}", content_type="text/plain")
+                async def webhook_info(request):
+                    """Эндпоинт для проверки информации о webhook"""
+                    try:
+                        webhook_info = await bot.get_webhook_info()
+                        info_text = f"Webhook URL: {webhook_info.url}\n"
+                        info_text += f"Custom certificate: {webhook_info.use_custom_certificate}\n"
+                        info_text += f"Max connections: {webhook_info.max_connections}\n"
+                        info_text += f"Allowed updates: {webhook_info.allowed_updates}\n"
+                        info_text += f"Pending update count: {webhook_info.pending_update_count}\n"
+                        info_text += f"Last error: {webhook_info.last_error_message}\n"
+                        return aiohttp.web.Response(text=info_text, content_type="text/plain")
+                    except Exception as e:
+                        return aiohttp.web.Response(text=f"Error: {e}", content_type="text/plain")
             
-            app.router.add_get("/", health)
-            app.router.add_get("/health", health)
-            app.router.add_get("/webhook-info", webhook_info)
+                app.router.add_get("/", health)
+                app.router.add_get("/health", health)
+                app.router.add_get("/webhook-info", webhook_info)
+                
+                async def metrics(request):
+                    """Глубина очередей, статистика воркеров, автоматы, фрагменты yt-dlp и ffmpeg"""
+                    text = (DOWNLOAD_SCHEDULER.metrics_text() + CIRCUIT_BREAKERS.metrics_text() + fragment_metrics_text()
+                            + FFMPEG_POOL.metrics_text() + BROWSERS.metrics_text() + TOKEN_BROKER.metrics_text()
+                            + TOKEN_POOL.metrics_text() + FILE_ID_CACHE.metrics_text())
+                    return aiohttp.web.Response(text=text, content_type="text/plain")
+                
+                app.router.add_get("/metrics", metrics)
             
-            runner = aiohttp.web.AppRunner(app)
-            await runner.setup()
-            site = aiohttp.web.TCPSite(runner, '0.0.0.0', PORT)
-            await site.start()
-            logger.info(f"Webhook запущен на порту {PORT}")
+                runner = aiohttp.web.AppRunner(app)
+                await runner.setup()
+                site = aiohttp.web.TCPSite(runner, '0.0.0.0', PORT)
+                await site.start()
+                logger.info(f"Webhook запущен на порту {PORT}")
             
-            await asyncio.Event().wait()
-        except Exception as e:
-            logger.error(f"Ошибка webhook режима: {e}")
-            logger.info("Переключаемся на polling режим...")
-            await bot.delete_webhook(drop_pending_updates=True)
-            allowed_updates = dp.resolve_used_update_types()
-            await dp.start_polling(bot, allowed_updates=allowed_updates)
-    else:
-        logger.info("Работаю в ржиме Polling")
-        try:
+                await asyncio.Event().wait()
+            except Exception as e:
+                logger.error(f"Ошибка webhook режима: {e}")
+                logger.info("Переключаемся на polling режим...")
+                await bot.delete_webhook(drop_pending_updates=True)
+                allowed_updates = dp.resolve_used_update_types()
+                await dp.start_polling(bot, allowed_updates=allowed_updates)
+        else:
+            logger.info("Работаю в ржиме Polling")
             await bot.delete_webhook(drop_pending_updates=True)
             allowed_updates = dp.resolve_used_update_types()
             await dp.start_polling(bot, allowed_updates=allowed_updates)
-        finally:
-            save_user_settings()
-            save_users_data()
-            save_referrals()
-            await shutdown_cleanup()
-            logger.info("Бот остановлен")
+    finally:
+        await shutdown_cleanup()
+        logger.info("Бот остановлен")
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,117 @@
+"""
+Тесты автомата защиты внешних сервисов: closed -> open -> half_open -> closed,
+рост паузы при повторных размыканиях, какие ответы и ошибки считаются сбоем,
+и guarded_request против локального aiohttp сервера.
+Запуск: python -m pytest test_circuit_breaker.py
+"""
+import asyncio
+import sys
+sys.path.insert(0, '.')
+
+import aiohttp
+import aiohttp.web
+import pytest
+
+import bot
+
+
+def expire_cooldown(breaker):
+    breaker.opened_at -= breaker.cooldown + 1
+
+
+def test_full_cycle():
+    breaker = bot.CircuitBreaker('api.example', failure_threshold=3, base_cooldown=10, max_cooldown=100)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == breaker.CLOSED and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+    assert not breaker.allow()
+    assert not breaker.probe_due()
+
+    expire_cooldown(breaker)
+    assert breaker.probe_due()
+    # В half_open проходит ровно один пробный запрос
+    assert breaker.allow()
+    assert breaker.state == breaker.HALF_OPEN
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == breaker.CLOSED
+    assert (breaker.failures, breaker.trips) == (0, 0)
+
+
+def test_failed_trial_doubles_cooldown():
+    breaker = bot.CircuitBreaker('api.example', failure_threshold=1, base_cooldown=10, max_cooldown=25)
+    breaker.record_failure()
+    assert breaker.cooldown == 10
+    for expected in (20, 25):
+        expire_cooldown(breaker)
+        assert breaker.allow()
+        # Одной ошибки в half_open достаточно, чтобы разомкнуть снова
+        breaker.record_failure()
+        assert breaker.state == breaker.OPEN
+        assert breaker.cooldown == expected
+
+
+def test_only_service_failures_count():
+    breaker = bot.CircuitBreaker('api.example', failure_threshold=2)
+    for status in (400, 403, 404):
+        breaker.record_response(status)
+    breaker.record_error(ValueError('bad json'))
+    assert breaker.failures == 0
+    breaker.record_response(503)
+    breaker.record_error(asyncio.TimeoutError())
+    assert breaker.state == breaker.OPEN
+
+
+def test_registry_keys_by_host():
+    registry = bot.CircuitBreakerRegistry()
+    assert registry.get('https://API.example/a') is registry.get('https://api.example/b?x=1')
+    assert registry.probe_url('api.example') == 'https://api.example/'
+    registry.register_probe('https://api.example/health')
+    assert registry.probe_url('api.example') == 'https://api.example/health'
+    assert 'circuit_state{host="api.example"} 0' in registry.metrics_text()
+
+
+def test_guarded_request_opens_and_recovers(monkeypatch):
+    registry = bot.CircuitBreakerRegistry()
+    monkeypatch.setattr(bot, 'CIRCUIT_BREAKERS', registry)
+    state = {'status': 500, 'requests': 0}
+
+    async def handler(request):
+        state['requests'] += 1
+        return aiohttp.web.Response(status=state['status'])
+
+    async def run():
+        app = aiohttp.web.Application()
+        app.router.add_get('/api', handler)
+        runner = aiohttp.web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = aiohttp.web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/api"
+        try:
+            async with aiohttp.ClientSession() as session:
+                async def call():
+                    resp = await bot.guarded_request(session, 'GET', url)
+                    resp.release()
+                    return resp.status
+
+                for _ in range(bot.CIRCUIT_FAILURE_THRESHOLD):
+                    assert await call() == 500
+                breaker = registry.get(url)
+                assert breaker.state == breaker.OPEN
+                with pytest.raises(bot.CircuitOpenError):
+                    await call()
+                sent = state['requests']
+
+                state['status'] = 200
+                expire_cooldown(breaker)
+                assert await call() == 200
+                assert breaker.state == breaker.CLOSED
+                return sent
+        finally:
+            await runner.cleanup()
+
+    # Разомкнутый автомат отклонил запрос, не отправляя его
+    assert asyncio.run(run()) == bot.CIRCUIT_FAILURE_THRESHOLD
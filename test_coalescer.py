@@ -0,0 +1,158 @@
+"""
+Тесты DownloadCoalescer и deliver_media: одна загрузка на N получателей,
+перевыбор лидера при отмене, статус очереди для всех и параллельная
+отправка после первой загрузки файла в Telegram.
+Запуск: python -m pytest test_coalescer.py
+"""
+import asyncio
+import sys
+sys.path.insert(0, '.')
+
+import bot
+
+
+def test_single_download_for_many_callers():
+    calls = 0
+
+    async def run():
+        nonlocal calls
+        coalescer = bot.DownloadCoalescer()
+        gate = asyncio.Event()
+
+        async def factory(flight):
+            nonlocal calls
+            calls += 1
+            await gate.wait()
+            return None, ['photo.jpg'], 'desc'
+
+        tasks = [asyncio.create_task(coalescer.run('k', factory)) for _ in range(5)]
+        await asyncio.sleep(0.01)
+        assert coalescer.in_flight() == 1
+        gate.set()
+        results = await asyncio.gather(*tasks)
+        flights = {id(flight) for _, flight in results}
+        return [result for result, _ in results], flights, coalescer
+
+    results, flights, coalescer = asyncio.run(run())
+    assert calls == 1
+    assert len(flights) == 1
+    assert all(result == (None, ['photo.jpg'], 'desc') for result in results)
+    assert coalescer.coalesced == 4
+    assert coalescer.in_flight() == 0
+
+
+def test_leader_cancel_elects_new_leader():
+    starts = []
+
+    async def run():
+        coalescer = bot.DownloadCoalescer()
+        gate = asyncio.Event()
+
+        async def factory(flight):
+            starts.append(flight)
+            await gate.wait()
+            return None, ['p.jpg'], ''
+
+        leader = asyncio.create_task(coalescer.run('k', factory))
+        await asyncio.sleep(0.01)
+        waiters = [asyncio.create_task(coalescer.run('k', factory)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        await asyncio.sleep(0.01)
+        gate.set()
+        results = await asyncio.gather(*waiters)
+        assert leader.cancelled()
+        return results
+
+    results = asyncio.run(run())
+    # Старый лидер и ровно один новый: второй ожидающий присоединился к новому
+    assert len(starts) == 2
+    assert results[0][1] is results[1][1]
+
+
+def test_leader_error_reaches_waiters():
+    async def run():
+        coalescer = bot.DownloadCoalescer()
+
+        async def factory(flight):
+            await asyncio.sleep(0.01)
+            raise RuntimeError('boom')
+
+        tasks = [asyncio.create_task(coalescer.run('k', factory)) for _ in range(3)]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+def test_queue_position_reaches_waiters(monkeypatch):
+    async def run():
+        scheduler = bot.DownloadScheduler({'x': 1}, max_queue=10, tier_weights={bot.TIER_FREE: 1.0})
+        monkeypatch.setattr(bot, 'DOWNLOAD_SCHEDULER', scheduler)
+        scheduler.start()
+        coalescer = bot.DownloadCoalescer()
+        busy = asyncio.Event()
+        seen = {'leader': [], 'waiter': []}
+
+        async def blocker():
+            await busy.wait()
+
+        async def work():
+            return None, ['p.jpg'], ''
+
+        def factory(flight):
+            return scheduler.run('x', work, flight.notify_queued,
+                                 on_submit=lambda job: setattr(flight, 'job', job))
+
+        async def listener(name, position):
+            seen[name].append(position)
+
+        running = asyncio.create_task(scheduler.run('x', blocker))
+        await asyncio.sleep(0.01)
+        leader = asyncio.create_task(coalescer.run('k', factory, on_queued=lambda p: listener('leader', p)))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(coalescer.run('k', factory, on_queued=lambda p: listener('waiter', p)))
+        await asyncio.sleep(0.01)
+        busy.set()
+        await asyncio.gather(running, leader, waiter)
+        await scheduler.stop()
+        return seen
+
+    seen = asyncio.run(run())
+    assert seen == {'leader': [1], 'waiter': [1]}
+
+
+def test_deliver_media_uploads_once_then_sends_concurrently(monkeypatch, tmp_path):
+    cache = bot.FileIdCache(str(tmp_path / 'cache.json'))
+    monkeypatch.setattr(bot, 'FILE_ID_CACHE', cache)
+    uploads = []
+    cached_sends = []
+    active = {'now': 0, 'max': 0}
+
+    async def send_cached_media(chat_id, cache_key):
+        if not cache.get(cache_key):
+            return False
+        active['now'] += 1
+        active['max'] = max(active['max'], active['now'])
+        await asyncio.sleep(0.05)
+        active['now'] -= 1
+        cached_sends.append(chat_id)
+        return True
+
+    async def send_video_or_message(chat_id, path, cache_key=None, fix_video=True, link_cache=None):
+        await asyncio.sleep(0.05)
+        uploads.append(chat_id)
+        cache.put(cache_key, 'video', ['file-id'])
+
+    monkeypatch.setattr(bot, 'send_cached_media', send_cached_media)
+    monkeypatch.setattr(bot, 'send_video_or_message', send_video_or_message)
+
+    async def run():
+        flight = bot._Flight(asyncio.get_running_loop().create_future())
+        await asyncio.gather(*(bot.deliver_media(chat_id, 'v.mp4', None, 'youtube:id:720', flight)
+                               for chat_id in range(5)))
+
+    asyncio.run(run())
+    assert uploads == [0]
+    assert sorted(cached_sends) == [1, 2, 3, 4]
+    assert active['max'] > 1
@@ -0,0 +1,62 @@
+"""
+Тесты ConnectionBudget: выдача соединений и доля полосы, которая
+пересчитывается, когда другие загрузки стартуют и завершаются.
+Запуск: python -m pytest test_connection_budget.py
+"""
+import asyncio
+import sys
+sys.path.insert(0, '.')
+
+from yt_dlp.downloader.common import FileDownloader
+
+import bot
+
+
+def test_share_follows_granted_connections():
+    async def run():
+        budget = bot.ConnectionBudget(connections=24, bandwidth=24_000_000)
+        first = await budget.acquire(8)
+        rate = budget.ratelimit(first)
+        shares = [float(rate)]
+        second = await budget.acquire(4)
+        shares.append(float(rate))
+        await budget.release(second)
+        shares.append(float(rate))
+        return shares
+
+    # Одна загрузка берёт всю полосу, при второй делит её 8:4, после неё снова вся
+    assert asyncio.run(run()) == [24_000_000, 16_000_000, 24_000_000]
+
+
+def test_acquire_waits_for_free_connection():
+    async def run():
+        budget = bot.ConnectionBudget(connections=2, bandwidth=0)
+        assert await budget.acquire(5) == 2
+        assert budget.ratelimit(2) is None
+        waiter = asyncio.create_task(budget.acquire(1))
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        await budget.release(2)
+        return await waiter
+
+    assert asyncio.run(run()) == 1
+
+
+def test_ytdlp_throttles_with_live_share(monkeypatch):
+    slept = []
+    monkeypatch.setattr('yt_dlp.downloader.common.time.sleep', slept.append)
+
+    async def run():
+        budget = bot.ConnectionBudget(connections=4, bandwidth=1000)
+        rate = budget.ratelimit(await budget.acquire(2))
+        params = {'ratelimit': rate}
+        downloader = FileDownloader.__new__(FileDownloader)
+        # Фрагментные загрузчики yt-dlp получают копию params
+        downloader.params = {**params, 'noprogress': True}
+        downloader.slow_down(0.0, 1.0, 1000)
+        await budget.acquire(2)
+        downloader.slow_down(0.0, 1.0, 1000)
+
+    asyncio.run(run())
+    # 1000 байт за секунду: в одиночку это ровно лимит, вдвоём - вдвое больше доли
+    assert slept == [1.0]
@@ -0,0 +1,233 @@
+"""
+Тесты download_direct против локального aiohttp сервера: загрузка диапазонами,
+откат на один поток без поддержки диапазонов и отмена посреди загрузки.
+Отдельно - удаление временной папки download_direct_to_temp при неудаче
+и предел памяти AsyncFileSink при медленном диске.
+Запуск: python -m pytest test_download_direct.py
+"""
+import asyncio
+import os
+import re
+import sys
+import threading
+import time
+sys.path.insert(0, '.')
+
+import aiohttp
+import aiohttp.web
+import pytest
+
+import bot
+
+PAYLOAD = os.urandom(1024 * 1024)
+
+
+async def start_server(ranges: bool = True, chunk_delay: float = 0.0):
+    """Сервер отдаёт PAYLOAD. ranges=False - 206 только на пробный bytes=0-0, дальше 200 целиком."""
+    requests = []
+
+    async def handler(request):
+        requests.append(request.headers.get('Range'))
+        match = re.match(r'bytes=(\d+)-(\d+)', request.headers.get('Range', ''))
+        if match and (ranges or match.group(0) == 'bytes=0-0'):
+            start, end = int(match.group(1)), int(match.group(2))
+            status = 206
+            headers = {'Content-Range': f'bytes {start}-{end}/{len(PAYLOAD)}', 'ETag': '"v1"'}
+        else:
+            start, end = 0, len(PAYLOAD) - 1
+            status = 200
+            headers = {}
+        resp = aiohttp.web.StreamResponse(status=status, headers=headers)
+        resp.content_length = end - start + 1
+        resp.content_type = 'video/mp4'
+        await resp.prepare(request)
+        for offset in range(start, end + 1, 64 * 1024):
+            await resp.write(PAYLOAD[offset:min(end + 1, offset + 64 * 1024)])
+            if chunk_delay:
+                await asyncio.sleep(chunk_delay)
+        return resp
+
+    app = aiohttp.web.Application()
+    app.router.add_get('/file', handler)
+    runner = aiohttp.web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = aiohttp.web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/file", requests
+
+
+@pytest.fixture(autouse=True)
+def small_segments(monkeypatch):
+    monkeypatch.setattr(bot, 'RANGED_MIN_SEGMENT_SIZE', 128 * 1024)
+    monkeypatch.setattr(bot, 'FILE_SINK_MIN_BUFFER', 64 * 1024)
+
+
+@pytest.fixture
+def slow_writes(monkeypatch):
+    """Медленный pwrite, который считает записи, идущие в потоках."""
+    state = {'in_flight': 0}
+    lock = threading.Lock()
+    real_pwrite_all = bot._pwrite_all
+
+    def pwrite_all(fd, data, offset):
+        with lock:
+            state['in_flight'] += 1
+        try:
+            time.sleep(0.2)
+            real_pwrite_all(fd, data, offset)
+        finally:
+            with lock:
+                state['in_flight'] -= 1
+
+    monkeypatch.setattr(bot, '_pwrite_all', pwrite_all)
+    return state
+
+
+def test_ranged_download(tmp_path):
+    async def run():
+        runner, url, requests = await start_server()
+        try:
+            async with aiohttp.ClientSession() as session:
+                return await bot.download_direct(session, url, str(tmp_path / 'out.mp4'), segments=4), requests
+        finally:
+            await runner.cleanup()
+
+    result, requests = asyncio.run(run())
+    assert result.size == len(PAYLOAD)
+    assert (tmp_path / 'out.mp4').read_bytes() == PAYLOAD
+    assert len(requests) == 5  # пробный запрос и четыре сегмента
+
+
+def test_falls_back_to_single_stream_without_ranges(tmp_path):
+    async def run():
+        runner, url, requests = await start_server(ranges=False)
+        try:
+            async with aiohttp.ClientSession() as session:
+                return await bot.download_direct(session, url, str(tmp_path / 'out.mp4'), segments=4), requests
+        finally:
+            await runner.cleanup()
+
+    result, requests = asyncio.run(run())
+    assert result.size == len(PAYLOAD)
+    assert (tmp_path / 'out.mp4').read_bytes() == PAYLOAD
+    assert requests[-1] is None  # последний запрос - обычный поток без Range
+
+
+def test_cancel_waits_for_in_flight_writes(tmp_path, slow_writes):
+    dest = tmp_path / 'out.mp4'
+
+    async def run():
+        runner, url, _ = await start_server(chunk_delay=0.01)
+        try:
+            async with aiohttp.ClientSession() as session:
+                task = asyncio.create_task(bot.download_direct(session, url, str(dest), segments=4))
+                while not slow_writes['in_flight']:
+                    await asyncio.sleep(0.01)
+                task.cancel()
+                with pytest.raises(asyncio.CancelledError):
+                    await task
+                # download_direct вернулся: ни одна запись уже не должна идти в закрытый fd
+                return slow_writes['in_flight']
+        finally:
+            await runner.cleanup()
+
+    assert asyncio.run(run()) == 0
+    assert not dest.exists()
+
+
+def test_cancel_keeps_resumable_partial(tmp_path, slow_writes, monkeypatch):
+    store = bot.DownloadStateStore(str(tmp_path / 'state.json'), str(tmp_path / 'partials'))
+    monkeypatch.setattr(bot, 'DOWNLOAD_STATE', store)
+    dest = tmp_path / 'out.mp4'
+
+    async def run(cancel: bool):
+        runner, url, _ = await start_server(chunk_delay=0.01)
+        try:
+            async with aiohttp.ClientSession() as session:
+                task = asyncio.create_task(bot.download_direct(session, url, str(dest), segments=4,
+                                                               resume_key='video'))
+                if not cancel:
+                    return await task
+                while not slow_writes['in_flight']:
+                    await asyncio.sleep(0.01)
+                task.cancel()
+                with pytest.raises(asyncio.CancelledError):
+                    await task
+                return slow_writes['in_flight']
+        finally:
+            await runner.cleanup()
+
+    assert asyncio.run(run(cancel=True)) == 0
+    entry = store.entries['video']
+    assert os.path.exists(entry['path'])
+    assert 'video' not in store.active
+    # Записанный прогресс сегментов совпадает с содержимым недокачанного файла
+    with open(entry['path'], 'rb') as f:
+        partial = f.read()
+    for progress, (start, _) in zip(entry['progress'], entry['segments']):
+        assert partial[start:progress] == PAYLOAD[start:progress]
+
+    result = asyncio.run(run(cancel=False))
+    assert result.size == len(PAYLOAD)
+    assert dest.read_bytes() == PAYLOAD
+    assert 'video' not in store.entries
+
+
+
+
+def test_temp_dir_removed_on_failure(tmp_path, monkeypatch):
+    created = []
+    real_mkdtemp = bot.tempfile.mkdtemp
+
+    def mkdtemp(*args, **kwargs):
+        created.append(real_mkdtemp(dir=str(tmp_path)))
+        return created[-1]
+
+    monkeypatch.setattr(bot.tempfile, 'mkdtemp', mkdtemp)
+
+    async def run(**kwargs):
+        runner, url, _ = await start_server()
+        try:
+            async with aiohttp.ClientSession() as session:
+                return await bot.download_direct_to_temp(session, url, 'v.mp4', segments=4, **kwargs)
+        finally:
+            await runner.cleanup()
+
+    path = asyncio.run(run())
+    assert path == os.path.join(created[0], 'v.mp4')
+    assert open(path, 'rb').read() == PAYLOAD
+
+    with pytest.raises(bot.StreamLimitError):
+        asyncio.run(run(min_size=len(PAYLOAD) + 1))
+    assert not os.path.exists(created[1])
+
+
+class SlowFile:
+    """Обёртка файла с медленной записью: буферы копятся, пока идёт сброс."""
+
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, data):
+        time.sleep(0.01)
+        return self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+
+def test_file_sink_memory_stays_within_max_buffer(tmp_path):
+    async def run():
+        peak = 0
+        async with bot.AsyncFileSink(str(tmp_path / 'out.bin'), min_buffer=16 * 1024,
+                                     max_buffer=256 * 1024) as sink:
+            sink._file = SlowFile(sink._file)
+            for offset in range(0, len(PAYLOAD), 8 * 1024):
+                await sink.write(PAYLOAD[offset:offset + 8 * 1024])
+                peak = max(peak, sink._in_flight + sink._buffered)
+        return peak
+
+    # Пишущийся и копящийся буферы вместе не больше max_buffer
+    assert asyncio.run(run()) <= 256 * 1024
+    assert (tmp_path / 'out.bin').read_bytes() == PAYLOAD
@@ -0,0 +1,95 @@
+"""
+Тесты DownloadStateStore: занятие ключа, переиспользование записи при том же
+валидаторе и сброс при изменённом, уборка брошенных недокачек, сохранение
+и загрузка реестра.
+Запуск: python -m pytest test_download_state.py
+"""
+import asyncio
+import os
+import sys
+import time
+sys.path.insert(0, '.')
+
+import pytest
+
+import bot
+
+TOTAL = 1024 * 1024
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, 'RANGED_MIN_SEGMENT_SIZE', 128 * 1024)
+    return bot.DownloadStateStore(str(tmp_path / 'state.json'), str(tmp_path / 'partials'), max_age=60)
+
+
+def write_partial(entry):
+    with open(entry['path'], 'wb') as f:
+        f.truncate(entry['total'])
+
+
+def test_claim_is_exclusive(store):
+    assert store.claim('video')
+    assert not store.claim('video')
+    store.release('video')
+    assert store.claim('video')
+
+
+def test_prepare_reuses_entry_with_same_validator(store):
+    entry = store.prepare('video', 'https://cdn/a', TOTAL, '"v1"', None)
+    assert entry['segments'][0][0] == 0 and entry['segments'][-1][1] == TOTAL - 1
+    write_partial(entry)
+    entry['progress'][0] += 1000
+
+    again = store.prepare('video', 'https://cdn/b', TOTAL, '"v1"', None)
+    assert again is entry
+    assert again['url'] == 'https://cdn/b'  # ссылка CDN протухает, прогресс - нет
+    assert again['progress'][0] == 1000
+
+
+@pytest.mark.parametrize('etag, total', [('"v2"', TOTAL), ('"v1"', TOTAL * 2)])
+def test_prepare_resets_on_changed_file(store, etag, total):
+    entry = store.prepare('video', 'https://cdn/a', TOTAL, '"v1"', None)
+    write_partial(entry)
+    entry['progress'][0] += 1000
+
+    fresh = store.prepare('video', 'https://cdn/a', total, etag, None)
+    assert fresh is not entry
+    assert fresh['progress'] == [start for start, _ in fresh['segments']]
+    assert not os.path.exists(fresh['path'])
+
+
+def test_sweep_skips_active_and_removes_stale(store):
+    stale = store.prepare('stale', 'u', TOTAL, '"v1"', None)
+    busy = store.prepare('busy', 'u', TOTAL, '"v1"', None)
+    fresh = store.prepare('fresh', 'u', TOTAL, '"v1"', None)
+    for entry in (stale, busy, fresh):
+        write_partial(entry)
+        entry['updated'] -= 120
+    fresh['updated'] = time.time()
+    store.claim('busy')
+    orphan = os.path.join(store.partials_dir, 'orphan.part')
+    open(orphan, 'wb').close()
+    os.utime(orphan, (time.time() - 120, time.time() - 120))
+
+    assert store.sweep() == 2
+    assert set(store.entries) == {'busy', 'fresh'}
+    assert not os.path.exists(stale['path'])
+    assert not os.path.exists(orphan)
+    assert os.path.exists(busy['path'])
+
+
+def test_flush_and_load(store):
+    entry = store.prepare('video', 'u', TOTAL, None, 'Mon, 01 Jan 2024 00:00:00 GMT')
+    write_partial(entry)
+    asyncio.run(store.flush())
+    assert not store.dirty
+
+    loaded = bot.DownloadStateStore(store.file_path, store.partials_dir)
+    loaded.load()
+    assert loaded.entries == store.entries
+
+    store.forget('video')
+    assert store.dirty and 'video' not in store.entries
+    # forget не трогает файл: его уже переместили к месту назначения
+    assert os.path.exists(entry['path'])
@@ -0,0 +1,54 @@
+"""
+Тесты FileIdCache: срок жизни, вытеснение старых записей, сохранение и загрузка.
+Запуск: python -m pytest test_file_id_cache.py
+"""
+import asyncio
+import sys
+import time
+sys.path.insert(0, '.')
+
+import bot
+
+
+def test_put_get_and_counters(tmp_path):
+    cache = bot.FileIdCache(str(tmp_path / 'cache.json'))
+    cache.put('youtube:abc:720', 'video', ['file-1'])
+    assert cache.get('youtube:abc:720')['file_ids'] == ['file-1']
+    assert cache.get('youtube:missing:720') is None
+    assert cache.get(None) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert 'file_id_cache_hits_total 1' in cache.metrics_text()
+
+
+def test_expired_entry_is_invalidated(tmp_path):
+    cache = bot.FileIdCache(str(tmp_path / 'cache.json'), ttl=60)
+    cache.put('k', 'video', ['f'])
+    cache.entries['k']['created'] = time.time() - 61
+    assert cache.get('k') is None
+    assert 'k' not in cache.entries
+
+
+def test_evicts_oldest_in_insertion_order(tmp_path):
+    cache = bot.FileIdCache(str(tmp_path / 'cache.json'), max_entries=3)
+    for key in 'abc':
+        cache.put(key, 'video', [key])
+    # Перезапись делает запись самой свежей
+    cache.put('a', 'video', ['a2'])
+    cache.put('d', 'video', ['d'])
+    assert list(cache.entries) == ['c', 'a', 'd']
+
+
+def test_flush_and_load_keep_age_order(tmp_path):
+    path = str(tmp_path / 'cache.json')
+    cache = bot.FileIdCache(path, max_entries=2)
+    cache.put('new', 'video', ['n'])
+    cache.put('old', 'video', ['o'])
+    cache.entries['old']['created'] = time.time() - 10
+    asyncio.run(cache.flush())
+    assert not cache.dirty
+
+    loaded = bot.FileIdCache(path, max_entries=2)
+    loaded.load()
+    assert list(loaded.entries) == ['old', 'new']
+    loaded.put('third', 'video', ['t'])
+    assert list(loaded.entries) == ['new', 'third']
@@ -0,0 +1,108 @@
+"""
+Тесты подбора формата под лимит Telegram: потолок высоты из настройки
+качества, оценка размера по tbr, и что _ydl_download_path извлекает
+метаданные один раз и качает выбранный формат.
+Запуск: python -m pytest test_fit_format.py
+"""
+import asyncio
+import os
+import sys
+import threading
+sys.path.insert(0, '.')
+
+import aiohttp.web
+
+import bot
+
+MB = 1024 * 1024
+
+
+def fmt(format_id, height=None, vcodec='avc1', acodec='mp4a', ext='mp4', size=None, tbr=None):
+    return {'format_id': format_id, 'height': height, 'vcodec': vcodec, 'acodec': acodec,
+            'ext': ext, 'filesize': size, 'tbr': tbr}
+
+
+INFO = {
+    'duration': 100,
+    'formats': [
+        fmt('18', 360, size=10 * MB),
+        fmt('136', 720, acodec='none', size=30 * MB),
+        fmt('137', 1080, acodec='none', size=47 * MB),
+        fmt('140', vcodec='none', ext='m4a', size=2 * MB),
+        fmt('251', vcodec='none', ext='webm', size=3 * MB),
+    ],
+}
+
+
+def test_best_fit_within_height_cap():
+    assert bot.select_fit_format(INFO, 720)[0] == '136+140'
+    assert bot.select_fit_format(INFO, 480)[0] == '18'
+    # 1080p + аудио больше 95% лимита - берётся 720p
+    assert bot.select_fit_format(INFO, 1080)[0] == '136+140'
+
+
+def test_size_estimated_from_bitrate():
+    info = {'duration': 600, 'formats': [fmt('22', 720, tbr=1000), fmt('18', 360, tbr=500)]}
+    # 1000 кбит/с * 600 с = 75 MB - не влезает, 500 кбит/с - 37.5 MB
+    assert bot.select_fit_format(info, 720)[0] == '18'
+    assert bot.select_fit_format({'formats': [fmt('22', 720)]}, 720) is None
+
+
+def test_chooser_only_for_height_capped_qualities():
+    assert bot.fit_format_chooser('best') is None
+    assert bot.fit_format_chooser('audio') is None
+    assert bot.fit_format_chooser('720p')(INFO) == '136+140'
+
+
+def test_legacy_fit_setting_maps_to_720p(monkeypatch):
+    monkeypatch.setitem(bot.user_settings, 42, 'fit')
+    assert bot.get_quality_setting(42) == '720p'
+
+
+def test_download_extracts_once_and_uses_chosen_format(tmp_path):
+    payload = os.urandom(100_000)
+    requests = []
+    ready = threading.Event()
+    state = {}
+
+    async def handler(request):
+        requests.append(request.path)
+        return aiohttp.web.Response(body=payload, content_type='video/mp4')
+
+    async def serve():
+        app = aiohttp.web.Application()
+        app.router.add_get('/v.mp4', handler)
+        runner = aiohttp.web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = aiohttp.web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        state['port'] = site._server.sockets[0].getsockname()[1]
+        state['stop'] = asyncio.Event()
+        ready.set()
+        await state['stop'].wait()
+        await runner.cleanup()
+
+    def run_server():
+        state['loop'] = asyncio.new_event_loop()
+        state['loop'].run_until_complete(serve())
+
+    thread = threading.Thread(target=run_server, daemon=True)
+    thread.start()
+    ready.wait()
+    seen = []
+
+    def choose(info):
+        seen.append([f['format_id'] for f in info['formats']])
+        return info['formats'][0]['format_id']
+
+    try:
+        opts = {'outtmpl': str(tmp_path / '%(title)s.%(ext)s'), 'quiet': True, 'noprogress': True}
+        path = bot._ydl_download_path(f"http://127.0.0.1:{state['port']}/v.mp4", opts, choose)
+    finally:
+        state['loop'].call_soon_threadsafe(state['stop'].set)
+        thread.join()
+
+    assert open(path, 'rb').read() == payload
+    assert len(seen) == 1
+    # Один запрос на извлечение метаданных и один на скачивание
+    assert len(requests) == 2
@@ -0,0 +1,109 @@
+"""
+Тесты хеджированного запуска методов Instagram (_download_hedged): подстраховка
+медленного метода следующим, отмена проигравших с удалением их временных папок,
+быстрый переход дальше после ошибки и задержка по квантилю табло методов.
+Запуск: python -m pytest test_hedged.py
+"""
+import asyncio
+import os
+import sys
+sys.path.insert(0, '.')
+
+import pytest
+
+import bot
+
+
+@pytest.fixture(autouse=True)
+def scoreboard(monkeypatch, tmp_path):
+    board = bot.MethodScoreboard(str(tmp_path / 'stats.json'), exploration_rate=0.0)
+    monkeypatch.setattr(bot, 'METHOD_SCOREBOARD', board)
+    return board
+
+
+def make_method(downloader, log, name, delay, result=True):
+    async def method(url):
+        temp_dir = downloader._mkdtemp(f'{name}_')
+        log.append((name, temp_dir))
+        await asyncio.sleep(delay)
+        if isinstance(result, Exception):
+            raise result
+        if not result:
+            return None, None, ''
+        return os.path.join(temp_dir, 'v.mp4'), None, name
+    return method
+
+
+def test_slow_method_is_hedged_and_loser_cleaned_up():
+    downloader = bot.InstagramDownloader(hedge_delay=0.05)
+    log = []
+    methods = [('slow', make_method(downloader, log, 'slow', 5.0)),
+               ('fast', make_method(downloader, log, 'fast', 0.01))]
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        result = await downloader._download_hedged('url', methods)
+        return result, loop.time() - started
+
+    result, elapsed = asyncio.run(run())
+    assert result[2] == 'fast'
+    assert elapsed < 1.0
+    dirs = dict(log)
+    # Проигравший отменён и убрал за собой, папка победителя остаётся вызывающему
+    assert not os.path.exists(dirs['slow'])
+    assert os.path.exists(dirs['fast'])
+    downloader._remove_dirs([dirs['fast']])
+
+
+def test_failure_starts_next_method_without_waiting():
+    downloader = bot.InstagramDownloader(hedge_delay=10.0)
+    log = []
+    methods = [('broken', make_method(downloader, log, 'broken', 0.0, RuntimeError('403'))),
+               ('empty', make_method(downloader, log, 'empty', 0.0, result=False)),
+               ('ok', make_method(downloader, log, 'ok', 0.0))]
+
+    async def run():
+        return await asyncio.wait_for(downloader._download_hedged('url', methods), timeout=1.0)
+
+    result = asyncio.run(run())
+    assert result[2] == 'ok'
+    assert [name for name, _ in log] == ['broken', 'empty', 'ok']
+    dirs = dict(log)
+    assert not os.path.exists(dirs['broken']) and not os.path.exists(dirs['empty'])
+    downloader._remove_dirs([dirs['ok']])
+
+
+def test_all_methods_fail():
+    downloader = bot.InstagramDownloader(hedge_delay=0.01)
+    log = []
+    methods = [(name, make_method(downloader, log, name, 0.02, result=False)) for name in ('a', 'b', 'c')]
+    assert asyncio.run(downloader._download_hedged('url', methods)) is None
+    assert all(not os.path.exists(temp_dir) for _, temp_dir in log)
+
+
+def test_cancel_stops_every_attempt():
+    downloader = bot.InstagramDownloader(hedge_delay=0.01)
+    log = []
+    methods = [(name, make_method(downloader, log, name, 5.0)) for name in ('a', 'b')]
+
+    async def run():
+        task = asyncio.create_task(downloader._download_hedged('url', methods))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert [name for name, _ in log] == ['a', 'b']
+    assert all(not os.path.exists(temp_dir) for _, temp_dir in log)
+
+
+def test_hedge_delay_follows_latency_quantile(scoreboard):
+    downloader = bot.InstagramDownloader(hedge_delay=3.0, hedge_quantile=0.9)
+    assert downloader._hedge_delay('yt-dlp') == 3.0
+    for latency in (1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 2.5):
+        scoreboard.record('instagram', 'yt-dlp', True, latency)
+    scoreboard.record('instagram', 'yt-dlp', False, 30.0)
+    # Неудачи не входят в квантиль успешных вызовов
+    assert downloader._hedge_delay('yt-dlp') == 2.5
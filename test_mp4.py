@@ -0,0 +1,138 @@
+"""
+Тесты разбора MP4 (probe_mp4, _parse_moov) и переноса moov (faststart_mp4,
+_patch_chunk_offsets) на собранных вручную файлах с stco и co64.
+Запуск: python -m pytest test_mp4.py
+"""
+import struct
+import sys
+sys.path.insert(0, '.')
+
+from bot import Mp4Info, _parse_moov, _patch_chunk_offsets, faststart_mp4, probe_mp4
+
+CHUNK = 4096
+CHUNKS = 3
+
+
+def box(kind: bytes, body: bytes) -> bytes:
+    return struct.pack('>I4s', 8 + len(body), kind) + body
+
+
+def full_box(kind: bytes, body: bytes, version: int = 0) -> bytes:
+    return box(kind, bytes([version, 0, 0, 0]) + body)
+
+
+def chunk_offsets(kind: bytes, offsets) -> bytes:
+    fmt = '>I' if kind == b'stco' else '>Q'
+    return full_box(kind, struct.pack('>I', len(offsets)) + b''.join(struct.pack(fmt, o) for o in offsets))
+
+
+def make_moov(offsets_box: bytes, duration: int = 12000, timescale: int = 1000,
+              width: int = 1280, height: int = 720, handler: bytes = b'vide', extra: bytes = b'',
+              mvhd_version: int = 0) -> bytes:
+    if mvhd_version == 1:
+        mvhd = full_box(b'mvhd', struct.pack('>QQIQ', 0, 0, timescale, duration) + b'\0' * 80, version=1)
+    else:
+        mvhd = full_box(b'mvhd', struct.pack('>IIII', 0, 0, timescale, duration) + b'\0' * 80)
+    tkhd = full_box(b'tkhd', b'\0' * 72 + struct.pack('>II', width << 16, height << 16))
+    hdlr = full_box(b'hdlr', b'\0' * 4 + handler + b'\0' * 13)
+    stbl = box(b'stbl', offsets_box)
+    trak = box(b'trak', tkhd + box(b'mdia', hdlr + box(b'minf', stbl)))
+    return box(b'moov', mvhd + trak + extra)
+
+
+def write_mp4(path, kind: bytes = b'stco', moov_first: bool = False) -> bytes:
+    """ftyp + mdat из CHUNKS чанков с меткой номера + moov. Возвращает записанные байты."""
+    ftyp = box(b'ftyp', b'isom\0\0\0\0isommp41')
+    mdat = box(b'mdat', b''.join(struct.pack('>I', i) + b'\0' * (CHUNK - 4) for i in range(CHUNKS)))
+    moov_size = len(make_moov(chunk_offsets(kind, [0] * CHUNKS)))
+    first = len(ftyp) + (moov_size if moov_first else 0) + 8
+    moov = make_moov(chunk_offsets(kind, [first + i * CHUNK for i in range(CHUNKS)]))
+    data = ftyp + moov + mdat if moov_first else ftyp + mdat + moov
+    path.write_bytes(data)
+    return data
+
+
+def read_offsets(data: bytes, kind: bytes):
+    pos = data.index(kind) + 8
+    count = struct.unpack_from('>I', data, pos)[0]
+    fmt = '>%dI' if kind == b'stco' else '>%dQ'
+    return struct.unpack_from(fmt % count, data, pos + 4)
+
+
+def test_probe_moov_at_end(tmp_path):
+    write_mp4(tmp_path / 'a.mp4')
+    info = probe_mp4(str(tmp_path / 'a.mp4'))
+    assert [kind for kind, _, _ in info.boxes] == ['ftyp', 'mdat', 'moov']
+    assert not info.faststart
+    assert not info.fragmented
+    assert info.duration == 12.0
+    assert (info.width, info.height) == (1280, 720)
+    assert info.needs_remux
+
+
+def test_probe_faststart_file(tmp_path):
+    write_mp4(tmp_path / 'a.mp4', moov_first=True)
+    info = probe_mp4(str(tmp_path / 'a.mp4'))
+    assert info.faststart
+    assert not info.needs_remux
+
+
+def test_probe_rejects_non_mp4(tmp_path):
+    (tmp_path / 'a.mp4').write_bytes(box(b'mdat', b'\0' * 16))
+    assert probe_mp4(str(tmp_path / 'a.mp4')) is None
+    (tmp_path / 'b.mp4').write_bytes(b'\0\0\0\4junk')
+    assert probe_mp4(str(tmp_path / 'b.mp4')) is None
+
+
+def test_parse_moov_version1_and_fragmented():
+    moov = make_moov(chunk_offsets(b'stco', [0]), duration=90000 * 5, timescale=90000,
+                     extra=box(b'mvex', b''), mvhd_version=1)
+    info = Mp4Info()
+    _parse_moov(moov[8:], info)
+    assert info.duration == 5.0
+    assert info.fragmented
+    assert (info.width, info.height) == (1280, 720)
+
+
+def test_parse_moov_ignores_audio_track_size():
+    info = Mp4Info()
+    _parse_moov(make_moov(chunk_offsets(b'stco', [0]), handler=b'soun')[8:], info)
+    assert info.width is None and info.height is None
+
+
+def test_faststart_shifts_stco(tmp_path):
+    source = write_mp4(tmp_path / 'src.mp4')
+    assert faststart_mp4(str(tmp_path / 'src.mp4'), str(tmp_path / 'dst.mp4'))
+    data = (tmp_path / 'dst.mp4').read_bytes()
+    assert len(data) == len(source)
+    info = probe_mp4(str(tmp_path / 'dst.mp4'))
+    assert [kind for kind, _, _ in info.boxes] == ['ftyp', 'moov', 'mdat']
+    assert info.duration == 12.0
+    # Каждое смещение указывает на свой чанк с меткой номера
+    for i, offset in enumerate(read_offsets(data, b'stco')):
+        assert struct.unpack_from('>I', data, offset)[0] == i
+
+
+def test_faststart_shifts_co64(tmp_path):
+    write_mp4(tmp_path / 'src.mp4', kind=b'co64')
+    assert faststart_mp4(str(tmp_path / 'src.mp4'), str(tmp_path / 'dst.mp4'))
+    data = (tmp_path / 'dst.mp4').read_bytes()
+    for i, offset in enumerate(read_offsets(data, b'co64')):
+        assert struct.unpack_from('>I', data, offset)[0] == i
+
+
+def test_faststart_skips_faststart_file(tmp_path):
+    write_mp4(tmp_path / 'src.mp4', moov_first=True)
+    assert not faststart_mp4(str(tmp_path / 'src.mp4'), str(tmp_path / 'dst.mp4'))
+    assert not (tmp_path / 'dst.mp4').exists()
+
+
+def test_patch_chunk_offsets_only_before_moov():
+    moov = bytearray(make_moov(chunk_offsets(b'co64', [100, 5000, 9000])))
+    assert _patch_chunk_offsets(moov, 8, len(moov), moov_start=6000, shift=500)
+    assert read_offsets(bytes(moov), b'co64') == (600, 5500, 9000)
+
+
+def test_patch_chunk_offsets_stco_overflow():
+    moov = bytearray(make_moov(chunk_offsets(b'stco', [0xFFFFFF00])))
+    assert not _patch_chunk_offsets(moov, 8, len(moov), moov_start=0xFFFFFFF0, shift=0x1000)
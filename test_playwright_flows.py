@@ -0,0 +1,87 @@
+"""
+Тесты Playwright-сценариев без браузера: download_youtube_with_playwright
+отдаёт yt-dlp cookies страницы из пула во временном cookiefile, который
+удаляется после загрузки; wait_first возвращается на первом выполненном
+условии, пропускает упавшие и отменяет остальные.
+Запуск: python -m pytest test_playwright_flows.py
+"""
+import asyncio
+import contextlib
+import os
+import sys
+sys.path.insert(0, '.')
+
+import bot
+
+
+class FakeContext:
+    async def cookies(self):
+        return [{'domain': '.youtube.com', 'name': 'SOCS', 'value': 'CAI', 'path': '/', 'secure': True},
+                {'domain': '.example.com', 'name': 'other', 'value': 'x'}]
+
+
+class FakePage:
+    url = 'https://www.youtube.com/watch?v=abc'
+    context = FakeContext()
+
+    async def goto(self, url, wait_until=None):
+        self.url = url
+
+
+class FakeBrowsers:
+    def available(self, name):
+        return True
+
+    @contextlib.asynccontextmanager
+    async def page(self, name):
+        yield FakePage()
+
+
+def test_ytdlp_gets_page_cookies(monkeypatch):
+    seen = {}
+
+    async def run_ydl_download(platform, url, ydl_opts, choose_format=None):
+        with open(ydl_opts['cookiefile']) as f:
+            seen['cookies'] = f.read()
+        seen['path'] = ydl_opts['cookiefile']
+        return 'video.mp4'
+
+    monkeypatch.setattr(bot, 'BROWSERS', FakeBrowsers())
+    monkeypatch.setattr(bot, 'run_ydl_download', run_ydl_download)
+    result = asyncio.run(bot.download_youtube_with_playwright('https://www.youtube.com/watch?v=abc'))
+
+    assert result == 'video.mp4'
+    assert '\tSOCS\tCAI' in seen['cookies']
+    assert 'example.com' not in seen['cookies']
+    assert not os.path.exists(seen['path'])
+
+
+def test_wait_first_returns_on_first_condition_and_cancels_rest():
+    async def run():
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        slow = asyncio.ensure_future(asyncio.sleep(10))
+
+        async def failing():
+            raise TimeoutError('playwright timeout')
+
+        loop.call_later(0.05, ready.set)
+        started = loop.time()
+        result = await bot.wait_first(failing(), ready.wait(), slow, timeout=5)
+        return result, loop.time() - started, slow.cancelled()
+
+    result, elapsed, cancelled = asyncio.run(run())
+    assert result
+    assert elapsed < 1
+    assert cancelled
+
+
+def test_wait_first_deadline():
+    async def run():
+        async def failing():
+            raise TimeoutError('playwright timeout')
+        never = asyncio.Event()
+        return (await bot.wait_first(never.wait(), timeout=0.05),
+                await bot.wait_first(failing(), timeout=1))
+
+    assert asyncio.run(run()) == (False, False)
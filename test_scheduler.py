@@ -0,0 +1,261 @@
+"""
+Тесты DownloadScheduler: доля премиума по весам (WFQ), независимые воркеры
+платформ, общий лимит очереди с резервом для премиума, позиция в очереди
+против фактического порядка выдачи, отмена ждущей задачи, повышение задачи
+до премиума и ограничение нулевого веса.
+Запуск: python -m pytest test_scheduler.py
+"""
+import asyncio
+import random
+import sys
+sys.path.insert(0, '.')
+
+import pytest
+
+import bot
+
+WEIGHTS = {bot.TIER_PREMIUM: 4.0, bot.TIER_FREE: 1.0}
+
+
+def fill(scheduler, platform, tiers):
+    """Ставит задачи в очередь без воркеров; фабрика ничего не делает."""
+    async def noop():
+        return None
+    return [scheduler.submit(platform, noop, tier) for tier in tiers]
+
+
+def drain(scheduler, platform):
+    order = []
+    while True:
+        job = scheduler._pop_next(platform)
+        if job is None:
+            return order
+        order.append(job)
+
+
+def test_weighted_share_of_premium():
+    async def run():
+        scheduler = bot.DownloadScheduler({'x': 1}, max_queue=100, tier_weights=WEIGHTS)
+        fill(scheduler, 'x', [bot.TIER_FREE] * 20 + [bot.TIER_PREMIUM] * 20)
+        return [job.tier for job in drain(scheduler, 'x')]
+
+    order = asyncio.run(run())
+    # Пока есть оба уровня, на одного бесплатного выходит четыре премиума
+    first = order[:10]
+    assert first.count(bot.TIER_PREMIUM) == 8
+    assert first.count(bot.TIER_FREE) == 2
+    # Бесплатные не голодают: все выданы
+    assert order.count(bot.TIER_FREE) == 20
+
+
+def test_platforms_have_independent_workers():
+    async def run():
+        scheduler = bot.DownloadScheduler({'a': 1, 'b': 1}, max_queue=10, tier_weights=WEIGHTS)
+        scheduler.start()
+        gate = asyncio.Event()
+        finished = []
+
+        async def blocker():
+            await gate.wait()
+
+        async def quick():
+            finished.append('b')
+
+        blocked = asyncio.create_task(scheduler.run('a', blocker))
+        await asyncio.sleep(0.01)
+        # Занятый воркер платформы a не задерживает платформу b
+        await asyncio.wait_for(scheduler.run('b', quick), timeout=1.0)
+        assert not blocked.done()
+        gate.set()
+        await blocked
+        await scheduler.stop()
+        return finished
+
+    assert asyncio.run(run()) == ['b']
+
+
+def test_fairness_within_each_platform():
+    async def run():
+        scheduler = bot.DownloadScheduler({'a': 1, 'b': 1}, max_queue=100, tier_weights=WEIGHTS)
+        fill(scheduler, 'a', [bot.TIER_FREE] * 10 + [bot.TIER_PREMIUM] * 10)
+        fill(scheduler, 'b', [bot.TIER_FREE] * 10)
+        return ([job.tier for job in drain(scheduler, 'a')][:5],
+                [job.tier for job in drain(scheduler, 'b')])
+
+    a, b = asyncio.run(run())
+    assert a.count(bot.TIER_PREMIUM) == 4
+    # Премиум платформы a не сдвигает очередь платформы b
+    assert b == [bot.TIER_FREE] * 10
+
+
+def test_global_cap_with_premium_reserve():
+    async def run():
+        scheduler = bot.DownloadScheduler({'x': 1}, max_queue=4, tier_weights=WEIGHTS, premium_reserve=1)
+        fill(scheduler, 'x', [bot.TIER_FREE] * 3)
+        with pytest.raises(bot.QueueFullError):
+            fill(scheduler, 'x', [bot.TIER_FREE])
+        # Резервное место достаётся премиуму, дальше общий лимит и для него
+        fill(scheduler, 'x', [bot.TIER_PREMIUM])
+        with pytest.raises(bot.QueueFullError):
+            fill(scheduler, 'x', [bot.TIER_PREMIUM])
+        return scheduler.metrics()['x']
+
+    assert asyncio.run(run())['rejected'] == 2
+
+
+def test_premium_cannot_exceed_global_cap():
+    async def run():
+        scheduler = bot.DownloadScheduler({'x': 1}, max_queue=3, tier_weights=WEIGHTS)
+        fill(scheduler, 'x', [bot.TIER_PREMIUM] * 3)
+        with pytest.raises(bot.QueueFullError):
+            fill(scheduler, 'x', [bot.TIER_PREMIUM])
+
+    asyncio.run(run())
+
+
+def test_position_matches_pop_order():
+    rng = random.Random(7)
+
+    async def run():
+        for _ in range(20):
+            scheduler = bot.DownloadScheduler({'x': 1}, max_queue=200, tier_weights=WEIGHTS)
+            scheduler._ensure_platform('x')
+            # Сдвигаем виртуальное время, как после уже выданных задач
+            fill(scheduler, 'x', [rng.choice(list(WEIGHTS)) for _ in range(rng.randint(0, 10))])
+            for _ in range(rng.randint(0, 5)):
+                scheduler._pop_next('x')
+            jobs = fill(scheduler, 'x', [rng.choice(list(WEIGHTS)) for _ in range(rng.randint(1, 30))])
+            queued = [job for tier in scheduler._queues['x'].values() for job in tier]
+            expected = {id(job): scheduler.position(job) for job in queued}
+            order = drain(scheduler, 'x')
+            assert [expected[id(job)] for job in order] == list(range(1, len(order) + 1))
+            assert all(scheduler.position(job) == 0 for job in jobs)
+
+    asyncio.run(run())
+
+
+def test_cancel_removes_waiting_job():
+    async def run():
+        scheduler = bot.DownloadScheduler({'x': 1}, max_queue=10, tier_weights=WEIGHTS)
+        scheduler.start()
+        gate = asyncio.Event()
+        started = []
+
+        async def blocker():
+            await gate.wait()
+
+        async def work():
+            started.append(True)
+
+        running = asyncio.create_task(scheduler.run('x', blocker))
+        await asyncio.sleep(0.01)
+        waiting = asyncio.create_task(scheduler.run('x', work))
+        await asyncio.sleep(0.01)
+        assert scheduler._queued('x') == 1
+        waiting.cancel()
+        await asyncio.sleep(0.01)
+        queued = scheduler._queued('x')
+        gate.set()
+        await running
+        await asyncio.sleep(0.01)
+        await scheduler.stop()
+        return queued, started
+
+    queued, started = asyncio.run(run())
+    assert queued == 0
+    assert started == []
+
+
+def test_queued_callback_gets_position():
+    async def run():
+        scheduler = bot.DownloadScheduler({'x': 1}, max_queue=10, tier_weights=WEIGHTS)
+        scheduler.start()
+        gate = asyncio.Event()
+        positions = []
+
+        async def blocker():
+            await gate.wait()
+
+        async def on_queued(position):
+            positions.append(position)
+
+        first = asyncio.create_task(scheduler.run('x', blocker, on_queued))
+        await asyncio.sleep(0.01)
+        rest = [asyncio.create_task(scheduler.run('x', blocker, on_queued)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        gate.set()
+        await asyncio.gather(first, *rest)
+        await scheduler.stop()
+        return positions
+
+    # Первая задача сразу ушла в свободный воркер, остальные получили свои места
+    assert asyncio.run(run()) == [1, 2]
+
+
+def test_zero_weight_is_clamped():
+    scheduler = bot.DownloadScheduler({'x': 1}, max_queue=10,
+                                      tier_weights={bot.TIER_PREMIUM: 0, bot.TIER_FREE: -1})
+    assert all(weight == bot.MIN_TIER_WEIGHT for weight in scheduler.tier_weights.values())
+
+    async def run():
+        fill(scheduler, 'x', [bot.TIER_FREE, bot.TIER_PREMIUM])
+        return len(drain(scheduler, 'x'))
+
+    assert asyncio.run(run()) == 2
+
+
+def test_promote_moves_job_to_premium_lane():
+    async def run():
+        scheduler = bot.DownloadScheduler({'x': 1}, max_queue=10, tier_weights=WEIGHTS)
+        jobs = fill(scheduler, 'x', [bot.TIER_FREE] * 4)
+        last = jobs[-1]
+        assert scheduler.position(last) == 4
+        scheduler.promote(last, bot.TIER_PREMIUM)
+        assert last.tier == bot.TIER_PREMIUM
+        position = scheduler.position(last)
+        # Понижение не делается
+        scheduler.promote(last, bot.TIER_FREE)
+        assert last.tier == bot.TIER_PREMIUM
+        return position, drain(scheduler, 'x').index(last) + 1
+
+    position, popped = asyncio.run(run())
+    assert position == popped
+    assert popped < 4
+
+
+def test_joiner_promotes_coalesced_flight(monkeypatch):
+    async def run():
+        scheduler = bot.DownloadScheduler({'x': 1}, max_queue=10, tier_weights=WEIGHTS)
+        monkeypatch.setattr(bot, 'DOWNLOAD_SCHEDULER', scheduler)
+        scheduler.start()
+        coalescer = bot.DownloadCoalescer()
+        gate = asyncio.Event()
+        order = []
+
+        async def blocker():
+            await gate.wait()
+
+        def job(name):
+            async def work():
+                order.append(name)
+                return None, [name], ''
+            return work
+
+        def factory(flight):
+            return scheduler.run('x', job('flight'), tier=flight.tier,
+                                 on_submit=lambda j: setattr(flight, 'job', j))
+
+        running = asyncio.create_task(scheduler.run('x', blocker))
+        await asyncio.sleep(0.01)
+        others = [asyncio.create_task(scheduler.run('x', job(f'free{i}'))) for i in range(3)]
+        leader = asyncio.create_task(coalescer.run('k', factory, tier=bot.TIER_FREE))
+        await asyncio.sleep(0.01)
+        joiner = asyncio.create_task(coalescer.run('k', factory, tier=bot.TIER_PREMIUM))
+        await asyncio.sleep(0.01)
+        gate.set()
+        await asyncio.gather(running, leader, joiner, *others)
+        await scheduler.stop()
+        return order
+
+    # Премиум-получатель поднял общую загрузку впереди бесплатных
+    assert asyncio.run(run())[0] == 'flight'
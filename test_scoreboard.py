@@ -0,0 +1,71 @@
+"""
+Тесты MethodScoreboard: порядок по успеху в секунду, сглаживание для новых
+методов, скользящее окно результатов, исследование и сохранение статистики.
+Запуск: python -m pytest test_scoreboard.py
+"""
+import asyncio
+import sys
+sys.path.insert(0, '.')
+
+import bot
+
+METHODS = [('a', None), ('b', None), ('c', None)]
+
+
+def names(ordered):
+    return [name for name, _ in ordered]
+
+
+def test_order_by_success_per_second(tmp_path):
+    board = bot.MethodScoreboard(str(tmp_path / 'stats.json'), exploration_rate=0.0)
+    for _ in range(10):
+        board.record('ig', 'a', False, 10.0)  # всегда падает по таймауту
+        board.record('ig', 'b', True, 4.0)
+        board.record('ig', 'c', True, 1.0)
+    assert names(board.order('ig', METHODS)) == ['c', 'b', 'a']
+
+
+def test_new_method_keeps_original_position(tmp_path):
+    board = bot.MethodScoreboard(str(tmp_path / 'stats.json'), exploration_rate=0.0)
+    assert names(board.order('ig', METHODS)) == ['a', 'b', 'c']
+    assert board.success_rate('ig', 'a') == 0.5
+
+
+def test_window_forgets_old_results(tmp_path):
+    board = bot.MethodScoreboard(str(tmp_path / 'stats.json'), window=5, exploration_rate=0.0)
+    for _ in range(20):
+        board.record('ig', 'a', True, 1.0)
+    board.record('ig', 'b', True, 1.0)
+    assert names(board.order('ig', METHODS))[0] == 'a'
+    # Метод сломался: после окна неудач 20 старых успехов забыты
+    for _ in range(5):
+        board.record('ig', 'a', False, 1.0)
+    assert board.success_rate('ig', 'a') == 1 / 7
+    assert names(board.order('ig', METHODS))[:2] == ['b', 'a']
+
+
+def test_groups_are_independent(tmp_path):
+    board = bot.MethodScoreboard(str(tmp_path / 'stats.json'), exploration_rate=0.0)
+    for _ in range(5):
+        board.record('youtube', 'c', True, 0.5)
+    assert names(board.order('ig', METHODS)) == ['a', 'b', 'c']
+
+
+def test_exploration_moves_non_leader_first(tmp_path, monkeypatch):
+    board = bot.MethodScoreboard(str(tmp_path / 'stats.json'), exploration_rate=1.0)
+    monkeypatch.setattr(bot.random, 'randrange', lambda start, stop: stop - 1)
+    assert names(board.order('ig', METHODS)) == ['c', 'a', 'b']
+
+
+def test_flush_and_load(tmp_path):
+    path = str(tmp_path / 'stats.json')
+    board = bot.MethodScoreboard(path, exploration_rate=0.0)
+    board.record('ig', 'b', True, 2.0)
+    board.record('ig', 'b', False, 4.0)
+    asyncio.run(board.flush())
+    assert not board.dirty
+
+    loaded = bot.MethodScoreboard(path, exploration_rate=0.0)
+    loaded.load()
+    assert loaded.snapshot() == board.snapshot()
+    assert loaded.stats['ig']['b']['latency'] == board.stats['ig']['b']['latency']
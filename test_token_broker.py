@@ -0,0 +1,98 @@
+"""
+Тесты TokenBroker: одновременные запросы ждут одно обновление, устаревшее
+поколение отдаёт уже свежие токены, пауза после неудачи и расписание
+планового обновления.
+Запуск: python -m pytest test_token_broker.py
+"""
+import asyncio
+import sys
+from datetime import datetime, timedelta
+sys.path.insert(0, '.')
+
+import bot
+
+
+class Refresher:
+    def __init__(self, results):
+        self.results = list(results)
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def test_concurrent_refreshes_coalesce():
+    refresher = Refresher([True])
+    broker = bot.TokenBroker(refresher, ttl=3600, refresh_ahead=600, min_interval=60)
+
+    async def run():
+        generation = broker.generation
+        return await asyncio.gather(*(broker.refresh("блокировка", seen_generation=generation)
+                                      for _ in range(5)))
+
+    assert asyncio.run(run()) == [True] * 5
+    assert refresher.calls == 1
+    assert (broker.generation, broker.refreshes, broker.coalesced) == (1, 1, 4)
+
+
+def test_stale_generation_skips_refresh():
+    refresher = Refresher([True, True])
+    broker = bot.TokenBroker(refresher, ttl=3600, refresh_ahead=600, min_interval=60)
+    assert asyncio.run(broker.refresh("плановое"))
+    # Ошибка случилась на токенах поколения 0, а они уже сменились
+    assert asyncio.run(broker.refresh("блокировка", seen_generation=0))
+    assert refresher.calls == 1
+    assert asyncio.run(broker.refresh("блокировка", seen_generation=1))
+    assert (refresher.calls, broker.generation) == (2, 2)
+
+
+def test_failure_backs_off():
+    refresher = Refresher([False, RuntimeError("браузер упал"), True])
+    broker = bot.TokenBroker(refresher, ttl=3600, refresh_ahead=600, min_interval=60)
+    assert not asyncio.run(broker.refresh("плановое"))
+    # Повтор в пределах min_interval не трогает браузер
+    assert not asyncio.run(broker.refresh("блокировка"))
+    assert (refresher.calls, broker.coalesced) == (1, 1)
+    assert 59 < broker.next_refresh_in() <= 60
+
+    broker.last_attempt -= 61
+    assert not asyncio.run(broker.refresh("блокировка"))
+    assert (broker.failures, broker.failures_in_row) == (2, 2)
+    assert 119 < broker.next_refresh_in() <= 120
+
+    broker.last_attempt -= 121
+    assert asyncio.run(broker.refresh("плановое"))
+    assert (broker.failures_in_row, broker.generation) == (0, 1)
+    assert 'youtube_token_failures_total 2' in broker.metrics_text()
+
+
+def test_schedule_refreshes_ahead_of_ttl(monkeypatch):
+    broker = bot.TokenBroker(Refresher([]), ttl=3600, refresh_ahead=600, min_interval=60)
+    monkeypatch.setattr(bot, 'YOUTUBE_COOKIES_LAST_REFRESH', None)
+    assert broker.next_refresh_in() == 0
+    monkeypatch.setattr(bot, 'YOUTUBE_COOKIES_LAST_REFRESH', datetime.now() - timedelta(seconds=1000))
+    assert 1999 <= broker.next_refresh_in() <= 2000
+
+
+def test_refresh_soon_starts_one_background_refresh(monkeypatch):
+    refresher = Refresher([True])
+    broker = bot.TokenBroker(refresher, ttl=3600, refresh_ahead=600, min_interval=60)
+    monkeypatch.setattr(bot, 'YOUTUBE_COOKIES_LAST_REFRESH', datetime.now() - timedelta(seconds=3500))
+
+    async def run():
+        for _ in range(3):
+            broker.refresh_soon("устарели")
+        await broker._background
+
+    asyncio.run(run())
+    assert (refresher.calls, broker.generation) == (1, 1)
+
+    # Свежие токены не обновляются
+    monkeypatch.setattr(bot, 'YOUTUBE_COOKIES_LAST_REFRESH', datetime.now())
+    broker.refresh_soon("устарели")
+    assert refresher.calls == 1
@@ -0,0 +1,114 @@
+"""
+Тесты TokenPool: выдача личностей по кругу, вывод заблокированных и
+истёкших, удаление файла cookies только после последней загрузки, отдельные
+копии cookies для параллельных загрузок и добор пула фоновым циклом.
+Запуск: python -m pytest test_token_pool.py
+"""
+import asyncio
+import os
+import sys
+sys.path.insert(0, '.')
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def pool(tmp_path):
+    return bot.TokenPool(size=2, directory=str(tmp_path), ttl=60, retry_interval=1)
+
+
+def make_identity(directory, name):
+    cookiefile = os.path.join(directory, f"{name}.txt")
+    with open(cookiefile, 'w') as f:
+        f.write(f"# {name}\n")
+    return bot.YoutubeIdentity(name, f"visitor-{name}", f"po-{name}", cookiefile)
+
+
+def add_identity(pool, name):
+    identity = make_identity(pool.directory, name)
+    pool._identities.append(identity)
+    return identity
+
+
+def test_acquire_round_robin(pool):
+    assert pool.acquire() is None
+    first = add_identity(pool, 'identity-1')
+    second = add_identity(pool, 'identity-2')
+    assert [pool.acquire() for _ in range(4)] == [first, second, first, second]
+    assert (first.in_use, first.uses) == (2, 2)
+
+
+def test_block_retires_and_removes_file_after_last_user(pool):
+    identity = add_identity(pool, 'identity-1')
+    other = add_identity(pool, 'identity-2')
+    assert pool.acquire() is identity
+    pool.acquire()
+    assert pool.acquire() is identity
+
+    pool.release(identity, ok=False, blocked=True)
+    assert identity.retired and pool.blocks == 1
+    assert pool.live() == [other]
+    # Вторая загрузка ещё держит личность: файл cookies на месте
+    assert os.path.exists(identity.cookiefile)
+
+    pool.release(identity, ok=True)
+    assert not os.path.exists(identity.cookiefile)
+    assert (identity.successes, identity.failures) == (1, 1)
+    assert pool._wake.is_set()
+
+
+def test_expired_identity_not_handed_out(pool):
+    old = add_identity(pool, 'identity-1')
+    fresh = add_identity(pool, 'identity-2')
+    old.minted_at -= pool.ttl + 1
+    assert pool.live() == [fresh]
+    assert [pool.acquire() for _ in range(2)] == [fresh, fresh]
+
+
+def test_each_lease_gets_own_cookie_copy(pool):
+    identity = add_identity(pool, 'identity-1')
+    first = pool.lease_cookiefile(identity)
+    second = pool.lease_cookiefile(identity)
+    assert len({first, second, identity.cookiefile}) == 3
+    # Запись yt-dlp в свою копию не затрагивает ни соседа, ни исходный файл
+    with open(first, 'w') as f:
+        f.write('# rewritten\n')
+    assert open(second).read() == open(identity.cookiefile).read() == '# identity-1\n'
+
+    pool.close()
+    assert os.listdir(pool.directory) == []
+
+
+def test_run_fills_pool_and_replaces_retired(pool, monkeypatch):
+    monkeypatch.setattr(bot.BROWSERS, 'available', lambda platform: True)
+    serial = iter(range(1, 100))
+
+    async def mint():
+        return make_identity(pool.directory, f"identity-{next(serial)}")
+
+    monkeypatch.setattr(pool, 'mint', mint)
+
+    async def wait_for(predicate):
+        for _ in range(100):
+            if predicate():
+                return
+            await asyncio.sleep(0.01)
+        raise AssertionError("пул не дошёл до ожидаемого состояния")
+
+    async def run():
+        task = asyncio.create_task(pool.run())
+        try:
+            await wait_for(lambda: len(pool.live()) == 2)
+            blocked = pool.acquire()
+            pool.release(blocked, ok=False, blocked=True)
+            await wait_for(lambda: pool.minted == 3)
+            return blocked
+        finally:
+            task.cancel()
+
+    blocked = asyncio.run(run())
+    assert [i.name for i in pool.live()] == ['identity-2', 'identity-3']
+    assert not os.path.exists(blocked.cookiefile)
+    assert 'youtube_identities_live 2' in pool.metrics_text()